@@ -0,0 +1,461 @@
+# Asyncio acquisition core: walks and fetches several sources at once and feeds them to one imager.
+
+import asyncio
+import posixpath
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from colorama import reinit, Fore
+
+import imaging
+import metrics
+import utilities
+
+reinit()  # Colorama
+utils = utilities.Utilities.get_instance()
+run_metrics = metrics.Metrics.get_instance()
+
+# Number of entries that can wait on the imager before the sources stop producing more.
+SINK_SIZE = 64
+# Number of sessions opened to a source when the plugin isn't told otherwise.
+CONNECTIONS = 4
+# Size of the reads handed to the imager.
+READ_SIZE = 1024 * 1024
+
+
+class Source:
+    """
+        The walker/fetcher protocol a plugin implements to be acquired by `Acquisition`. A source has a pool of
+        sessions, each a connection to the same device or server, and its workers take turns on them, one for each
+        session unless the connection can carry more than one transfer at a time. `walk` and `open` are blocking and
+        run on a thread pool the size of the workers, so client libraries like pysftp, ftplib, smbclient or adb_shell
+        are used as they are.
+    """
+
+    def __init__(self, sessions, queue_size=256, buffer_chunks=64, workers=None, unchanged=None):
+        """
+            Constructor for the Source class.
+
+            Parameters:
+                sessions: Connections to the source.
+                queue_size: Number of files that can wait to be fetched before the workers stop listing to fetch them.
+                buffer_chunks: Number of chunks each transfer can buffer before it waits on the imager.
+                workers: Number of workers sharing the sessions, one for each session by default.
+                unchanged: Callable taking a container path and its metadata, files it is true for are not fetched
+                           unless the imager opens them.
+        """
+
+        self.sessions = sessions
+        self.queue_size = queue_size
+        self.buffer_chunks = buffer_chunks
+        self.workers = workers or len(sessions)
+        self.unchanged = unchanged
+        self.stats = [{"files": 0, "bytes": 0, "listings": 0, "errors": 0, "seconds": 0.0}
+                      for _ in range(self.workers)]
+
+    def walk(self, session, directory):
+        """
+            List one directory. Returns the folders to add to the container as (path, metadata, None) tuples, the
+            directories to walk next and the files to fetch.
+        """
+
+        raise NotImplementedError
+
+    def open(self, session, item):
+        """
+            Start fetching a file. Returns its container path, its metadata and a callable that writes the file's data
+            to the file like object it is given, or None if the file can't be fetched.
+        """
+
+        raise NotImplementedError
+
+
+class PooledSource(Source):
+    """
+        A `Source` for a device or server whose files are found by listing its directories: the workers share a
+        frontier of directories still to be listed and a queue of files still to be copied, so listings and transfers
+        overlap instead of waiting on one round trip at a time. Each file is handed to the imager as soon as its
+        transfer starts. A protocol implements `list` and `read`, and `container_path` if its paths aren't stored as
+        they are.
+    """
+
+    protocol = None
+
+    def __init__(self, sessions, verbose=False, queue_size=256, buffer_chunks=64, skip=None, workers=None,
+                 unchanged=None):
+        """
+            Constructor for the PooledSource class.
+
+            Parameters:
+                sessions: Connections to the source.
+                verbose: Print each folder and file as it is found.
+                queue_size: Number of files that can wait to be copied before the workers stop listing to copy them.
+                buffer_chunks: Number of chunks each transfer can buffer before it waits on the imager.
+                skip: Container paths that are already in the image.
+                workers: Number of workers sharing the sessions, one for each session by default.
+                unchanged: Callable taking a container path and its metadata, files it is true for are not copied
+                           unless the imager opens them.
+        """
+
+        super().__init__(sessions, queue_size, buffer_chunks, workers, unchanged)
+        self.verbose = verbose
+        self.skip = skip if skip is not None else set()
+        self.result = True
+        self.options = (False, set(), True)
+        self.lock = threading.Lock()
+        # Files to copy along with the next walk, without listing their directories.
+        self.files = deque()
+        self.visited = set()
+
+    @classmethod
+    def open_sessions(cls, connect, count, verbose=False):
+        """
+            Open up to `count` sessions with `connect`, a callable that returns a new connection. The first session has
+            to open, any after it that fail are left out so fewer workers are used.
+        """
+
+        sessions = [connect()]
+        while len(sessions) < count:
+            try:
+                sessions.append(connect())
+            except Exception as e:
+                if verbose:
+                    utils.multi_print(f"{Fore.RED}\tCould not open another {cls.protocol} session: {Fore.RESET}{e}")
+                break
+        return sessions
+
+    def close(self):
+        """
+            Close every session.
+        """
+
+        for session in self.sessions:
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    def copy(self, directories, symlinks=False, no_image=frozenset(), recursive=True):
+        """
+            Walk and copy the given remote directories, yielding (path, metadata, stream) tuples as folders are listed
+            and files are transferred.
+
+            Parameters:
+                directories: Remote directories to start from.
+                symlinks: Follow symlinks to directories.
+                no_image: Remote paths to leave out.
+                recursive: Walk into the directories that are found.
+        """
+
+        self.options = (symlinks, set(no_image), recursive)
+        files = list(self.files)
+        self.files.clear()
+        engine = Acquisition()
+        engine.add(self, directories, files)
+        yield from engine.streams()
+
+    @staticmethod
+    def container_path(remote_path):
+        """
+            Get the path a remote file or folder is stored under in the container.
+        """
+
+        return remote_path.lstrip("/")
+
+    def walk(self, session, remote_dir):
+        """
+            List a remote directory with the options of the walk.
+        """
+
+        symlinks, no_image, recursive = self.options
+        folders, directories, files = [], [], []
+        self.list(session, remote_dir, folders, symlinks, no_image, recursive, directories, files)
+        return folders, directories, files
+
+    def open(self, session, item):
+        """
+            Get a file ready to copy, it is read once the imager takes it.
+        """
+
+        remote_path, fsmeta = item
+        if self.verbose:
+            utils.multi_print(f"{Fore.GREEN}\tCopying file: {Fore.RESET}{remote_path}")
+        return (self.container_path(remote_path), fsmeta,
+                lambda stream: self.read(session, remote_path, fsmeta.length, stream))
+
+    def list(self, session, remote_dir, folders, symlinks, no_image, recursive, directories, files):
+        """
+            List a remote directory, collecting its folders for the imager, the directories to walk next and the files
+            to copy.
+        """
+
+        raise NotImplementedError
+
+    def read(self, session, remote_path, size, stream):
+        """
+            Read a remote file into `stream`.
+        """
+
+        raise NotImplementedError
+
+    def report(self):
+        """
+            Print the throughput of each worker, if anything was copied.
+        """
+
+        if not any(stats["listings"] or stats["files"] for stats in self.stats):
+            return
+        utils.multi_print(f"{Fore.GREEN}[*] {self.protocol} throughput:")
+        for number, stats in enumerate(self.stats):
+            rate = stats["bytes"] / stats["seconds"] / 1048576 if stats["seconds"] else 0
+            utils.multi_print(f"{Fore.GREEN}\tWorker {number + 1}: {Fore.RESET}{stats['listings']} listings, "
+                              f"{stats['files']} files, {stats['bytes'] / 1048576:.2f} MB, {rate:.2f} MB/s, "
+                              f"{stats['errors']} errors")
+
+
+class Frontier:
+    """
+        The directories still to be listed and the files still to be fetched from one source.
+    """
+
+    def __init__(self, directories, files, queue_size):
+        """
+            Constructor for the Frontier class.
+
+            Parameters:
+                directories: Directories to list first.
+                files: Files to fetch.
+                queue_size: Number of files that can wait before directories stop being listed first.
+        """
+
+        self.directories = deque(directories)
+        self.files = deque(files)
+        self.queue_size = queue_size
+        self.listing = 0
+        self.stopped = False
+        self.condition = asyncio.Condition()
+
+    async def next_job(self):
+        """
+            Wait for the next directory to list or file to fetch. Directories are listed first so every worker has
+            something to do, unless enough files are already waiting. Returns None once the walk is done.
+        """
+
+        async with self.condition:
+            while True:
+                if self.stopped:
+                    return None
+                if self.directories and len(self.files) < self.queue_size:
+                    self.listing += 1
+                    return "list", self.directories.popleft()
+                if self.files:
+                    return "fetch", self.files.popleft()
+                if self.directories:
+                    self.listing += 1
+                    return "list", self.directories.popleft()
+                if not self.listing:
+                    # Nothing queued and nothing being listed that could queue more.
+                    self.condition.notify_all()
+                    return None
+                await self.condition.wait()
+
+    async def listed(self, directories, files):
+        """
+            Queue what a listing found.
+        """
+
+        async with self.condition:
+            self.listing -= 1
+            self.directories.extend(directories)
+            self.files.extend(files)
+            self.condition.notify_all()
+
+    async def stop(self):
+        async with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+class Acquisition:
+    """
+        This class is used to acquire one or more sources at once into a single imager. Every source is walked by its
+        own workers, limited to its pool of sessions, while an event loop schedules the blocking listings and
+        transfers on a thread pool for each source. Everything found goes through one bounded queue to the imager, so
+        a source that is faster than the container only gets as far ahead as that queue and its transfer buffers.
+    """
+
+    def __init__(self, sink_size=SINK_SIZE):
+        """
+            Constructor for the Acquisition class.
+
+            Parameters:
+                sink_size: Number of entries that can wait on the imager.
+        """
+
+        self.sink_size = sink_size
+        self.jobs = []
+        self.loop = None
+        self.sink = None
+        self.frontiers = []
+        self.ready = threading.Event()
+
+    def add(self, source, directories=(), files=(), prefix=""):
+        """
+            Add a source to acquire.
+
+            Parameters:
+                source: `Source` to walk and fetch.
+                directories: Directories to start walking from.
+                files: Files to fetch without a listing.
+                prefix: Folder in the container the source is stored under, so several sources can share one image.
+        """
+
+        self.jobs.append((source, list(directories), list(files), prefix.strip("/")))
+
+    def streams(self):
+        """
+            Acquire the sources, yielding (path, metadata, stream) tuples for `Imager.add_streams` as folders are
+            listed and files are fetched.
+        """
+
+        thread = threading.Thread(target=asyncio.run, args=(self.run(),), daemon=True)
+        thread.start()
+        self.ready.wait()
+        finished = False
+        try:
+            while True:
+                item = self.get()
+                if item is None:
+                    finished = True
+                    break
+                yield item
+        finally:
+            if not finished:
+                # Stop everything if the imager quit early, and close any transfers it didn't get to.
+                asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+                while True:
+                    item = self.get()
+                    if item is None:
+                        break
+                    if item[2] is not None and not callable(item[2]):
+                        item[2].close()
+            thread.join()
+
+    def get(self):
+        """
+            Take the next entry off the sink from the imager's thread. None means every source is done.
+        """
+
+        item = asyncio.run_coroutine_threadsafe(self.sink.get(), self.loop).result()
+        # The loop runs until the imager has taken everything, including the None.
+        self.loop.call_soon_threadsafe(self.sink.task_done)
+        return item
+
+    async def stop(self):
+        """
+            Stop the workers after the jobs they are on.
+        """
+
+        for frontier in self.frontiers:
+            await frontier.stop()
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.sink = asyncio.Queue(maxsize=self.sink_size)
+        self.frontiers = [Frontier(directories, files, source.queue_size)
+                          for source, directories, files, prefix in self.jobs]
+        self.ready.set()
+        try:
+            await asyncio.gather(*(self.acquire(job, frontier) for job, frontier in zip(self.jobs, self.frontiers)))
+        finally:
+            await self.sink.put(None)
+            await self.sink.join()
+
+    async def acquire(self, job, frontier):
+        """
+            Walk and fetch one source with its workers, which take turns on its sessions.
+        """
+
+        source, directories, files, prefix = job
+        if prefix:
+            await self.sink.put((prefix, imaging.create_metadata(prefix, 0, None), None))
+        with ThreadPoolExecutor(max_workers=source.workers) as executor:
+            await asyncio.gather(*(self.worker(source, frontier, executor, number,
+                                               source.sessions[number % len(source.sessions)], prefix)
+                                   for number in range(source.workers)))
+
+    async def worker(self, source, frontier, executor, number, session, prefix):
+        """
+            List directories and fetch files with one session until the walk is done.
+        """
+
+        stats = source.stats[number]
+        while True:
+            job = await frontier.next_job()
+            if job is None:
+                return
+            kind, item = job
+            if kind == "fetch":
+                await self.fetch(source, executor, session, item, stats, prefix)
+                continue
+            folders, directories, files = [], [], []
+            start_time = time.time()
+            try:
+                folders, directories, files = await self.loop.run_in_executor(executor, source.walk, session, item)
+                stats["listings"] += 1
+                # Sources that only learn a file's size when they fetch it (HTTP) list it without one.
+                run_metrics.count("listed", len(files), sum(getattr(file[1], "length", 0) or 0 for file in files),
+                                  time.time() - start_time)
+            except Exception as e:
+                utils.multi_print(f"{Fore.RED}[-] Error: Could not list: {Fore.RESET}{item} ({e})")
+                stats["errors"] += 1
+            finally:
+                await frontier.listed(directories, files)
+            for folder in folders:
+                await self.sink.put(self.prefixed(prefix, folder))
+
+    async def fetch(self, source, executor, session, item, stats, prefix):
+        """
+            Fetch one file. The transfer is handed to the imager as soon as it starts and the worker moves on once the
+            file has been fetched or buffered. A file the imager will skip as unchanged is handed over without starting
+            its transfer, which only runs if the imager opens it after all.
+        """
+
+        start_time = time.time()
+        try:
+            opened = await self.loop.run_in_executor(executor, source.open, session, item)
+        except Exception as e:
+            utils.multi_print(f"{Fore.RED}[-] Error: Could not open: {Fore.RESET}{item} ({e})")
+            opened = None
+        if opened is None:
+            stats["errors"] += 1
+            return
+        container_path, fsmeta, writer = opened
+        if source.unchanged is not None and source.unchanged(self.prefixed(prefix, opened)[0], fsmeta):
+            pipe = partial(imaging.StreamPipe, writer, max_chunks=source.buffer_chunks)
+            await self.sink.put(self.prefixed(prefix, (container_path, fsmeta, pipe)))
+            return
+        pipe = imaging.StreamPipe(writer, max_chunks=source.buffer_chunks)
+        transfer = asyncio.wrap_future(pipe.start(executor))
+        await self.sink.put(self.prefixed(prefix, (container_path, fsmeta, pipe)))
+        await transfer
+        stats["seconds"] += time.time() - start_time
+        if pipe.error is None:
+            stats["files"] += 1
+            stats["bytes"] += pipe.received
+        else:
+            stats["errors"] += 1
+
+    @staticmethod
+    def prefixed(prefix, item):
+        """
+            Move an entry under the folder its source is stored in.
+        """
+
+        if not prefix:
+            return item
+        container_path, fsmeta, stream = item
+        return posixpath.join(prefix, container_path), fsmeta, stream
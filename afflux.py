@@ -7,7 +7,11 @@ from sys import exit
 
 from colorama import init, deinit, Fore
 
+import afflux_batch
+import afflux_mount
+import compression
 import imaging
+import metrics
 from plugin_manager import PluginCollection
 
 init(autoreset=True)
@@ -39,6 +43,15 @@ def main():
                         help='directory to create any temporary files.')
     parser.add_argument('-A', "--append", action="store_true", default=False,
                         help='append to an existing AFF4 image specified with `-o`.')
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help='resume an interrupted acquisition into the AFF4 image specified with `-o`, skipping\n'
+                             'files its journal says were already added.')
+    parser.add_argument("--incremental", nargs=1, action="store", metavar='AFF4_IMAGE',
+                        help='only add files that are new or changed since AFF4_IMAGE, a previous image of the same\n'
+                             'device. Unchanged files are recorded as references to it.')
+    parser.add_argument("--dedup", action="store_true", default=False,
+                        help='store files whose contents are already in the container as references to the stored\n'
+                             'copy instead of writing them again.')
     parser.add_argument('-e', "--container_password", nargs=1, action="store", metavar='PASSWORD',
                         help='password to create an encrypted AFF4 container.')
     parser.add_argument('-o', "--output", nargs=1, action="store", metavar='OUTPUT_FILE',
@@ -47,10 +60,43 @@ def main():
                         help='overwrite AFF4 file if it already exists.')
     parser.add_argument('-m', "--meta", action="store", nargs=1, metavar='AFF4_IMAGE',
                         help='print the AFF4 image\'s metadata.', )
+    parser.add_argument("--mount", action="store", nargs=2, metavar=('AFF4_IMAGE', 'MOUNTPOINT'),
+                        help='mount an AFF4 image read-only on MOUNTPOINT to browse its files without extracting\n'
+                             'them. Needs fusepy and libfuse, macFUSE or WinFsp.')
+    parser.add_argument("--batch", action="store", nargs=1, metavar='MANIFEST',
+                        help='acquire several devices at once from a JSON manifest, each with its own plugin and\n'
+                             'arguments, into its own container in the manifest\'s case folder.')
     parser.add_argument('-p', "--plugin", action="store", nargs=1, metavar='PLUGIN_NAME',
                         help='specify a plugin to load, or use "list" to list all plugins.', )
     parser.add_argument("-z", "--zip", action="store_true", default=False,
                         help='write to a Zip container instead of AFF4.')
+    parser.add_argument("--workers", action="store", default=1, type=int, metavar='N',
+                        help='number of threads to read, hash and compress files with.')
+    parser.add_argument("--compression", action="store", default="auto", choices=compression.POLICIES,
+                        metavar='POLICY',
+                        help='codec to store files with: "auto" stores files that are already compressed, like\n'
+                             'photos and archives, as they are and uses lz4 for the rest, or one of "lz4", "snappy",\n'
+                             '"zlib" or "store" for every file. Default is "auto".')
+    parser.add_argument("--metrics", nargs=1, action="store", metavar='FILE',
+                        help='write the files and bytes counted through each stage of the run and their latency\n'
+                             'histograms to FILE as JSON.')
+    parser.add_argument("--jobs", action="store", default=1, type=int, metavar='N',
+                        help='number of threads to extract files with when using `-x`.')
+    parser.add_argument("--include", nargs="+", action="store", metavar='GLOB',
+                        help='with `-x`, only extract files whose path in the image matches one of the globs.')
+    parser.add_argument("--exclude", nargs="+", action="store", metavar='GLOB',
+                        help='with `-x`, skip files whose path in the image matches one of the globs.')
+    parser.add_argument("--hash", nargs="+", action="store", metavar='HASH',
+                        help='with `-x`, only extract files with one of these SHA1 or MD5 hashes.')
+    parser.add_argument("--min-size", action="store", type=int, metavar='BYTES',
+                        help='with `-x`, only extract files of at least this many bytes.')
+    parser.add_argument("--max-size", action="store", type=int, metavar='BYTES',
+                        help='with `-x`, only extract files of at most this many bytes.')
+    parser.add_argument("--modified-after", action="store", type=imaging.parse_time, metavar='TIME',
+                        help='with `-x`, only extract files modified after TIME, a date and time or an age such as\n'
+                             '"7d", "12h" or "30m".')
+    parser.add_argument("--modified-before", action="store", type=imaging.parse_time, metavar='TIME',
+                        help='with `-x`, only extract files modified before TIME.')
 
     # Temporarily set 'QT_STYLE_OVERRIDE' environment variable to suppress QT warnings on some systems.
     environ["QT_STYLE_OVERRIDE"] = ""
@@ -94,6 +140,34 @@ def main():
             print(f"{Fore.RED}[-] File not found: {Fore.RESET}{args.meta[0]}\n")
             exit()
 
+    # Mount a container as a read-only filesystem
+    if args.mount:
+        if path.exists(args.mount[0]):
+            print(f"{Fore.GREEN}[+] Loading image...")
+            afflux_mount.mount(args.mount[0], args.mount[1], args.container_password, args.verbose)
+            exit()
+        else:
+            print(f"{Fore.RED}[-] File not found: {Fore.RESET}{args.mount[0]}\n")
+            exit()
+
+    # Acquire every device in a batch manifest
+    if args.batch:
+        if path.exists(args.batch[0]):
+            start_time = datetime.now()
+            shared_arguments = ["--workers", str(args.workers), "--compression", args.compression]
+            if args.verbose:
+                shared_arguments.append("-v")
+            if args.dedup:
+                shared_arguments.append("--dedup")
+            if args.container_password:
+                shared_arguments += ["-e", args.container_password[0]]
+            result = afflux_batch.run_batch(args.batch[0], shared_arguments)
+            print(f"{Fore.GREEN}\n[*] Time: {Fore.RESET}{str(datetime.now() - start_time)}\n")
+            exit(0 if result else 1)
+        else:
+            print(f"{Fore.RED}[-] File not found: {Fore.RESET}{args.batch[0]}\n")
+            exit()
+
     # Print help if no -p switch is used.
     if args.plugin is None and args.extract is None:
         parser.print_help()
@@ -130,7 +204,7 @@ def main():
 
     # Check if the file already exists
     if args.output:
-        if not args.extract:
+        if not args.extract and not args.resume:
             if not args.append:
                 if not args.overwrite:
                     if path.exists(args.output[0]):
@@ -147,11 +221,15 @@ def main():
                     exit()
 
     start_time = datetime.now()
+    run_metrics = metrics.Metrics.get_instance()
+    run_metrics.reset()
+    result = None
     try:
-        # Cleanup anything if needed.
-        clean = imager.cleanup(specified_path=args.temp)
-        if not clean:
-            exit()
+        # Cleanup anything if needed. Leave everything alone when resuming a previous run.
+        if not args.resume:
+            clean = imager.cleanup(specified_path=args.temp)
+            if not clean:
+                exit()
 
         # Try and load the specified plugin.
         if args.plugin is not None:
@@ -161,7 +239,8 @@ def main():
                 if args.help:
                     plugin.parser.print_help()
                 else:
-                    plugin.run()
+                    with metrics.ProgressBar(run_metrics):
+                        result = plugin.run()
             else:
                 print(f"{Fore.RED}[-] Plugin not found.\n")
                 exit()
@@ -175,8 +254,20 @@ def main():
             if not args.output:
                 print(f"{Fore.RED}[-] Specify output directory with '-o'.\n")
                 exit()
-            imager.extract_all(args.extract[0], args.output[0], args.container_password)
+            imager.extract_all(args.extract[0], args.output[0], args.container_password, jobs=args.jobs,
+                               filters=imaging.ExtractFilter.from_arguments(args))
+        run_metrics.stop()
+        run_metrics.print_summary()
         print(f"{Fore.GREEN}\n[*] Time: {Fore.RESET}{str(datetime.now() - start_time)}\n")
+        if args.metrics and not args.help:
+            run_metrics.set_info(plugin=args.plugin[0] if args.plugin else "extract", output=args.output[0])
+            output = imager.zip_name(args.output[0]) if args.zip else args.output[0]
+            if not args.extract and path.isfile(output):
+                run_metrics.set_info(container_size=path.getsize(output))
+            run_metrics.write(args.metrics[0])
+        # Let a batch run know the acquisition failed.
+        if result is False:
+            exit(1)
 
     except KeyboardInterrupt:
         print(f"{Fore.GREEN}\n[*] Attempting to quit gracefully...")
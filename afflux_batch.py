@@ -0,0 +1,239 @@
+# Run several acquisitions at once from a job manifest, each in its own process and child container.
+
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from datetime import timedelta
+
+from colorama import reinit, Fore
+
+import utilities
+
+reinit()  # Colorama
+printUtils = utilities.Utilities.get_instance()
+
+# Seconds between progress summaries while jobs are running.
+STATUS_INTERVAL = 30
+
+
+class BatchJob:
+    """
+        One device in a batch, acquired by its own afflux process into its own container in the case folder.
+    """
+
+    def __init__(self, name, plugin, arguments, case_folder):
+        """
+            Constructor for BatchJob class.
+
+            Parameters:
+                name: Name of the device, used for its container, log and temporary folder.
+                plugin: Plugin to acquire the device with.
+                arguments: Plugin arguments, as they would be given on the command line.
+                case_folder: Folder the containers and logs are written to.
+        """
+
+        self.name = name
+        self.plugin = plugin
+        self.arguments = arguments
+        extension = ".zip" if "-z" in arguments or "--zip" in arguments else ".aff4"
+        self.output = os.path.join(case_folder, name + extension)
+        self.log_path = os.path.join(case_folder, name + ".log")
+        self.temp = os.path.join(case_folder, ".tmp", name)
+        self.process = None
+        self.log = None
+        self.started = None
+        self.finished = None
+        self.status = "waiting"
+
+    def command(self, shared_arguments):
+        """
+            Build the afflux command line for the job.
+        """
+
+        if getattr(sys, "frozen", False):
+            # The GUI build runs the jobs with the command line build next to it.
+            afflux = [os.path.join(os.path.dirname(sys.executable), "afflux.exe" if os.name == "nt" else "afflux")]
+        else:
+            afflux = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "afflux.py")]
+        return (afflux + ["-p", self.plugin] + self.arguments + shared_arguments
+                + ["-o", self.output, "-t", self.temp, "--overwrite"])
+
+    def start(self, shared_arguments, lines):
+        """
+            Start the job's process, and a thread that logs its output and passes each line to `lines`.
+        """
+
+        self.log = open(self.log_path, "w", encoding="utf-8")
+        env = dict(os.environ, PYTHONUNBUFFERED="1")
+        self.process = subprocess.Popen(self.command(shared_arguments), stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+                                        encoding="utf-8", errors="replace")
+        self.started = time.time()
+        self.status = "running"
+        threading.Thread(target=self.read_output, args=(lines,), daemon=True).start()
+
+    def read_output(self, lines):
+        for line in self.process.stdout:
+            line = printUtils.reaesc.sub("", line).rstrip()
+            self.log.write(line + "\n")
+            lines.put((self, line))
+        self.process.wait()
+        self.log.close()
+        lines.put((self, None))
+
+    def elapsed(self):
+        if self.started is None:
+            return timedelta()
+        return timedelta(seconds=int((self.finished or time.time()) - self.started))
+
+    def written(self):
+        """
+            Size of the job's container so far, in MB.
+        """
+
+        try:
+            return os.path.getsize(self.output) / 1048576
+        except OSError:
+            return 0.0
+
+
+def load_manifest(manifest_path):
+    """
+        Read a batch manifest, a JSON object with the case folder as "output", an optional "parallel" limit and a
+        "devices" list of objects with a "name", a "plugin" and its "arguments". Returns the case folder, the number of
+        jobs to run at once and the jobs, or None if the manifest can't be used.
+
+        Parameters:
+            manifest_path: Path of the manifest.
+    """
+
+    try:
+        with open(manifest_path, encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError) as e:
+        printUtils.multi_print(f"{Fore.RED}[-] Could not read manifest: {Fore.RESET}{e}")
+        return None
+
+    case_folder = manifest.get("output")
+    devices = manifest.get("devices")
+    if not case_folder or not isinstance(devices, list) or not devices:
+        printUtils.multi_print(f"{Fore.RED}[-] The manifest needs an \"output\" folder and a list of \"devices\".")
+        return None
+
+    jobs = []
+    names = set()
+    for number, device in enumerate(devices, 1):
+        name = str(device.get("name") or f"device_{number}")
+        arguments = device.get("arguments", [])
+        if isinstance(arguments, str):
+            arguments = arguments.split()
+        if not device.get("plugin"):
+            printUtils.multi_print(f"{Fore.RED}[-] No plugin given for device: {Fore.RESET}{name}")
+            return None
+        if name in names:
+            printUtils.multi_print(f"{Fore.RED}[-] Device name used more than once: {Fore.RESET}{name}")
+            return None
+        names.add(name)
+        jobs.append(BatchJob(name, device["plugin"], [str(argument) for argument in arguments], case_folder))
+
+    parallel = int(manifest.get("parallel") or min(len(jobs), os.cpu_count() or 1))
+    return case_folder, max(1, parallel), jobs
+
+
+def print_status(jobs):
+    """
+        Print where every job is at.
+    """
+
+    printUtils.multi_print(f"{Fore.GREEN}[*] Batch progress:")
+    for job in jobs:
+        color = Fore.RED if job.status == "failed" else Fore.GREEN
+        printUtils.multi_print(f"\t{color}{job.name}: {Fore.RESET}{job.status}, {job.elapsed()}, "
+                               f"{job.written():.2f} MB written")
+
+
+def stop_jobs(jobs):
+    """
+        Stop every job that is still running.
+    """
+
+    printUtils.multi_print(f"{Fore.RED}[-] Stopping the batch...")
+    for job in jobs:
+        if job.process is not None and job.process.poll() is None:
+            job.process.terminate()
+            job.status = "stopped"
+
+
+def run_batch(manifest_path, shared_arguments=None, stop=None, progress=None):
+    """
+        Acquire every device in a manifest, running up to its "parallel" limit at once. Each device gets its own afflux
+        process and its own container in the case folder, with the process's full output in a log next to it.
+        Returns True if every device was acquired.
+
+        Parameters:
+            manifest_path: Path of the manifest.
+            shared_arguments: Afflux arguments given to every job, such as `-v` or `-e PASSWORD`.
+            stop: `threading.Event` that stops the running jobs and the batch when it is set.
+            progress: Callable given the number of devices finished and the number in the batch as each one finishes.
+    """
+
+    loaded = load_manifest(manifest_path)
+    if loaded is None:
+        return False
+    case_folder, parallel, jobs = loaded
+    shared_arguments = shared_arguments or []
+    os.makedirs(case_folder, exist_ok=True)
+    printUtils.multi_print(f"{Fore.GREEN}[+] Acquiring {Fore.RESET}{len(jobs)}{Fore.GREEN} devices into "
+                           f"{Fore.RESET}{case_folder}{Fore.GREEN}, {Fore.RESET}{parallel}{Fore.GREEN} at a time.")
+
+    lines = queue.Queue()
+    waiting = list(jobs)
+    running = 0
+    last_status = time.time()
+    try:
+        while waiting or running:
+            if stop is not None and stop.is_set():
+                stop_jobs(jobs)
+                return False
+            while waiting and running < parallel:
+                job = waiting.pop(0)
+                printUtils.multi_print(f"{Fore.GREEN}[*] Starting {Fore.RESET}{job.name}{Fore.GREEN} with "
+                                       f"{Fore.RESET}{job.plugin}")
+                try:
+                    job.start(shared_arguments, lines)
+                    running += 1
+                except OSError as e:
+                    job.status = "failed"
+                    printUtils.multi_print(f"{Fore.RED}[-] Could not start {Fore.RESET}{job.name} ({e})")
+
+            try:
+                job, line = lines.get(timeout=1)
+            except queue.Empty:
+                job = line = None
+            if job is not None and line is None:
+                running -= 1
+                job.finished = time.time()
+                job.status = "done" if job.process.returncode == 0 and os.path.exists(job.output) else "failed"
+                color = Fore.GREEN if job.status == "done" else Fore.RED
+                printUtils.multi_print(f"{color}[{'+' if job.status == 'done' else '-'}] {job.name} {job.status} "
+                                       f"in {Fore.RESET}{job.elapsed()}{color}, see {Fore.RESET}{job.log_path}")
+                if progress is not None:
+                    progress(sum(entry.status not in ("waiting", "running") for entry in jobs), len(jobs))
+            elif line and line.lstrip().startswith(("[+]", "[-]")):
+                # Pass on what each job says about its connection and results, the details stay in its log.
+                printUtils.multi_print(f"{Fore.GREEN}[{job.name}] {Fore.RESET}{line.strip()}")
+
+            if time.time() - last_status >= STATUS_INTERVAL and running:
+                print_status(jobs)
+                last_status = time.time()
+
+    except KeyboardInterrupt:
+        stop_jobs(jobs)
+        raise
+
+    print_status(jobs)
+    return all(job.status == "done" for job in jobs)
@@ -0,0 +1,694 @@
+# Benchmark the plugins and extraction against synthetic devices served from local stand-ins.
+
+import argparse
+import functools
+import http.server
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from colorama import init, Fore
+
+import utilities
+
+init(autoreset=True)
+printUtils = utilities.Utilities.get_instance()
+
+AFFLUX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "afflux.py")
+
+# Shapes of the synthetic trees.
+SHAPES = ("tiny", "huge", "deep", "unicode")
+
+# Targets that can be benchmarked. Network plugins are served from the tree by a stand-in in this process, the AFC
+# plugin's engine and the ADB plugin are driven in a child process over a fake AFC service and a fake ADB device.
+# ios_ssh and usb_drive aren't targets, they image through the same engines as ssh and disk_image.
+TARGETS = ("disk_image", "http", "ftp", "ssh", "smb", "afc", "adb", "extract")
+
+# Names for the unicode shape, mixing scripts, combining characters and characters Windows doesn't allow.
+UNICODE_NAMES = ("\u0444\u0430\u0439\u043b", "\u6587\u4ef6", "\u0645\u0644\u0641",
+                 "\u03b1\u03c1\u03c7\u03b5\u03af\u03bf", "\u30d5\u30a1\u30a4\u30eb", "\ud30c\uc77c", "caf\u00e9",
+                 "cafe\u0301", "emoji_\U0001F4F1", "colon:name", "question?", "space name ")
+
+# Size of the writes used to fill fixture files.
+FILL_BLOCK = 1024 * 1024
+
+# Largest DATA packet the fake ADB device sends, the same as adbd.
+SYNC_DATA_MAX = 64 * 1024
+
+
+def fill(path_name, size):
+    """
+        Write `size` bytes of random data to a file.
+    """
+
+    with open(path_name, "wb") as fixture:
+        while size > 0:
+            block = min(size, FILL_BLOCK)
+            fixture.write(os.urandom(block))
+            size -= block
+
+
+def make_tree(root, shape, options):
+    """
+        Generate a synthetic tree of the given shape under `root`, unless it is already there. Returns the number of
+        files and bytes in it.
+
+        Parameters:
+            root: Folder to create the tree in.
+            shape: One of `SHAPES`.
+            options: Parsed benchmark arguments with the sizes of the shapes.
+    """
+
+    summary_path = root + ".json"
+    if os.path.exists(summary_path):
+        with open(summary_path, encoding="utf-8") as summary_file:
+            return json.load(summary_file)
+
+    os.makedirs(root)
+    files = 0
+    size = 0
+    if shape == "tiny":
+        for number in range(options.files):
+            folder = os.path.join(root, "d%04d" % (number // options.per_folder))
+            os.makedirs(folder, exist_ok=True)
+            fill(os.path.join(folder, "f%07d" % number), options.tiny_size)
+            files += 1
+            size += options.tiny_size
+    elif shape == "huge":
+        for number in range(options.huge_count):
+            fill(os.path.join(root, "huge%02d.bin" % number), options.huge_size * 1048576)
+            files += 1
+            size += options.huge_size * 1048576
+    elif shape == "deep":
+        folder = root
+        for level in range(options.depth):
+            folder = os.path.join(folder, "level%03d" % level)
+            os.makedirs(folder)
+            fill(os.path.join(folder, "file.txt"), options.tiny_size)
+            files += 1
+            size += options.tiny_size
+    elif shape == "unicode":
+        names = [name for name in UNICODE_NAMES if os.name != "nt" or not set(name) & set(':?')]
+        for number in range(options.files // 10 or 1):
+            folder = os.path.join(root, names[number % len(names)].strip() + "_%d" % (number // len(names)))
+            os.makedirs(folder, exist_ok=True)
+            name = names[(number * 7) % len(names)] + "_%d.dat" % number
+            fill(os.path.join(folder, name), random.randint(1, options.tiny_size * 8))
+            files += 1
+            size += os.path.getsize(os.path.join(folder, name))
+
+    summary = {"files": files, "bytes": size}
+    with open(summary_path, "w", encoding="utf-8") as summary_file:
+        json.dump(summary, summary_file)
+    return summary
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """
+        `http.server` handler serving a fixture tree without logging every request.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_http(root):
+    """
+        Serve a tree with `http.server`. Returns a callable that stops the server and the plugin arguments to image it.
+    """
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=root))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+
+    return stop, ["-l", f"http://127.0.0.1:{server.server_address[1]}/", "-r"]
+
+
+def serve_ftp(root):
+    """
+        Serve a tree with pyftpdlib, if it is installed. Returns a callable that stops the server and the plugin
+        arguments to image it.
+    """
+
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    # pyftpdlib logs every command at INFO, and sets that up itself unless its logger already has a handler.
+    logger = logging.getLogger("pyftpdlib")
+    logger.setLevel(logging.WARNING)
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user("afflux", "afflux", root, perm="elr")
+    handler = type("BenchmarkFTPHandler", (FTPHandler,), {"authorizer": authorizer})
+    server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, kwargs={"handle_exit": False}, daemon=True).start()
+    return server.close_all, ["-a", "127.0.0.1", "--port", str(server.address[1]), "-u", "afflux", "-P", "afflux",
+                              "-d", "/", "-r"]
+
+
+def serve_ssh(root):
+    """
+        Serve a tree over SFTP with a paramiko server on the loopback. Returns a callable that stops the server and the
+        plugin arguments to image it.
+    """
+
+    import paramiko
+    # The plugin closing its sessions is logged as a reset connection.
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+    class Server(paramiko.ServerInterface):
+        def check_auth_password(self, username, password):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def get_allowed_auths(self, username):
+            return "password"
+
+        def check_channel_request(self, kind, chanid):
+            return paramiko.OPEN_SUCCEEDED
+
+    class Handle(paramiko.SFTPHandle):
+        def stat(self):
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    class Sftp(paramiko.SFTPServerInterface):
+        def local_path(self, remote_path):
+            return os.path.join(root, self.canonicalize(remote_path).lstrip("/"))
+
+        def list_folder(self, remote_path):
+            folder = self.local_path(remote_path)
+            entries = []
+            for name in os.listdir(folder):
+                attributes = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(folder, name)))
+                attributes.filename = name
+                entries.append(attributes)
+            return entries
+
+        def stat(self, remote_path):
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local_path(remote_path)))
+
+        def lstat(self, remote_path):
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self.local_path(remote_path)))
+
+        def open(self, remote_path, flags, attr):
+            handle = Handle(flags)
+            handle.readfile = open(self.local_path(remote_path), "rb")
+            handle.filename = remote_path
+            return handle
+
+        def canonicalize(self, remote_path):
+            return os.path.normpath("/" + remote_path).replace("\\", "/").replace("//", "/")
+
+    key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(64)
+
+    def accept():
+        while True:
+            try:
+                client, _ = listener.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, Sftp)
+            transport.start_server(server=Server())
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.close, ["-a", "127.0.0.1", "--port", str(listener.getsockname()[1]), "-u", "afflux", "-P", "afflux",
+                      "-d", "/", "-r"]
+
+
+def serve_smb(root):
+    """
+        Serve a tree as an SMB share with impacket's SMB server, if it is installed. Returns a callable that stops the
+        server and the plugin arguments to image it.
+    """
+
+    from impacket import smbserver
+    from impacket.ntlm import compute_lmhash, compute_nthash
+    # impacket logs every connection and request at INFO.
+    logging.getLogger("impacket").setLevel(logging.WARNING)
+
+    server = smbserver.SimpleSMBServer(listenAddress="127.0.0.1", listenPort=0)
+    server.addShare("AFFLUX", root, "")
+    server.addCredential("afflux", 0, compute_lmhash("afflux"), compute_nthash("afflux"))
+    server.setSMB2Support(True)
+    threading.Thread(target=server.start, daemon=True).start()
+
+    def stop():
+        server.getServer().shutdown()
+        server.stop()
+
+    return stop, ["-a", "127.0.0.1", "--port", str(server.getServer().server_address[1]), "-S", "AFFLUX",
+                  "-u", "afflux", "-P", "afflux", "-r"]
+
+
+class FakeAfc:
+    """
+        Stand-in for a pymobiledevice3 `AfcService` that serves a local tree, with a delay on every round trip like a
+        device over USB.
+    """
+
+    def __init__(self, root, latency):
+        self.root = root
+        self.latency = latency
+        self.service = self
+        self.handles = {}
+        self.opened = 0
+        self.replies = []
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+
+    def local_path(self, remote_path):
+        return os.path.join(self.root, remote_path.lstrip("/"))
+
+    def listdir(self, remote_path):
+        time.sleep(self.latency)
+        return os.listdir(self.local_path(remote_path))
+
+    def stat(self, remote_path):
+        time.sleep(self.latency)
+        local_path = self.local_path(remote_path)
+        stat_result = os.lstat(local_path)
+        kind = "S_IFLNK" if os.path.islink(local_path) else "S_IFDIR" if os.path.isdir(local_path) else "S_IFREG"
+        modified = datetime.fromtimestamp(stat_result.st_mtime)
+        return {"st_ifmt": kind, "st_size": stat_result.st_size, "st_mtime": modified, "st_birthtime": modified}
+
+    def fopen(self, remote_path):
+        time.sleep(self.latency)
+        self.opened += 1
+        self.handles[self.opened] = open(self.local_path(remote_path), "rb")
+        return self.opened
+
+    def fclose(self, handle):
+        self.handles.pop(handle).close()
+
+    def _dispatch_packet(self, operation, data):
+        from pymobiledevice3.services.afc import afc_fread_req_t
+        request = afc_fread_req_t.parse(data)
+        self.replies.append(self.handles[request.handle].read(request.size))
+
+    def _receive_data(self):
+        from pymobiledevice3.services.afc import afc_error_t
+        time.sleep(self.latency)
+        return afc_error_t.SUCCESS, self.replies.pop(0)
+
+
+def run_fake_afc(root, output, metrics_path, connections, workers, latency):
+    """
+        Image a tree through the AFC plugin's engine over fake AFC connections. Run in a child process so it is
+        measured like the other plugins.
+    """
+
+    import imaging
+    import metrics
+    from plugins import apple_afc
+
+    run_metrics = metrics.Metrics.get_instance()
+    engine = apple_afc.AfcEngine([FakeAfc(root, latency) for _ in range(connections)])
+    imager = imaging.Imager(False, workers=workers)
+    try:
+        result = imager.add_streams(output, engine.copy(["/"]), False, None)
+    finally:
+        engine.close()
+    run_metrics.stop()
+    run_metrics.set_info(plugin="apple_afc", output=output, container_size=os.path.getsize(output))
+    run_metrics.write(metrics_path)
+    return engine.result and result
+
+
+class FakeAdbTransport:
+    """
+        Stand-in for an adb_shell USB transport that plays the device's side of the ADB and sync protocols over a local
+        tree, with a delay on every round trip like a device over USB. Streams are multiplexed over it like over a real
+        device, and each reply is only sent once the host has acknowledged the one before it.
+    """
+
+    def __init__(self, root, latency):
+        self.root = root
+        self.latency = latency
+        self.lock = threading.Condition()
+        self.received = bytearray()
+        # (time the packet arrives, packet) tuples waiting to be read by the host.
+        self.sent = []
+        self.streams = {}
+        self.last_id = 0
+
+    def connect(self, transport_timeout_s=None):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.received.clear()
+            self.sent.clear()
+            self.streams.clear()
+
+    def bulk_write(self, data, transport_timeout_s=None):
+        from adb_shell import constants
+        from adb_shell.adb_message import unpack
+        with self.lock:
+            self.received += data
+            while len(self.received) >= constants.MESSAGE_SIZE:
+                command, arg0, arg1, length, _ = unpack(bytes(self.received[:constants.MESSAGE_SIZE]))
+                if len(self.received) < constants.MESSAGE_SIZE + length:
+                    break
+                payload = bytes(self.received[constants.MESSAGE_SIZE:constants.MESSAGE_SIZE + length])
+                del self.received[:constants.MESSAGE_SIZE + length]
+                self.handle(constants.WIRE_TO_ID[command], arg0, arg1, payload)
+        return len(data)
+
+    def bulk_read(self, numbytes, transport_timeout_s=None):
+        # Like a USB read, wait for the device to send something rather than returning nothing straight away.
+        with self.lock:
+            if not self.lock.wait_for(lambda: self.sent, transport_timeout_s):
+                return b""
+            arrives, packet = self.sent[0]
+        time.sleep(max(0.0, arrives - time.time()))
+        with self.lock:
+            self.sent[0] = (arrives, packet[numbytes:])
+            if not self.sent[0][1]:
+                self.sent.pop(0)
+        return packet[:numbytes]
+
+    def send(self, command, arg0, arg1, data=b""):
+        from adb_shell.adb_message import AdbMessage
+        self.sent.append((time.time() + self.latency, AdbMessage(command, arg0, arg1, data).pack() + data))
+        self.lock.notify_all()
+
+    def handle(self, command, arg0, arg1, data):
+        """
+            Answer one message from the host.
+        """
+
+        from adb_shell import constants
+        if command == constants.CNXN:
+            self.send(constants.CNXN, constants.VERSION, constants.MAX_ADB_DATA, b"device::ro.product.name=afflux;\0")
+        elif command == constants.OPEN:
+            if data.rstrip(b"\0") != b"sync:":
+                self.send(constants.CLSE, 0, arg0)
+                return
+            self.last_id += 1
+            self.streams[self.last_id] = {"host": arg0, "requests": bytearray(), "replies": None}
+            self.send(constants.OKAY, self.last_id, arg0)
+        elif command == constants.WRTE:
+            stream = self.streams[arg1]
+            self.send(constants.OKAY, arg1, arg0)
+            stream["requests"] += data
+            self.sync_request(stream)
+            self.reply(arg1)
+        elif command == constants.OKAY:
+            if arg1 in self.streams:
+                self.reply(arg1)
+        elif command == constants.CLSE:
+            if self.streams.pop(arg1, None) is not None:
+                self.send(constants.CLSE, arg1, arg0)
+
+    def reply(self, stream_id):
+        """
+            Send a stream's next reply to the host, if it has one.
+        """
+
+        from adb_shell import constants
+        stream = self.streams[stream_id]
+        if stream["replies"] is not None:
+            data = next(stream["replies"], None)
+            if data is None:
+                stream["replies"] = None
+            else:
+                self.send(constants.WRTE, stream_id, stream["host"], data)
+
+    def sync_request(self, stream):
+        """
+            Start answering the sync request the host wrote to a stream, once all of it has arrived.
+        """
+
+        import struct
+        from adb_shell import constants
+        if len(stream["requests"]) < 8:
+            return
+        command, length = struct.unpack("<2I", stream["requests"][:8])
+        if len(stream["requests"]) < 8 + length:
+            return
+        remote_path = stream["requests"][8:8 + length].decode("utf-8")
+        del stream["requests"][:8 + length]
+        local_path = os.path.join(self.root, remote_path.lstrip("/"))
+        command = constants.FILESYNC_WIRE_TO_ID[command]
+        if command == constants.LIST:
+            stream["replies"] = self.list_replies(local_path)
+        elif command == constants.STAT:
+            stream["replies"] = self.stat_replies(local_path)
+        elif command == constants.RECV:
+            stream["replies"] = self.recv_replies(local_path)
+
+    @staticmethod
+    def list_replies(local_path):
+        import struct
+        from adb_shell import constants
+        entries = b""
+        for name in [".", ".."] + os.listdir(local_path):
+            stat_result = os.lstat(os.path.join(local_path, name))
+            encoded = name.encode("utf-8")
+            entries += struct.pack("<5I", constants.FILESYNC_ID_TO_WIRE[constants.DENT], stat_result.st_mode,
+                                   stat_result.st_size & 0xFFFFFFFF, int(stat_result.st_mtime), len(encoded)) + encoded
+        yield entries + struct.pack("<5I", constants.FILESYNC_ID_TO_WIRE[constants.DONE], 0, 0, 0, 0)
+
+    @staticmethod
+    def stat_replies(local_path):
+        import struct
+        from adb_shell import constants
+        try:
+            stat_result = os.stat(local_path)
+            mode, size, mtime = stat_result.st_mode, stat_result.st_size & 0xFFFFFFFF, int(stat_result.st_mtime)
+        except OSError:
+            mode = size = mtime = 0
+        yield struct.pack("<4I", constants.FILESYNC_ID_TO_WIRE[constants.STAT], mode, size, mtime)
+
+    @staticmethod
+    def recv_replies(local_path):
+        import struct
+        from adb_shell import constants
+        with open(local_path, "rb") as local_file:
+            while True:
+                data = local_file.read(SYNC_DATA_MAX)
+                if not data:
+                    break
+                yield struct.pack("<2I", constants.FILESYNC_ID_TO_WIRE[constants.DATA], len(data)) + data
+        yield struct.pack("<2I", constants.FILESYNC_ID_TO_WIRE[constants.DONE], 0)
+
+
+def run_fake_adb(root, output, metrics_path, connections, workers, latency):
+    """
+        Image a tree through the ADB plugin over a fake ADB device, which like a device over USB only has the one
+        connection to pull files over. Run in a child process so it is measured like the other plugins.
+    """
+
+    import imaging
+    import metrics
+    from adb_shell.adb_device import AdbDevice
+    from adb_shell.transport.base_transport import BaseTransport
+    from plugins import android_adb
+
+    BaseTransport.register(FakeAdbTransport)
+    run_metrics = metrics.Metrics.get_instance()
+    plugin = android_adb.AndroidImage()
+    plugin.arguments = argparse.Namespace(verbose=False)
+    plugin.device = AdbDevice(FakeAdbTransport(root, latency))
+    plugin.device.connect()
+    imager = imaging.Imager(False, workers=workers)
+    try:
+        result = imager.add_streams(output, plugin.acquire(["/"], False, [], connections=connections,
+                                                           skip=imager.committed, unchanged=imager.is_unchanged),
+                                    False, None)
+    finally:
+        plugin.device.close()
+    run_metrics.stop()
+    run_metrics.set_info(plugin="android_adb", output=output, container_size=os.path.getsize(output))
+    run_metrics.write(metrics_path)
+    return result
+
+
+def measure(command, cwd):
+    """
+        Run a command and wait for it. Returns its exit code, the seconds it took and its peak RSS in MB, or None where
+        the platform can't report it.
+    """
+
+    start_time = time.time()
+    process = subprocess.Popen(command, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start_time
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+        peak_rss = usage.ru_maxrss / (1048576 if sys.platform == "darwin" else 1024)
+        return process.returncode, seconds, round(peak_rss, 2)
+    process.wait()
+    return process.returncode, time.time() - start_time, None
+
+
+def run_target(target, shape, tree, summary, work, options):
+    """
+        Benchmark one target on one tree. Returns its result, or None if the target can't run here.
+    """
+
+    output = os.path.join(work, f"{target}_{shape}.aff4")
+    metrics_path = os.path.join(work, f"{target}_{shape}.metrics.json")
+    for stale in (output, output + ".journal", metrics_path):
+        if os.path.exists(stale):
+            os.remove(stale)
+    common = ["-o", output, "--overwrite", "--workers", str(options.workers), "--metrics", metrics_path]
+    stop = None
+    try:
+        if target == "disk_image":
+            command = [sys.executable, AFFLUX, "-p", "disk_image", "-f", tree, "-r"] + common
+        elif target == "http":
+            stop, arguments = serve_http(tree)
+            command = [sys.executable, AFFLUX, "-p", "generic_http"] + arguments + common
+        elif target == "ftp":
+            stop, arguments = serve_ftp(tree)
+            command = [sys.executable, AFFLUX, "-p", "generic_ftp"] + arguments + common
+        elif target == "ssh":
+            stop, arguments = serve_ssh(tree)
+            command = [sys.executable, AFFLUX, "-p", "generic_ssh"] + arguments + common
+        elif target == "smb":
+            stop, arguments = serve_smb(tree)
+            command = [sys.executable, AFFLUX, "-p", "generic_smb"] + arguments + common
+        elif target in ("afc", "adb"):
+            command = [sys.executable, os.path.abspath(__file__), f"--fake-{target}", tree, output, metrics_path,
+                       str(options.connections), str(options.workers), str(options.latency)]
+        else:
+            # Extract the disk_image container of the same tree, acquiring it first if it wasn't benchmarked.
+            container = os.path.join(work, f"disk_image_{shape}.aff4")
+            if not os.path.exists(container):
+                measure([sys.executable, AFFLUX, "-p", "disk_image", "-f", tree, "-r", "-o", container,
+                         "--overwrite", "--workers", str(options.workers)], work)
+            destination = os.path.join(work, f"extract_{shape}")
+            shutil.rmtree(destination, ignore_errors=True)
+            output = container
+            command = [sys.executable, AFFLUX, "-x", container, "-o", destination, "--jobs", str(options.workers),
+                       "--metrics", metrics_path]
+    except ImportError as e:
+        printUtils.multi_print(f"{Fore.RED}[-] Skipping {target}: {Fore.RESET}{e}")
+        return None
+
+    try:
+        returncode, seconds, peak_rss = measure(command, work)
+    finally:
+        if stop is not None:
+            stop()
+
+    stages = {}
+    if os.path.exists(metrics_path):
+        with open(metrics_path, encoding="utf-8") as metrics_file:
+            stages = json.load(metrics_file).get("stages", {})
+    written = stages.get("written", {})
+    return {
+        "target": target,
+        "shape": shape,
+        "returncode": returncode,
+        "files": summary["files"],
+        "bytes": summary["bytes"],
+        "files_written": written.get("files"),
+        "bytes_written": written.get("bytes"),
+        "seconds": round(seconds, 3),
+        "files_per_second": round(summary["files"] / seconds, 2) if seconds else 0.0,
+        "mb_per_second": round(summary["bytes"] / seconds / 1048576, 2) if seconds else 0.0,
+        "peak_rss_mb": peak_rss,
+        "container_size": os.path.getsize(output) if os.path.exists(output) else None,
+        "stages": stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f"{Fore.GREEN}Afflux benchmark.{Fore.RESET}",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES),
+                        help='synthetic trees to generate.')
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=list(TARGETS),
+                        help='plugins to benchmark, and extraction of the disk_image container.')
+    parser.add_argument("--files", action="store", type=int, default=10000, metavar='N',
+                        help='number of files in the tiny shape, a tenth as many in the unicode shape.')
+    parser.add_argument("--per-folder", action="store", type=int, default=1000, metavar='N',
+                        help='files per folder in the tiny shape.')
+    parser.add_argument("--tiny-size", action="store", type=int, default=512, metavar='BYTES',
+                        help='size of the files in the tiny and deep shapes.')
+    parser.add_argument("--huge-count", action="store", type=int, default=2, metavar='N',
+                        help='number of files in the huge shape.')
+    parser.add_argument("--huge-size", action="store", type=int, default=256, metavar='MB',
+                        help='size of the files in the huge shape.')
+    parser.add_argument("--depth", action="store", type=int, default=64, metavar='N',
+                        help='number of nested folders in the deep shape.')
+    parser.add_argument("--workers", action="store", type=int, default=4, metavar='N',
+                        help='number of imager workers and extraction jobs.')
+    parser.add_argument("--connections", action="store", type=int, default=4, metavar='N',
+                        help='number of fake AFC connections.')
+    parser.add_argument("--latency", action="store", type=float, default=0.001, metavar='SECONDS',
+                        help='delay of each fake AFC and ADB round trip.')
+    parser.add_argument("--work", action="store", metavar='PATH',
+                        help='folder for the trees and containers, kept between runs so the trees are reused.\n'
+                             'A temporary folder is used by default.')
+    parser.add_argument('-o', "--output", action="store", default="benchmark.json", metavar='OUTPUT_FILE',
+                        help='JSON file to write the results to.')
+    parser.add_argument("--fake-afc", nargs=6, help=argparse.SUPPRESS)
+    parser.add_argument("--fake-adb", nargs=6, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.fake_afc:
+        root, output, metrics_path, connections, workers, latency = args.fake_afc
+        sys.exit(0 if run_fake_afc(root, output, metrics_path, int(connections), int(workers), float(latency))
+                 else 1)
+    if args.fake_adb:
+        root, output, metrics_path, connections, workers, latency = args.fake_adb
+        sys.exit(0 if run_fake_adb(root, output, metrics_path, int(connections), int(workers), float(latency))
+                 else 1)
+
+    work = os.path.abspath(args.work) if args.work else tempfile.mkdtemp(prefix="afflux_benchmark_")
+    os.makedirs(work, exist_ok=True)
+    results = []
+    for shape in args.shapes:
+        tree = os.path.join(work, "tree_" + shape)
+        printUtils.multi_print(f"{Fore.GREEN}[*] Generating {Fore.RESET}{shape}{Fore.GREEN} tree...")
+        summary = make_tree(tree, shape, args)
+        for target in args.targets:
+            printUtils.multi_print(f"{Fore.GREEN}[*] Benchmarking {Fore.RESET}{target}{Fore.GREEN} on "
+                                   f"{Fore.RESET}{shape}{Fore.GREEN}...")
+            result = run_target(target, shape, tree, summary, work, args)
+            if result is None:
+                continue
+            results.append(result)
+            color = Fore.GREEN if result["returncode"] == 0 else Fore.RED
+            printUtils.multi_print(f"\t{color}{target}/{shape}: {Fore.RESET}{result['files_per_second']} files/s, "
+                                   f"{result['mb_per_second']} MB/s, {result['seconds']} s, peak RSS "
+                                   f"{result['peak_rss_mb']} MB")
+
+    with open(args.output, "w", encoding="utf-8") as output_file:
+        json.dump({"started": datetime.now().isoformat(timespec="seconds"), "python": sys.version.split()[0],
+                   "platform": sys.platform, "options": {key: value for key, value in vars(args).items()
+                                                         if key not in ("fake_afc", "fake_adb", "output")},
+                   "results": results}, output_file, indent=2)
+    printUtils.multi_print(f"{Fore.GREEN}[+] Results written to: {Fore.RESET}{args.output}")
+    if not args.work:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -27,7 +27,7 @@ environ["QT_STYLE_OVERRIDE"] = ""
 import imaging
 from plugin_manager import PluginCollection
 from gui.afflux_gui_threads import (ImageFolderThread, SSHImageThread, iOSAFCImageThread, AndroidImageThread,
-                                    FTPImageThread, SMBImageThread, plugin_names)
+                                    FTPImageThread, SMBImageThread, BatchThread, plugin_names)
 from gui import afflux_gui_ui
 from gui import breeze_resources
 
@@ -66,6 +66,18 @@ class AffluxGui:
         else:
             self.ui.outputTextBrowser.append(output)
 
+    def update_progress(self, percent, text):
+        """
+            Show the progress of the imaging thread. The bar is busy until the thread knows how much there is to add.
+        """
+
+        if percent < 0:
+            self.ui.progressBar.setRange(0, 0)
+        else:
+            self.ui.progressBar.setRange(0, 100)
+            self.ui.progressBar.setValue(percent)
+        self.ui.progressLabel.setText(text)
+
     def warning_box(self, text, details):
         """
             Create a warning alert box.
@@ -113,7 +125,17 @@ class AffluxGui:
         """
             A finished imaging alert box.
         """
+        # Stop the busy indicator of a run that never knew its total.
+        if self.ui.progressBar.maximum() == 0:
+            self.ui.progressBar.setRange(0, 100)
         try:
+            if isinstance(self.image_thread, BatchThread):
+                if self.image_thread.result:
+                    self.information_box("Batch completed!", "Every device has been acquired into the case folder.")
+                    self.ui.outputTextBrowser.append("[+] Finished batch!")
+                else:
+                    self.warning_box("Batch failed!", "A device was not acquired, see its log in the case folder.")
+                return
             # Check the return value from the imaging
             if self.image_thread.result:
                 if self.ui.zipImageCheckBox.isChecked():
@@ -218,11 +240,14 @@ class AffluxGui:
                                                   output_file,
                                                   self.encryption,
                                                   self.ui.filesystemFollowSymlinksCheckbox.isChecked(),
-                                                  self.ui.zipImageCheckBox.isChecked())
+                                                  self.ui.zipImageCheckBox.isChecked(),
+                                                  workers=self.ui.workersSpinBox.value(),
+                                                  compression=self.ui.compressionComboBox.currentText())
             # Pass the thread through so we can emit a signal back to us with text to output
             utils.set_text_worker(self.image_thread)
             self.image_thread.start()
             self.image_thread.signal.connect(self.output_text)
+            self.image_thread.progress.connect(self.update_progress)
             self.image_thread.finished.connect(self.finished_imaging)
         elif self.ui.filesystemPathLineEdit.text() != "":
             if not self.files_image_filenames:
@@ -233,10 +258,13 @@ class AffluxGui:
                                                       output_file,
                                                       self.encryption,
                                                       self.ui.filesystemFollowSymlinksCheckbox.isChecked(),
-                                                      self.ui.zipImageCheckBox.isChecked())
+                                                      self.ui.zipImageCheckBox.isChecked(),
+                                                      workers=self.ui.workersSpinBox.value(),
+                                                      compression=self.ui.compressionComboBox.currentText())
                 utils.set_text_worker(self.image_thread)
                 self.image_thread.start()
                 self.image_thread.signal.connect(self.output_text)
+                self.image_thread.progress.connect(self.update_progress)
                 self.image_thread.finished.connect(self.finished_imaging)
         else:
             pass
@@ -301,11 +329,14 @@ class AffluxGui:
                                                    self.ui.androidFollowSymlinksCheckbox.isChecked(),
                                                    self.ui.androidRootCheckbox.isChecked(),
                                                    self.ui.zipImageCheckBox.isChecked(),
-                                                   keygen=self.ui.androidKeygenCheckbox.isChecked())
+                                                   keygen=self.ui.androidKeygenCheckbox.isChecked(),
+                                                   workers=self.ui.workersSpinBox.value(),
+                                                   compression=self.ui.compressionComboBox.currentText())
             # Pass the thread through so we can emit a signal back to us with text to output
             utils.set_text_worker(self.image_thread)
             self.image_thread.start()
             self.image_thread.signal.connect(self.output_text)
+            self.image_thread.progress.connect(self.update_progress)
             self.image_thread.finished.connect(self.finished_imaging)
 
     def try_image_ios(self):
@@ -334,11 +365,14 @@ class AffluxGui:
                                               int(self.ui.iosDeviceComboBox.currentIndex()),
                                               self.ui.iosClearPairsCheckbox.isChecked(),
                                               self.ui.iosRePairCheckbox.isChecked(),
-                                              self.ui.zipImageCheckBox.isChecked())
+                                              self.ui.zipImageCheckBox.isChecked(),
+                                              workers=self.ui.workersSpinBox.value(),
+                                              compression=self.ui.compressionComboBox.currentText())
         # Pass the thread through so we can emit a signal back to us with text to output
         utils.set_text_worker(self.image_thread)
         self.image_thread.start()
         self.image_thread.signal.connect(self.output_text)
+        self.image_thread.progress.connect(self.update_progress)
         self.image_thread.finished.connect(self.finished_imaging)
 
     def try_image_drive(self):
@@ -361,11 +395,14 @@ class AffluxGui:
                                                   output_file,
                                                   self.encryption,
                                                   self.ui.drivesFollowSymlinksCheckbox.isChecked(),
-                                                  self.ui.zipImageCheckBox.isChecked())
+                                                  self.ui.zipImageCheckBox.isChecked(),
+                                                  workers=self.ui.workersSpinBox.value(),
+                                                  compression=self.ui.compressionComboBox.currentText())
             # Pass the thread through so we can emit a signal back to us with text to output
             utils.set_text_worker(self.image_thread)
             self.image_thread.start()
             self.image_thread.signal.connect(self.output_text)
+            self.image_thread.progress.connect(self.update_progress)
             self.image_thread.finished.connect(self.finished_imaging)
 
     def try_image_ssh(self):
@@ -386,11 +423,14 @@ class AffluxGui:
                                                int(self.ui.sshPortLineEdit.text()),
                                                self.ui.sshFollowSymlinksCheckbox.isChecked(),
                                                self.ui.sshRecursiveCheckbox.isChecked(),
-                                               self.ui.zipImageCheckBox.isChecked())
+                                               self.ui.zipImageCheckBox.isChecked(),
+                                               workers=self.ui.workersSpinBox.value(),
+                                               compression=self.ui.compressionComboBox.currentText())
             # Pass the thread through so we can emit a signal back to us with text to output
             utils.set_text_worker(self.image_thread)
             self.image_thread.start()
             self.image_thread.signal.connect(self.output_text)
+            self.image_thread.progress.connect(self.update_progress)
             self.image_thread.finished.connect(self.finished_imaging)
         else:
             self.warning_box("Error", "No hostname or IP specified.")
@@ -413,11 +453,14 @@ class AffluxGui:
                                                int(self.ui.ftpPortLineEdit.text()),
                                                self.ui.ftpFollowSymlinksCheckbox.isChecked(),
                                                self.ui.ftpRecursiveCheckbox.isChecked(),
-                                               self.ui.zipImageCheckBox.isChecked())
+                                               self.ui.zipImageCheckBox.isChecked(),
+                                               workers=self.ui.workersSpinBox.value(),
+                                               compression=self.ui.compressionComboBox.currentText())
             # Pass the thread through so we can emit a signal back to us with text to output
             utils.set_text_worker(self.image_thread)
             self.image_thread.start()
             self.image_thread.signal.connect(self.output_text)
+            self.image_thread.progress.connect(self.update_progress)
             self.image_thread.finished.connect(self.finished_imaging)
         else:
             self.warning_box("Error", "No hostname or IP specified.")
@@ -441,11 +484,14 @@ class AffluxGui:
                                                    int(self.ui.smbPortLineEdit.text()),
                                                    self.ui.smbFollowSymlinksCheckbox.isChecked(),
                                                    self.ui.smbRecursiveCheckbox.isChecked(),
-                                                   self.ui.zipImageCheckBox.isChecked())
+                                                   self.ui.zipImageCheckBox.isChecked(),
+                                                   workers=self.ui.workersSpinBox.value(),
+                                                   compression=self.ui.compressionComboBox.currentText())
                 # Pass the thread through so we can emit a signal back to us with text to output
                 utils.set_text_worker(self.image_thread)
                 self.image_thread.start()
                 self.image_thread.signal.connect(self.output_text)
+                self.image_thread.progress.connect(self.update_progress)
                 self.image_thread.finished.connect(self.finished_imaging)
             else:
                 self.warning_box("Error", "No share specified.")
@@ -498,11 +544,44 @@ class AffluxGui:
 
         return True
 
+    def batch_button_clicked(self):
+        """
+            Handler for the 'Batch' button being clicked, acquires every device in a manifest at once.
+        """
+
+        if getattr(self, "image_thread", None) is not None and self.image_thread.isRunning():
+            self.warning_box("Error:", "Wait for the current acquisition to finish.")
+            return False
+
+        manifest = QtWidgets.QFileDialog.getOpenFileName(self.ui.centralwidget, 'Open Batch Manifest', '',
+                                                         'JSON (*.json)')[0]
+        if not manifest:
+            return False
+
+        shared_arguments = ["--workers", str(self.ui.workersSpinBox.value()),
+                            "--compression", self.ui.compressionComboBox.currentText()]
+        if self.ui.verboseCheckBox.isChecked():
+            shared_arguments.append("-v")
+        encryption = self.check_encryption()
+        if encryption:
+            shared_arguments += ["-e", encryption[0]]
+        self.image_thread = BatchThread(manifest, shared_arguments)
+        utils.set_text_worker(self.image_thread)
+        self.image_thread.start()
+        self.image_thread.signal.connect(self.output_text)
+        self.image_thread.progress.connect(self.update_progress)
+        self.image_thread.finished.connect(self.finished_imaging)
+        return True
+
     def kill_threads(self):
         """
             Kill any running threads and cleanup.
         """
 
+        if isinstance(getattr(self, "image_thread", None), BatchThread):
+            # The devices are acquired by their own processes, which are stopped with the batch.
+            self.image_thread.stop()
+            return
         try:
             self.image_thread.terminate()
             imager.cleanup()
@@ -515,6 +594,7 @@ class AffluxGui:
         """
 
         self.ui.imagePushButton.clicked.connect(self.image_button_clicked)
+        self.ui.batchButton.clicked.connect(self.batch_button_clicked)
         self.ui.cancelButton.clicked.connect(self.kill_threads)
         self.ui.filesystemFilesButton.clicked.connect(self.image_files_clicked)
         self.ui.filesystemFoldersButton.clicked.connect(self.image_folders_clicked)
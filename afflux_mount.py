@@ -0,0 +1,252 @@
+# Read-only FUSE filesystem over an AFF4 logical image, so files can be looked at without extracting the image.
+
+import errno
+import os
+import posixpath
+import threading
+import time
+from collections import OrderedDict
+from stat import S_IFDIR, S_IFREG
+
+from colorama import reinit, Fore
+from pyaff4 import rdfvalue
+
+import imaging
+import utilities
+
+reinit()  # Colorama
+printUtils = utilities.Utilities.get_instance()
+
+# Size of the blocks file reads are served from, and how many of them are kept in memory.
+BLOCK_SIZE = 1024 * 1024
+CACHE_BLOCKS = 64
+
+
+def mount_path(path_name):
+    """
+        Turn a path stored in an image into an absolute POSIX path under the mount point. Windows drive letters are
+        dropped the same way extraction drops them.
+    """
+
+    path_name = path_name.replace("\\", "/")
+    if path_name[1:3] == ":/":
+        path_name = path_name[2:]
+    return posixpath.normpath("/" + path_name.lstrip("/"))
+
+
+def to_timestamp(value, default):
+    """
+        Turn a stored timestamp into POSIX time for `getattr`.
+    """
+
+    parsed = imaging.parse_datetime(value)
+    return parsed.timestamp() if parsed is not None else default
+
+
+class Node:
+    """
+        A folder or file in the mounted image.
+    """
+
+    def __init__(self, is_folder, size=0, stream=None, timestamps=None):
+        """
+            Constructor for Node class.
+
+            Parameters:
+                is_folder: The node is a folder.
+                size: Size of the file in bytes.
+                stream: URN of the stream holding the file's contents.
+                timestamps: Modified, accessed and changed times as POSIX timestamps.
+        """
+
+        self.is_folder = is_folder
+        self.size = size or 0
+        self.stream = stream
+        self.timestamps = timestamps
+        self.children = set()
+
+
+class AFF4Filesystem:
+    """
+        fusepy operations for a read-only view of an AFF4 logical image. The directory tree is built once from the
+        image's index, or its metadata if it doesn't have one, and file contents are read from the image's streams
+        in blocks as they are asked for, with the most recently used blocks cached.
+
+        Operations are dispatched by calling the object with the operation's name, which is how fusepy calls it, so
+        it can also be driven directly without a kernel FUSE layer.
+    """
+
+    def __init__(self, volume, cache_blocks=CACHE_BLOCKS):
+        """
+            Constructor for AFF4Filesystem class.
+
+            Parameters:
+                volume: Volume to serve files from.
+                cache_blocks: Number of blocks to keep in memory.
+        """
+
+        self.volume = volume
+        self.resolver = volume.resolver
+        self.cache_blocks = cache_blocks
+        self.cache = OrderedDict()
+        # pyaff4 streams and their resolver can't be used from several threads at once.
+        self.lock = threading.Lock()
+        self.mounted = time.time()
+        self.uid = os.getuid() if hasattr(os, "getuid") else 0
+        self.gid = os.getgid() if hasattr(os, "getgid") else 0
+        self.handles = 0
+        self.nodes = {"/": Node(True, timestamps=(self.mounted,) * 3)}
+        self.load()
+
+    def load(self):
+        """
+            Build the directory tree from the volume.
+        """
+
+        index = imaging.ContainerIndex.load(self.volume)
+        try:
+            for row in imaging.ContainerIndex.rows(self.volume, index, "folder", "file", "duplicate"):
+                if row["path"] is None or (row["kind"] == "duplicate" and row["stream"] is None):
+                    continue
+                timestamps = tuple(to_timestamp(row[column], self.mounted)
+                                   for column in ("last_written", "last_accessed", "record_changed"))
+                if row["kind"] == "folder":
+                    node = Node(True, timestamps=timestamps)
+                else:
+                    node = Node(False, row["size"], row["stream"] or row["urn"], timestamps)
+                self.add(mount_path(row["path"]), node)
+        finally:
+            if index is not None:
+                index.close()
+
+    def add(self, path, node):
+        """
+            Add a node to the tree, creating any of its parent folders the image doesn't record.
+        """
+
+        existing = self.nodes.get(path)
+        if existing is not None:
+            # A folder the tree already has, or a file stored again by an append.
+            if existing.is_folder == node.is_folder:
+                node.children = existing.children
+                self.nodes[path] = node
+            return
+        self.nodes[path] = node
+        parent, name = posixpath.split(path)
+        if parent not in self.nodes:
+            self.add(parent, Node(True, timestamps=(self.mounted,) * 3))
+        self.nodes[parent].children.add(name)
+
+    def __call__(self, op, *args):
+        method = getattr(self, op, None)
+        if method is None:
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+        return method(*args)
+
+    def node(self, path):
+        node = self.nodes.get(path)
+        if node is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return node
+
+    def getattr(self, path, fh=None):
+        node = self.node(path)
+        modified, accessed, changed = node.timestamps
+        attributes = {"st_uid": self.uid, "st_gid": self.gid, "st_mtime": modified, "st_atime": accessed,
+                      "st_ctime": changed}
+        if node.is_folder:
+            attributes.update(st_mode=S_IFDIR | 0o555, st_nlink=2 + len(node.children), st_size=0)
+        else:
+            attributes.update(st_mode=S_IFREG | 0o444, st_nlink=1, st_size=node.size)
+        return attributes
+
+    def readdir(self, path, fh):
+        node = self.node(path)
+        if not node.is_folder:
+            raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        return [".", ".."] + sorted(node.children)
+
+    def access(self, path, amode):
+        self.node(path)
+        if amode & os.W_OK:
+            raise OSError(errno.EROFS, os.strerror(errno.EROFS), path)
+        return 0
+
+    def open(self, path, flags):
+        node = self.node(path)
+        if node.is_folder:
+            raise OSError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+        if flags & (os.O_WRONLY | os.O_RDWR | os.O_APPEND | os.O_TRUNC):
+            raise OSError(errno.EROFS, os.strerror(errno.EROFS), path)
+        with self.lock:
+            self.handles += 1
+            return self.handles
+
+    def read(self, path, size, offset, fh):
+        node = self.node(path)
+        end = min(offset + size, node.size)
+        if offset >= end:
+            return b""
+        data = bytearray()
+        for block in range(offset // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1):
+            data += self.block(node.stream, block)
+        start = offset - (offset // BLOCK_SIZE) * BLOCK_SIZE
+        return bytes(data[start:start + end - offset])
+
+    def block(self, stream_urn, block):
+        """
+            Read a block of a stream, from the cache if it was read recently.
+        """
+
+        key = (stream_urn, block)
+        with self.lock:
+            data = self.cache.get(key)
+            if data is not None:
+                self.cache.move_to_end(key)
+                return data
+            with imaging.open_stream(self.resolver, rdfvalue.URN(stream_urn)) as stream:
+                stream.seek(block * BLOCK_SIZE)
+                data = stream.read(BLOCK_SIZE)
+            self.cache[key] = data
+            if len(self.cache) > self.cache_blocks:
+                self.cache.popitem(last=False)
+            return data
+
+    def release(self, path, fh):
+        return 0
+
+    def statfs(self, path):
+        return {"f_bsize": BLOCK_SIZE, "f_frsize": BLOCK_SIZE, "f_namemax": 255}
+
+
+def mount(container_name, mountpoint, password=None, verbose=False):
+    """
+        Mount an AFF4 logical image read-only at a mount point, until it is unmounted or interrupted. Returns False if
+        it couldn't be mounted.
+
+        Parameters:
+            container_name: Path of the image.
+            mountpoint: Empty folder to mount the image on.
+            password:
+            verbose:
+    """
+
+    try:
+        from fuse import FUSE
+    except (ImportError, OSError) as e:
+        printUtils.multi_print(Fore.RED + "[-] Mounting needs fusepy and a FUSE library (libfuse, macFUSE or WinFsp): "
+                               + Fore.RESET + "%s" % e)
+        return False
+    if not os.path.isdir(mountpoint):
+        printUtils.multi_print(Fore.RED + "[-] Mount point is not a directory: " + Fore.RESET + mountpoint)
+        return False
+
+    imager = imaging.Imager(verbose)
+    with imager.open_reader(rdfvalue.URN.FromFileName(container_name), password) as volume:
+        filesystem = AFF4Filesystem(volume)
+        printUtils.multi_print(Fore.GREEN + "[*] Mounted " + Fore.RESET + container_name + Fore.GREEN + " on "
+                               + Fore.RESET + mountpoint + Fore.GREEN + ", " + Fore.RESET
+                               + str(len(filesystem.nodes) - 1) + Fore.GREEN
+                               + " files and folders. Unmount it or press Ctrl+C to stop.")
+        FUSE(filesystem, mountpoint, foreground=True, ro=True, fsname="afflux")
+    return True
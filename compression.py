@@ -0,0 +1,85 @@
+# Compression policy: picks the codec each file is stored with, so files that are already compressed aren't compressed
+# again.
+
+import os
+
+import lz4.block
+
+# Policies for `--compression`. "auto" stores files that are already compressed and uses `FAST_CODEC` for the rest,
+# the others use the same codec for every file.
+POLICIES = ("auto", "lz4", "snappy", "zlib", "store")
+FAST_CODEC = "lz4"
+
+# Bytes at the start of a file "auto" looks at.
+SAMPLE_SIZE = 64 * 1024
+
+# A sample smaller than this says too little about the rest of the file to skip compressing it.
+MIN_SAMPLE_SIZE = 4096
+
+# A sample lz4 can't shrink below this fraction of its size is treated as already compressed.
+INCOMPRESSIBLE_RATIO = 0.9
+
+# Extensions of formats that are compressed already: photos, video, audio, archives and packages.
+COMPRESSED_EXTENSIONS = frozenset((
+    "jpg", "jpeg", "png", "gif", "webp", "heic", "heif", "avif",
+    "mp4", "m4v", "mov", "3gp", "mkv", "webm",
+    "mp3", "m4a", "aac", "ogg", "opus", "flac",
+    "zip", "apk", "aab", "jar", "ipa", "obb", "docx", "xlsx", "pptx", "odt", "ods", "epub",
+    "gz", "tgz", "bz2", "xz", "7z", "rar", "zst", "lz4", "br", "cab", "dmg",
+))
+
+# (offset, magic number) of the same kinds of formats, for files without a telling extension.
+COMPRESSED_MAGIC = (
+    (0, b"\xff\xd8\xff"),  # JPEG
+    (0, b"\x89PNG\r\n\x1a\n"),
+    (0, b"GIF8"),
+    (8, b"WEBP"),
+    (4, b"ftyp"),  # MP4, MOV, HEIC and 3GP
+    (0, b"\x1a\x45\xdf\xa3"),  # Matroska and WebM
+    (0, b"OggS"),
+    (0, b"fLaC"),
+    (0, b"ID3"),  # MP3
+    (0, b"PK\x03\x04"),  # Zip, APK, JAR and Office documents
+    (0, b"\x1f\x8b"),  # gzip
+    (0, b"BZh"),
+    (0, b"\xfd7zXZ\x00"),
+    (0, b"7z\xbc\xaf\x27\x1c"),
+    (0, b"Rar!\x1a\x07"),
+    (0, b"\x28\xb5\x2f\xfd"),  # zstd
+    (0, b"\x04\x22\x4d\x18"),  # lz4 frame
+)
+
+
+def is_compressed(pathname, sample):
+    """
+        Guess whether a file is already compressed from its extension, its magic number or, failing both, how well lz4
+        compresses its first bytes, which is a cheap estimate of their entropy.
+
+        Parameters:
+            pathname: Path of the file.
+            sample: First bytes of the file, up to `SAMPLE_SIZE`.
+    """
+
+    if os.path.splitext(pathname)[1][1:].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    for offset, magic in COMPRESSED_MAGIC:
+        if sample[offset:offset + len(magic)] == magic:
+            return True
+    if len(sample) < MIN_SAMPLE_SIZE:
+        return False
+    return len(lz4.block.compress(sample, store_size=False)) >= len(sample) * INCOMPRESSIBLE_RATIO
+
+
+def choose_codec(policy, pathname, sample):
+    """
+        Pick the codec to store a file with: "lz4", "snappy", "zlib" or "store".
+
+        Parameters:
+            policy: One of `POLICIES`.
+            pathname: Path of the file.
+            sample: First bytes of the file, up to `SAMPLE_SIZE`.
+    """
+
+    if policy != "auto":
+        return policy
+    return "store" if is_compressed(pathname, sample) else FAST_CODEC
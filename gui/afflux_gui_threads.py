@@ -1,7 +1,10 @@
+import threading
 from datetime import datetime
 from PyQt5 import QtCore
 import utilities
+import afflux_batch
 import imaging
+import metrics
 from plugin_manager import PluginCollection
 from colorama import init, Fore
 
@@ -19,6 +22,33 @@ plugins = PluginCollection('plugins', False)
 
 utils = utilities.Utilities()
 utils.set_gui()
+run_metrics = metrics.Metrics.get_instance()
+
+
+def watch_progress(thread):
+    """
+        Start a run's metrics and send its progress to the GUI through the thread's `progress` signal, as a percentage
+        (-1 until the total is known) and a line with the throughput and ETA.
+    """
+
+    def update(current_metrics):
+        done, total, files, listed = current_metrics.progress()
+        percent = int(done * 100 / total) if total else -1
+        thread.progress.emit(percent, metrics.format_progress(current_metrics))
+
+    # A run that failed part way may have left its updates running.
+    run_metrics.stop()
+    run_metrics.reset()
+    run_metrics.watch(update)
+
+
+def finish_progress():
+    """
+        Stop the progress updates and print where the time went.
+    """
+
+    run_metrics.stop()
+    run_metrics.print_summary()
 
 
 class ImageFolderThread(QtCore.QThread):
@@ -27,9 +57,10 @@ class ImageFolderThread(QtCore.QThread):
     """
 
     signal = QtCore.pyqtSignal(str)
+    progress = QtCore.pyqtSignal(int, str)
 
     def __init__(self, verbose, path_names, recursive, output_file, encryption_password, follow_symlinks, zip_image,
-                 parent=None):
+                 parent=None, workers=1, compression="auto"):
         super(ImageFolderThread, self).__init__(parent)
         self.verbose = verbose
         self.path_names = path_names
@@ -39,13 +70,18 @@ class ImageFolderThread(QtCore.QThread):
         self.follow_symlinks = follow_symlinks
         self.result = True
         self.zip = zip_image
+        self.workers = workers
+        self.compression = compression
 
     def run(self):
-        imager = imaging.Imager(self.verbose, zip=self.zip)
+        imager = imaging.Imager(self.verbose, zip=self.zip, workers=self.workers,
+                                compression=self.compression)
         start_time = datetime.now()
+        watch_progress(self)
         utils.multi_print(Fore.GREEN + "\n[*] Imaging..." + Fore.RESET)
         imager.add_path_names(self.output_file, self.path_names, self.recursive, False,
                               self.encryption_password, symlinks=self.follow_symlinks)
+        finish_progress()
         finished_time = str(datetime.now() - start_time)
         utils.multi_print(Fore.GREEN + "\n[*] Time: " + Fore.RESET + finished_time)
 
@@ -56,9 +92,10 @@ class iOSAFCImageThread(QtCore.QThread):
     """
 
     signal = QtCore.pyqtSignal(str)
+    progress = QtCore.pyqtSignal(int, str)
 
     def __init__(self, verbose, service, output_file, encryption_password, device_num, clear_pairs, re_pair,
-                 zip_image, parent=None):
+                 zip_image, parent=None, workers=1, compression="auto"):
         super(iOSAFCImageThread, self).__init__(parent)
         self.verbose = verbose
         self.service = service
@@ -69,19 +106,27 @@ class iOSAFCImageThread(QtCore.QThread):
         self.clear_pairs = clear_pairs
         self.re_pair = re_pair
         self.zip = zip_image
+        self.workers = workers
+        self.compression = compression
 
     def run(self):
         plugin = plugins.return_plugin(plugin_names["apple"])
         plugin.verbose = self.verbose
         plugin.service = self.service
         start_time = datetime.now()
-        plugin.imager = imaging.Imager(self.verbose)
+        watch_progress(self)
+        plugin.imager = imaging.Imager(self.verbose, workers=self.workers,
+                                       compression=self.compression)
         # Quick hack to fix verbosity in the GUI without adding a bunch to the ios_afc module.
         plugin.arguments = type('', (), {})
         plugin.arguments.verbose = self.verbose
+        plugin.arguments.workers = self.workers
+        plugin.arguments.compression = self.compression
+        plugin.arguments.resume = False
         plugin.arguments.append = False
         self.result = plugin.image_device_afc(self.output_file, self.encryption_password, self.re_pair,
                                               self.clear_pairs, self.zip, device_num=self.device_num)
+        finish_progress()
         finished_time = str(datetime.now() - start_time)
         utils.multi_print(Fore.GREEN + "\n[*] Time: " + Fore.RESET + finished_time)
 
@@ -92,9 +137,10 @@ class AndroidImageThread(QtCore.QThread):
     """
 
     signal = QtCore.pyqtSignal(str)
+    progress = QtCore.pyqtSignal(int, str)
 
     def __init__(self, verbose, directories, output_file, encryption_password, device, network, follow_symlinks, root,
-                 zip_image, parent=None, keygen=None):
+                 zip_image, parent=None, keygen=None, workers=1, compression="auto"):
         super(AndroidImageThread, self).__init__(parent)
         self.verbose = verbose
         self.directories = directories
@@ -106,6 +152,8 @@ class AndroidImageThread(QtCore.QThread):
         self.root = root
         self.result = False
         self.zip = zip_image
+        self.workers = workers
+        self.compression = compression
         self.keygen = keygen
 
     def run(self):
@@ -115,7 +163,11 @@ class AndroidImageThread(QtCore.QThread):
         plugin.arguments = type('', (), {})
         plugin.arguments.append = False
         plugin.arguments.verbose = self.verbose
-        plugin.imager = imaging.Imager(self.verbose)
+        plugin.arguments.workers = self.workers
+        plugin.arguments.compression = self.compression
+        plugin.arguments.resume = False
+        plugin.imager = imaging.Imager(self.verbose, workers=self.workers,
+                                       compression=self.compression)
         if self.keygen:
             plugin.key_gen("adb")
         plugin.sign("adb")
@@ -132,6 +184,7 @@ class AndroidImageThread(QtCore.QThread):
         else:
             out = plugin.connect(serial=self.device)
         start_time = datetime.now()
+        watch_progress(self)
         self.result = plugin.image_device(self.directories.split(" "),
                                           self.output_file,
                                           self.encryption_password,
@@ -139,6 +192,7 @@ class AndroidImageThread(QtCore.QThread):
                                           self.root,
                                           self.zip)
         plugin.close()
+        finish_progress()
         finished_time = str(datetime.now() - start_time)
         utils.multi_print(Fore.GREEN + "\n[*] Time: " + Fore.RESET + finished_time)
 
@@ -149,9 +203,10 @@ class SSHImageThread(QtCore.QThread):
     """
 
     signal = QtCore.pyqtSignal(str)
+    progress = QtCore.pyqtSignal(int, str)
 
     def __init__(self, verbose, host, output_file, encryption_password, username, password, directory, port,
-                 symlinks, recursive, zip_image, parent=None):
+                 symlinks, recursive, zip_image, parent=None, workers=1, compression="auto"):
         super(SSHImageThread, self).__init__(parent)
         self.verbose = verbose
         self.host = host
@@ -165,18 +220,26 @@ class SSHImageThread(QtCore.QThread):
         self.result = False
         self.recursive = recursive
         self.zip = zip_image
+        self.workers = workers
+        self.compression = compression
 
     def run(self):
         plugin = plugins.return_plugin(plugin_names["ssh"])
         start_time = datetime.now()
+        watch_progress(self)
         # Quick hack to fix verbosity in the GUI without adding a bunch to the generic_ssh module.
         plugin.arguments = type('', (), {})
         plugin.arguments.verbose = self.verbose
+        plugin.arguments.workers = self.workers
+        plugin.arguments.compression = self.compression
+        plugin.arguments.resume = False
         plugin.arguments.append = False
-        plugin.imager = imaging.Imager(self.verbose)
+        plugin.imager = imaging.Imager(self.verbose, workers=self.workers,
+                                       compression=self.compression)
         self.result = plugin.image_ssh(self.output_file, self.encryption_password, [self.directory], self.host,
                                        self.username, self.password, self.symlinks, self.recursive, self.zip,
                                        port=self.port)
+        finish_progress()
         finished_time = str(datetime.now() - start_time)
         utils.multi_print(Fore.GREEN + "\n[*] Time: " + Fore.RESET + finished_time)
 
@@ -187,9 +250,10 @@ class FTPImageThread(QtCore.QThread):
     """
 
     signal = QtCore.pyqtSignal(str)
+    progress = QtCore.pyqtSignal(int, str)
 
     def __init__(self, verbose, host, output_file, encryption_password, username, password, directory, port,
-                 symlinks, recursive, zip_image, parent=None):
+                 symlinks, recursive, zip_image, parent=None, workers=1, compression="auto"):
         super(FTPImageThread, self).__init__(parent)
         self.verbose = verbose
         self.host = host
@@ -203,18 +267,26 @@ class FTPImageThread(QtCore.QThread):
         self.result = False
         self.recursive = recursive
         self.zip = zip_image
+        self.workers = workers
+        self.compression = compression
 
     def run(self):
         plugin = plugins.return_plugin(plugin_names["ftp"])
         start_time = datetime.now()
+        watch_progress(self)
         # Quick hack to fix verbosity in the GUI without adding a bunch to the generic_ftp module.
         plugin.arguments = type('', (), {})
         plugin.arguments.verbose = self.verbose
+        plugin.arguments.workers = self.workers
+        plugin.arguments.compression = self.compression
+        plugin.arguments.resume = False
         plugin.arguments.append = False
-        plugin.imager = imaging.Imager(self.verbose, zip=self.zip)
+        plugin.imager = imaging.Imager(self.verbose, zip=self.zip, workers=self.workers,
+                                       compression=self.compression)
         self.result = plugin.image_ftp(self.output_file, self.encryption_password, [self.directory], self.host,
                                        self.username, self.password, self.symlinks, 5, self.recursive, self.zip,
                                        port=self.port)
+        finish_progress()
         finished_time = str(datetime.now() - start_time)
         utils.multi_print(Fore.GREEN + "\n[*] Time: " + Fore.RESET + finished_time)
 
@@ -225,9 +297,10 @@ class SMBImageThread(QtCore.QThread):
     """
 
     signal = QtCore.pyqtSignal(str)
+    progress = QtCore.pyqtSignal(int, str)
 
     def __init__(self, verbose, host, output_file, encryption_password, username, password, share, port,
-                 symlinks, recursive, zip_image, parent=None):
+                 symlinks, recursive, zip_image, parent=None, workers=1, compression="auto"):
         super(SMBImageThread, self).__init__(parent)
         self.verbose = verbose
         self.host = host
@@ -241,17 +314,59 @@ class SMBImageThread(QtCore.QThread):
         self.result = False
         self.recursive = recursive
         self.zip = zip_image
+        self.workers = workers
+        self.compression = compression
 
     def run(self):
         plugin = plugins.return_plugin(plugin_names["smb"])
         start_time = datetime.now()
+        watch_progress(self)
         # Quick hack to fix verbosity in the GUI without adding a bunch to the generic_smb module.
         plugin.arguments = type('', (), {})
         plugin.arguments.verbose = self.verbose
+        plugin.arguments.workers = self.workers
+        plugin.arguments.compression = self.compression
+        plugin.arguments.resume = False
         plugin.arguments.append = False
-        plugin.imager = imaging.Imager(self.verbose, zip=self.zip)
+        plugin.imager = imaging.Imager(self.verbose, zip=self.zip, workers=self.workers,
+                                       compression=self.compression)
         self.result = plugin.image_smb(self.output_file, self.encryption_password, self.share, self.host,
                                        self.username, self.password, self.symlinks, self.recursive, self.zip,
                                        port=self.port)
+        finish_progress()
         finished_time = str(datetime.now() - start_time)
         utils.multi_print(Fore.GREEN + "\n[*] Time: " + Fore.RESET + finished_time)
+
+
+class BatchThread(QtCore.QThread):
+    """
+        Thread to acquire every device in a batch manifest, each in its own afflux process.
+    """
+
+    signal = QtCore.pyqtSignal(str)
+    progress = QtCore.pyqtSignal(int, str)
+
+    def __init__(self, manifest, shared_arguments, parent=None):
+        super(BatchThread, self).__init__(parent)
+        self.manifest = manifest
+        self.shared_arguments = shared_arguments
+        self.stopping = threading.Event()
+        self.result = False
+
+    def stop(self):
+        """
+            Stop the devices that are still being acquired.
+        """
+
+        self.stopping.set()
+
+    def run(self):
+        start_time = datetime.now()
+        self.progress.emit(-1, "Acquiring devices...")
+        self.result = afflux_batch.run_batch(self.manifest, self.shared_arguments, stop=self.stopping,
+                                             progress=self.update_progress)
+        finished_time = str(datetime.now() - start_time)
+        utils.multi_print(Fore.GREEN + "\n[*] Time: " + Fore.RESET + finished_time)
+
+    def update_progress(self, finished, total):
+        self.progress.emit(int(finished * 100 / total), f"{finished} of {total} devices finished")
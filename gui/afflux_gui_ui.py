@@ -666,6 +666,14 @@ class Ui_MainWindow(object):
         self.outputTextBrowser.setSizePolicy(sizePolicy)
         self.outputTextBrowser.setObjectName("outputTextBrowser")
         self.verticalLayout_7.addWidget(self.outputTextBrowser)
+        self.progressBar = QtWidgets.QProgressBar(self.outputFrame)
+        self.progressBar.setProperty("value", 0)
+        self.progressBar.setObjectName("progressBar")
+        self.verticalLayout_7.addWidget(self.progressBar)
+        self.progressLabel = QtWidgets.QLabel(self.outputFrame)
+        self.progressLabel.setText("")
+        self.progressLabel.setObjectName("progressLabel")
+        self.verticalLayout_7.addWidget(self.progressLabel)
         self.gridLayout.addWidget(self.outputFrame, 2, 0, 1, 2)
         self.imageOptionsWidget = QtWidgets.QWidget(self.centralwidget)
         self.imageOptionsWidget.setObjectName("imageOptionsWidget")
@@ -699,6 +707,25 @@ class Ui_MainWindow(object):
         self.encryptImageCheckBox = QtWidgets.QCheckBox(self.imageOptionsWidget_1)
         self.encryptImageCheckBox.setObjectName("encryptImageCheckBox")
         self.horizontalLayout_2.addWidget(self.encryptImageCheckBox)
+        self.workersLabel = QtWidgets.QLabel(self.imageOptionsWidget_1)
+        self.workersLabel.setObjectName("workersLabel")
+        self.horizontalLayout_2.addWidget(self.workersLabel)
+        self.workersSpinBox = QtWidgets.QSpinBox(self.imageOptionsWidget_1)
+        self.workersSpinBox.setMinimum(1)
+        self.workersSpinBox.setMaximum(64)
+        self.workersSpinBox.setObjectName("workersSpinBox")
+        self.horizontalLayout_2.addWidget(self.workersSpinBox)
+        self.compressionLabel = QtWidgets.QLabel(self.imageOptionsWidget_1)
+        self.compressionLabel.setObjectName("compressionLabel")
+        self.horizontalLayout_2.addWidget(self.compressionLabel)
+        self.compressionComboBox = QtWidgets.QComboBox(self.imageOptionsWidget_1)
+        self.compressionComboBox.setObjectName("compressionComboBox")
+        self.compressionComboBox.addItem("")
+        self.compressionComboBox.addItem("")
+        self.compressionComboBox.addItem("")
+        self.compressionComboBox.addItem("")
+        self.compressionComboBox.addItem("")
+        self.horizontalLayout_2.addWidget(self.compressionComboBox)
         self.verticalLayout_9.addWidget(self.imageOptionsWidget_1)
         self.encryptionPasswordLabel = QtWidgets.QLabel(self.imageOptionsGroupBox)
         self.encryptionPasswordLabel.setObjectName("encryptionPasswordLabel")
@@ -738,6 +765,9 @@ class Ui_MainWindow(object):
         self.imagePushButton.setStatusTip("")
         self.imagePushButton.setObjectName("imagePushButton")
         self.horizontalLayout_23.addWidget(self.imagePushButton)
+        self.batchButton = QtWidgets.QPushButton(self.imageOptionsWidget_2)
+        self.batchButton.setObjectName("batchButton")
+        self.horizontalLayout_23.addWidget(self.batchButton)
         self.cancelButton = QtWidgets.QPushButton(self.imageOptionsWidget_2)
         palette = QtGui.QPalette()
         brush = QtGui.QBrush(QtGui.QColor(237, 51, 59))
@@ -892,12 +922,23 @@ class Ui_MainWindow(object):
         self.tabWidget.setTabText(self.tabWidget.indexOf(self.smb), _translate("MainWindow", "SMB"))
         self.tabWidget.setTabToolTip(self.tabWidget.indexOf(self.smb), _translate("MainWindow", "Image a remote device via SMB."))
         self.outputTextBrowser.setToolTip(_translate("MainWindow", "Ouptut information is displayed here."))
+        self.progressBar.setToolTip(_translate("MainWindow", "Bytes added to the container out of those found on the device so far."))
+        self.progressLabel.setToolTip(_translate("MainWindow", "Files added, throughput and estimated time remaining."))
         self.imageOptionsGroupBox.setTitle(_translate("MainWindow", "Image Options"))
         self.verboseCheckBox.setToolTip(_translate("MainWindow", "Verbosly output more information."))
         self.verboseCheckBox.setText(_translate("MainWindow", "Verbose"))
         self.zipImageCheckBox.setText(_translate("MainWindow", "Use zip"))
         self.encryptImageCheckBox.setToolTip(_translate("MainWindow", "Encrypt the image and contents with a password."))
         self.encryptImageCheckBox.setText(_translate("MainWindow", "Encrypt image"))
+        self.workersLabel.setText(_translate("MainWindow", "Workers:"))
+        self.workersSpinBox.setToolTip(_translate("MainWindow", "Number of threads to read, hash and compress files with."))
+        self.compressionLabel.setText(_translate("MainWindow", "Compression:"))
+        self.compressionComboBox.setToolTip(_translate("MainWindow", "Codec to store files with. \"auto\" stores files that are already compressed as they are and uses lz4 for the rest."))
+        self.compressionComboBox.setItemText(0, _translate("MainWindow", "auto"))
+        self.compressionComboBox.setItemText(1, _translate("MainWindow", "lz4"))
+        self.compressionComboBox.setItemText(2, _translate("MainWindow", "snappy"))
+        self.compressionComboBox.setItemText(3, _translate("MainWindow", "zlib"))
+        self.compressionComboBox.setItemText(4, _translate("MainWindow", "store"))
         self.encryptionPasswordLabel.setText(_translate("MainWindow", "Encryption password:"))
         self.encryptionPasswordLineEdit.setToolTip(_translate("MainWindow", "Encryption password if encryption is enabled."))
         self.outputFileLabel.setText(_translate("MainWindow", "Output file:"))
@@ -905,5 +946,7 @@ class Ui_MainWindow(object):
         self.outputFileButton.setText(_translate("MainWindow", "..."))
         self.imagePushButton.setToolTip(_translate("MainWindow", "Begin Imaging!"))
         self.imagePushButton.setText(_translate("MainWindow", "Image!"))
+        self.batchButton.setToolTip(_translate("MainWindow", "Acquire every device in a batch manifest."))
+        self.batchButton.setText(_translate("MainWindow", "Batch..."))
         self.cancelButton.setToolTip(_translate("MainWindow", "Stop imaging."))
         self.cancelButton.setText(_translate("MainWindow", "Cancel"))
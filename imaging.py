@@ -1,26 +1,114 @@
 # By Marshall University on 7/13/2021
 
+import ctypes
+import hashlib
+import io
+import json
+import mmap
 import os
+import posixpath
+import queue
+import shlex
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from dateutil.parser import parse
+from fnmatch import fnmatch
+from functools import lru_cache, partial
 from stat import *
 import uuid
 
 from colorama import reinit, Fore
 from sys import exit
 
-from pyaff4 import aff4_map
+from pyaff4 import aff4_image, aff4_map
 from pyaff4 import container
 from pyaff4 import data_store, linear_hasher
 from pyaff4 import lexicon, logical, escaping
 from pyaff4 import rdfvalue, hashes, utils
 import shutil
+import sqlite3
 import sys
 import errno
 import platform
+import re
+import tarfile
+import tempfile
+import tzlocal
+import compression
+import metrics
 import utilities
+import zip_container
 import zipfile
+import zlib
+import lz4.block
+import snappy
 
 reinit()  # Colorama
 printUtils = utilities.Utilities.get_instance()
+runMetrics = metrics.Metrics.get_instance()
+
+# Predicates for the POSIX attributes that pyaff4's FSMetadata classes don't keep.
+UNIX_MODE = lexicon.AFF4_NAMESPACE + "unixMode"
+UNIX_UID = lexicon.AFF4_NAMESPACE + "unixUID"
+UNIX_GID = lexicon.AFF4_NAMESPACE + "unixGID"
+
+# Files that were unchanged since the image an incremental acquisition is based on are stored as references to it.
+PRIOR_REFERENCE = lexicon.AFF4_NAMESPACE + "PriorImageReference"
+PRIOR_IMAGE = lexicon.AFF4_NAMESPACE + "priorImage"
+PRIOR_VOLUME = lexicon.AFF4_NAMESPACE + "priorVolume"
+
+# Type of the volume members holding a `ContainerIndex`. Appending adds a new one, the latest written is used.
+INDEX_TYPE = lexicon.AFF4_NAMESPACE + "AffluxIndex"
+
+# With deduplication, copies of a file that is already in the container are stored as references to its stream.
+DUPLICATE_REFERENCE = lexicon.AFF4_NAMESPACE + "DuplicateFileReference"
+DUPLICATE_OF = lexicon.AFF4_NAMESPACE + "duplicateOf"
+
+# Largest streamed file that is held in memory to be hashed before it is written, when it could be a duplicate.
+DEDUP_BUFFER_SIZE = 64 * 1024 * 1024
+
+# An incremental acquisition only estimates the time it saved once it has transferred enough to measure the rate.
+ESTIMATE_MIN_BYTES = 16 * 1024 * 1024
+ESTIMATE_MIN_SECONDS = 1.0
+
+# AFF4 compression method of each codec of `compression.POLICIES`.
+CODECS = {
+    "lz4": lexicon.AFF4_IMAGE_COMPRESSION_LZ4,
+    "snappy": lexicon.AFF4_IMAGE_COMPRESSION_SNAPPY,
+    "zlib": lexicon.AFF4_IMAGE_COMPRESSION_ZLIB,
+    "store": lexicon.AFF4_IMAGE_COMPRESSION_STORED,
+}
+
+# The codec a file was stored with: one of `CODECS`, or "deflate" for a deflated zip segment.
+CODEC = lexicon.AFF4_NAMESPACE + "affluxCodec"
+
+# How image chunks are compressed for each AFF4 compression method, see `ChunkCompressor`.
+COMPRESSORS = {
+    lexicon.AFF4_IMAGE_COMPRESSION_ZLIB: zlib.compress,
+    # AFF4 lz4 chunks are raw blocks, without the size lz4.block prepends by default.
+    lexicon.AFF4_IMAGE_COMPRESSION_LZ4: partial(lz4.block.compress, store_size=False),
+    lexicon.AFF4_IMAGE_COMPRESSION_SNAPPY: snappy.compress,
+}
+
+# Size of the reads the read ahead threads hash and hand to the writer.
+READ_AHEAD_BLOCK = 256 * 1024
+
+# Size of the copies the extraction threads make from a stream to its file.
+EXTRACT_BLOCK = 1024 * 1024
+
+# Local files of at least this many bytes are memory mapped instead of read, see `MappedFile`.
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# How far ahead of the reads of a mapped file the kernel is asked to read.
+MMAP_READ_AHEAD = 16 * 1024 * 1024
+
+# A file in a volume, as `Imager.stored_files` lists it. `stream` is the URN of the stream holding its contents and
+# `timestamps` are in the order `logical.resetTimestamps` takes them.
+StoredFile = namedtuple("StoredFile", ["path", "stream", "size", "sha1", "md5", "timestamps"])
 
 def next_or_none(iterable):
     try:
@@ -29,412 +117,2299 @@ def next_or_none(iterable):
         return None
 
 
-def print_volume_info(file, volume):
+@contextmanager
+def open_stream(resolver, urn):
     """
-        Print AFF4 volume information.
+        Open a stored stream to read from. The resolver keeps a stream open once it has been read, with its chunk
+        cache, and pyaff4 caches the trimmed last chunk of a stream under its place in the bevy instead of in the
+        stream. When the stream spans several bevies that entry is wrong, and reading the stream again (a duplicate
+        reference, or a mounted file) returns it in place of an early chunk. The cache is cleared on every open.
     """
 
-    volume_urn = volume.urn
-    printUtils.multi_print("AFF4Container: file://%s <%s>" % (file, str(volume_urn)))
+    with resolver.AFF4FactoryOpen(urn) as stream:
+        cache = getattr(stream, "cache", None)
+        if cache is not None:
+            cache.clear()
+        yield stream
 
 
-def print_turtle(resolver, volume):
+def new_image_urn(volume, pathname):
+    """
+        Pick the URN a file or folder is stored under in a volume, the same way pyaff4's `writeLogicalStream` does.
     """
-        Print the data stored in information.turtle.
 
-        Parameters:
-            resolver:
-            volume:
+    if volume.isAFF4Collision(pathname):
+        return rdfvalue.URN("aff4://%s" % uuid.uuid4())
+    return volume.urn.Append(escaping.arnPathFragment_from_path(pathname), quote=False)
+
+
+def read_local_copy(pathname):
+    """
+        Read a local file that could be a copy of a stored one, hashing it with SHA1 on the way, so it can be written
+        from what was read instead of being read from the disk a second time. Up to `DEDUP_BUFFER_SIZE` bytes are
+        held in memory, larger files are spooled to a temporary file. Returns the copy, rewound, and the SHA1 as a hex
+        string.
     """
 
-    metadata_urn = volume.urn.Append("information.turtle")
+    sha1 = hashlib.sha1()
+    copy = tempfile.SpooledTemporaryFile(max_size=DEDUP_BUFFER_SIZE)
     try:
-        with resolver.AFF4FactoryOpen(metadata_urn) as fd:
-            txt = fd.ReadAll()
-            for line in txt.split(b'\n'):
-                if b'aff4://' in line:
-                    printUtils.multi_print(Fore.GREEN + utils.SmartUnicode(line))
-                else:
-                    printUtils.multi_print(utils.SmartUnicode(line))
-    except:
-        pass
+        with open(pathname, "rb") as src:
+            while True:
+                read_time = time.perf_counter()
+                block = src.read(READ_AHEAD_BLOCK)
+                runMetrics.count("transferred", size=len(block), seconds=time.perf_counter() - read_time)
+                if not block:
+                    break
+                sha1.update(block)
+                copy.write(block)
+    except BaseException:
+        copy.close()
+        raise
+    copy.seek(0)
+    return copy, sha1.hexdigest()
+
+
+def parse_time(value):
+    """
+        Parse a time given to the extraction filters: a date and time, or an age such as "2w", "7d", "12h" or "30m"
+        that is counted back from now. Times without a time zone are local. Raises ValueError if it can't be parsed.
+    """
 
+    match = re.fullmatch(r"(\d+)([wdhm])", value.strip().lower())
+    if match:
+        unit = {"w": "weeks", "d": "days", "h": "hours", "m": "minutes"}[match.group(2)]
+        return datetime.now(tzlocal.get_localzone()) - timedelta(**{unit: int(match.group(1))})
+    when = parse(value)
+    if when.tzinfo is None:
+        when = when.astimezone()
+    return when
 
-class Imager:
+
+def parse_datetime(value):
     """
-        This class is used to image files and folders using the AFF4 image format. This code is largely from
-        https://github.com/aff4/pyaff4 with more error handling and cross-platform support.
+        Turn a timestamp read back from a container's resolver into a datetime, or None if it can't be parsed.
+    """
+
+    if value is None:
+        return None
+    value = getattr(value, "value", value)
+    if hasattr(value, "toPython"):
+        value = value.toPython()
+    if isinstance(value, datetime):
+        return value
+    value = utils.SmartUnicode(value)
+    if value.startswith(("b'", 'b"')):
+        value = value[2:-1]
+    try:
+        return parse(value)
+    except (ValueError, OverflowError):
+        return None
+
+
+def create_metadata(path_name, size, last_written, last_accessed=None, record_changed=None, birth_time=None, mode=None,
+                    uid=None, gid=None):
+    """
+        Create the metadata for a file or folder that is not on the local disk, so it can be streamed into a
+        container. Timestamps can be POSIX timestamps or datetime objects, missing ones fall back to `last_written`.
+
+        Parameters:
+            path_name: Path of the file or folder on the device.
+            size: Size of the file in bytes.
+            last_written: Modified time.
+            last_accessed: Accessed time.
+            record_changed: Changed time.
+            birth_time: Created time.
+            mode: POSIX mode bits.
+            uid: Owner user ID.
+            gid: Owner group ID.
+
+        Returns:
+            FSMetadata for the file.
+    """
+
+    local_tz = tzlocal.get_localzone()
+
+    def to_datetime(timestamp):
+        if timestamp is None:
+            return None
+        if isinstance(timestamp, datetime):
+            if timestamp.tzinfo is None:
+                return timestamp.astimezone(local_tz)
+            return timestamp
+        return datetime.fromtimestamp(timestamp, local_tz)
+
+    last_written = to_datetime(last_written)
+    if last_written is None:
+        last_written = datetime.now(local_tz)
+    last_accessed = to_datetime(last_accessed) or last_written
+    record_changed = to_datetime(record_changed) or last_written
+    if birth_time is not None:
+        fsmeta = logical.ModernUnixMetadata(path_name, path_name, size, last_written, last_accessed, record_changed,
+                                            to_datetime(birth_time))
+    else:
+        fsmeta = logical.ClassicUnixMetadata(path_name, path_name, size, last_written, last_accessed, record_changed)
+    fsmeta.mode = mode
+    fsmeta.uid = uid
+    fsmeta.gid = gid
+    return fsmeta
+
+
+@lru_cache(maxsize=None)
+def statx_syscall():
+    """
+        Load the statx system call once, `pyaff4.statx` loads it again for every file.
+    """
+
+    syscall = ctypes.CDLL(None, use_errno=True).syscall
+    # int statx(int dirfd, const char *pathname, int flags, unsigned int mask, struct statx *statxbuf);
+    syscall.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.c_char_p]
+    syscall.restype = ctypes.c_int
+    return syscall
+
+
+def linux_birth_time(path_name):
+    """
+        Get the birth time of a file on Linux, which `os.stat` doesn't return.
+    """
+
+    statx = logical.statx
+    statx_buffer = ctypes.create_string_buffer(ctypes.sizeof(statx.Statx))
+    if statx_syscall()(statx.SYS_STATX, statx.AT_FDCWD, os.fsencode(path_name), statx.AT_SYMLINK_NOFOLLOW,
+                       statx.STATX_ALL, statx_buffer):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path_name)
+    return statx.Statx.from_buffer(statx_buffer).get_btime()
+
+
+def stat_metadata(path_name, stat_result):
+    """
+        Create the metadata for a file or folder on the local disk from a stat result that was already taken, such as
+        one from `os.scandir`. This is `logical.FSMetadata.create` without the extra stat of the path.
+
+        Parameters:
+            path_name: Path of the file or folder.
+            stat_result: Its `os.stat_result`.
+
+        Returns:
+            FSMetadata for the file.
+    """
+
+    local_tz = tzlocal.get_localzone()
+    size = stat_result.st_size
+    last_written = datetime.fromtimestamp(stat_result.st_mtime, local_tz)
+    accessed = datetime.fromtimestamp(stat_result.st_atime, local_tz)
+    system = platform.system()
+    if system == "Windows":
+        birth_time = datetime.fromtimestamp(stat_result.st_ctime, local_tz)
+        return logical.WindowsFSMetadata(path_name, path_name, size, last_written, accessed, birth_time)
+    record_changed = datetime.fromtimestamp(stat_result.st_ctime, local_tz)
+    if system == "Darwin":
+        birth_time = datetime.fromtimestamp(stat_result.st_birthtime, local_tz)
+        return logical.MacOSFSMetadata(path_name, path_name, size, last_written, accessed, record_changed, birth_time)
+    if system == "Linux":
+        birth_time = datetime.fromtimestamp(linux_birth_time(path_name), local_tz)
+        return logical.LinuxFSMetadata(path_name, path_name, size, last_written, accessed, record_changed, birth_time)
+    return logical.ClassicUnixMetadata(path_name, path_name, size, last_written, accessed, record_changed)
+
+
+def store_unix_attributes(resolver, fsmeta):
+    """
+        Store the mode and owner of a file or folder, if they were given to `create_metadata`.
+    """
+
+    for predicate, value in ((UNIX_MODE, getattr(fsmeta, "mode", None)), (UNIX_UID, getattr(fsmeta, "uid", None)),
+                             (UNIX_GID, getattr(fsmeta, "gid", None))):
+        if value is not None:
+            resolver.Set(fsmeta.urn, fsmeta.urn, rdfvalue.URN(predicate), rdfvalue.XSDInteger(value))
+
+
+def tar_streams(fileobj, prefix=""):
+    """
+        Read a tar archive as it streams in and yield its folders and regular files as (path name, FSMetadata, stream)
+        tuples for `Imager.add_streams`. Each file's stream has to be read before the next tuple is requested, which
+        the imager does. Symlinks and special files are skipped.
+
+        Parameters:
+            fileobj: Readable file like object the archive is streamed from.
+            prefix: Folder in the container the archive's paths are relative to.
+    """
+
+    with tarfile.open(fileobj=fileobj, mode="r|") as archive:
+        for member in archive:
+            if not (member.isdir() or member.isreg()):
+                continue
+            pathname = posixpath.normpath(posixpath.join(prefix, member.name)).lstrip("/")
+            if pathname == ".":
+                continue
+            fsmeta = create_metadata(pathname, member.size if member.isreg() else 0, member.mtime,
+                                     last_accessed=float(member.pax_headers.get("atime", member.mtime)),
+                                     record_changed=float(member.pax_headers.get("ctime", member.mtime)),
+                                     mode=S_IMODE(member.mode), uid=member.uid, gid=member.gid)
+            if member.isdir():
+                yield pathname, fsmeta, None
+            else:
+                yield pathname, fsmeta, archive.extractfile(member)
+
+
+def tar_arguments(targets, no_image):
+    """
+        Build the exclusions, directory and members of a tar command archiving remote paths from "/". Paths are
+        given as "./path", so an exclusion is matched against members from the start: GNU tar matches exclusions
+        after any "/" in a member's name by default, and no component of a name can be "." after the first. Not every
+        tar supports --anchored (busybox doesn't), this works with all of them.
+
+        Parameters:
+            targets: Paths to archive, relative to "/".
+            no_image: Remote paths to leave out.
+    """
+
+    excludes = " ".join(f"--exclude={shlex.quote('./' + item.strip('/'))}" for item in sorted(no_image))
+    members = " ".join(shlex.quote("./" + target.strip("/")) for target in targets)
+    return f"{excludes} -C / {members}".lstrip()
+
+
+def tar_error_paths(output):
+    """
+        Get the paths a tar command reported it could not read from its error output, so they can be copied another
+        way.
+
+        Parameters:
+            output: Error output of the tar command.
     """
 
-    def __init__(self, verbose, zip=False):
+    failed = []
+    for line in output.splitlines():
+        # toybox, busybox and GNU tar all report "tar: <path>: <reason>", optionally with the path quoted
+        match = re.match(r"tar: (?:\w+ )?'?([^':]+)'?:", line)
+        if match and not match.group(1).startswith("Removing"):
+            failed.append(posixpath.normpath("/" + match.group(1).strip()))
+    return failed
+
+
+class StreamPipe(io.BytesIO):
+    """
+        A bounded pipe that lets a plugin hand a file to the imager while it is still being transferred. `writer` is
+        called on its own thread with the pipe as the destination file the first time the imager reads from it, so a
+        file is only pulled from the device when it is actually added to the container. It is a `BytesIO` so client
+        libraries that only write to a path or a `BytesIO` (adb_shell) can write into it.
+    """
+
+    def __init__(self, writer, max_chunks=64):
         """
-            Constructor for Imager class.
+            Constructor for StreamPipe class.
 
             Parameters:
-                    verbose: Include verbose messages in output.
+                writer: Callable that writes the file's data to the file like object it is given.
+                max_chunks: Number of written chunks to buffer before the writer blocks.
         """
 
-        self.verbose = verbose
-        self.os = ""
-        self.container_path = ""
-        self.separator = ""
-        self.check_os()
-        self.zip = zip
+        super().__init__()
+        self.writer = writer
+        self.chunks = queue.Queue(maxsize=max_chunks)
+        self.buffer = bytearray()
+        self.error = None
+        self.thread = None
+        self.future = None
+        self.done = threading.Event()
+        self.finished = False
+        self.cancelled = False
+        # Bytes the writer has read from the source so far.
+        self.received = 0
+
+    @property
+    def started(self):
+        return self.thread is not None or self.future is not None
+
+    def start(self, executor=None):
+        """
+            Start transferring the file if it hasn't started yet, on its own thread or on `executor` if one is given.
+            Returns the executor's future for the transfer.
+        """
 
-    def check_os(self):
+        if not self.started:
+            if executor is not None:
+                self.future = executor.submit(self._transfer)
+            else:
+                self.thread = threading.Thread(target=self._transfer, daemon=True)
+                self.thread.start()
+        return self.future
+
+    def _transfer(self):
+        try:
+            self.writer(self)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._put(None)
+            self.done.set()
+
+    def _put(self, chunk):
+        while not self.cancelled:
+            try:
+                self.chunks.put(chunk, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def write(self, data):
+        if self.cancelled:
+            raise BrokenPipeError("Stream was closed by the imager.")
+        if data:
+            self.received += len(data)
+            self._put(bytes(data))
+        return len(data)
+
+    def read(self, size=-1):
+        self.start()
+        while not self.finished and (size is None or size < 0 or len(self.buffer) < size):
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.finished = True
+                if self.error is not None:
+                    raise self.error
+                break
+            self.buffer += chunk
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
         """
-            Check and set the OS.
+            Stop the transfer and wait for the writer to finish.
         """
 
-        self.os = platform.system()
-        if self.os == "Windows":
-            self.separator = "\\"
-        else:
-            self.separator = "/"
-        return True
+        self.cancelled = True
+        if self.started:
+            while not self.done.is_set():
+                try:
+                    self.chunks.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+        super().close()
 
-    def cleanup(self, specified_path=None):
+
+def received_size(stream, length):
+    """
+        Get how many bytes of a file handed to the imager were read from the source, after the imager closed it without
+        reading it.
+
+        Parameters:
+            stream: The file's stream, a callable that opens it, or None.
+            length: Size of the file in bytes.
+    """
+
+    if stream is None or callable(stream):
+        return 0
+    # A member of a tar stream crosses the wire with the rest of the archive whether it is read or not.
+    return getattr(stream, "received", length)
+
+
+class MappedFile:
+    """
+        A local file memory mapped for reading. `read` returns memoryview slices of the mapping, so each chunk goes
+        from the page cache to the hashes and the compressor without being copied into a new `bytes` object. The
+        kernel is told the file is read in order and asked to read ahead of the reads, where the OS supports it.
+    """
+
+    def __init__(self, pathname):
         """
-            Cleanup any temporary directories.
+            Constructor for MappedFile class.
 
             Parameters:
-                specified_path: Custom temporary folder if specified.
+                pathname: Path of the file.
         """
 
+        self.file = open(pathname, "rb")
         try:
-            username = os.getlogin()
-        except OSError:
-            username = ""
-        if not specified_path:
-            paths = ["/tmp/afflux_files_download",
-                     "C:\\Users\\" + username + "\\AppData\\Local\\Temp\\afflux_files_download"]
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.file.close()
+            raise
+        self.view = memoryview(self.map)
+        self.position = 0
+        self.advised = 0
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self.file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        elif hasattr(mmap, "MADV_SEQUENTIAL"):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else min(self.position + size, len(self.view))
+        if end > self.advised:
+            self.read_ahead(end)
+        data = self.view[self.position:end]
+        self.position = end
+        return data
+
+    def read_ahead(self, end):
+        """
+            Ask the kernel to start reading the next `MMAP_READ_AHEAD` bytes after `end`.
+        """
+
+        start = self.advised
+        self.advised = min(end + MMAP_READ_AHEAD, len(self.view))
+        # madvise needs a start on a page boundary.
+        start -= start % mmap.PAGESIZE
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self.file.fileno(), start, self.advised - start, os.POSIX_FADV_WILLNEED)
+        elif hasattr(mmap, "MADV_WILLNEED"):
+            self.map.madvise(mmap.MADV_WILLNEED, start, self.advised - start)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # A chunk is still referenced somewhere, the mapping is closed when it is garbage collected.
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_local(pathname, length):
+    """
+        Open a local file to add to a container, memory mapped if it has at least `MMAP_THRESHOLD` bytes.
+
+        Parameters:
+            pathname: Path of the file.
+            length: Size of the file in bytes.
+    """
+
+    if length >= MMAP_THRESHOLD:
+        try:
+            return MappedFile(pathname)
+        except (OSError, ValueError):
+            # Files that can't be mapped, like some on network shares, are read as usual.
+            pass
+    return open(pathname, "rb")
+
+
+class MeteredHasher(linear_hasher.StreamHasher):
+    """
+        pyaff4's `StreamHasher` counting the bytes read from the source and hashed, and how long each read and hash
+        took, in the run's `metrics.Metrics`.
+    """
+
+    def __init__(self, parent, hashDatatypes, transferred=True):
+        """
+            Constructor for MeteredHasher class.
+
+            Parameters:
+                parent: Readable file like object.
+                hashDatatypes: Hashes to compute.
+                transferred: Count the reads from `parent` as transferred, False if it was already read into memory.
+        """
+
+        super().__init__(parent, hashDatatypes)
+        self.transferred = transferred
+        # Bytes read through the hasher so far.
+        self.size = 0
+
+    def read(self, bytes):
+        start_time = time.perf_counter()
+        data = self.parent.read(bytes)
+        read_time = time.perf_counter()
+        if self.transferred:
+            runMetrics.count("transferred", size=len(data), seconds=read_time - start_time)
+        if data:
+            self.size += len(data)
+            for h in self.hashes:
+                h.update(data)
+            runMetrics.count("hashed", size=len(data), seconds=time.perf_counter() - read_time)
+        return data
+
+
+class MappedHasher(MeteredHasher):
+    """
+        `MeteredHasher` for a `MappedFile`. Instead of hashing each read, the mapping is hashed `MMAP_READ_AHEAD` bytes
+        at a time as the reads reach it, with every hash on its own thread since hashlib releases the GIL on large
+        buffers. A window is hashed while the reads go on through the next one.
+    """
+
+    def __init__(self, parent, hashDatatypes):
+        """
+            Constructor for MappedHasher class.
+
+            Parameters:
+                parent: MappedFile to read.
+                hashDatatypes: Hashes to compute.
+        """
+
+        super().__init__(parent, hashDatatypes)
+        self.hashed = 0
+        self.pool = ThreadPoolExecutor(max_workers=len(self.hashes))
+        self.window = None
+        self.futures = []
+
+    def read(self, bytes):
+        start_time = time.perf_counter()
+        data = self.parent.read(bytes)
+        runMetrics.count("transferred", size=len(data), seconds=time.perf_counter() - start_time)
+        if self.parent.position > self.hashed:
+            self.hash_window(self.parent.position)
+        return data
+
+    def hash_window(self, end):
+        """
+            Start hashing the mapping from where the last window stopped to at least `end`, once the last window is
+            hashed.
+        """
+
+        self.wait()
+        stop = min(max(end, self.hashed + MMAP_READ_AHEAD), len(self.parent.view))
+        self.window = self.parent.view[self.hashed:stop]
+        start_time = time.perf_counter()
+        self.futures = [self.pool.submit(h.update, self.window) for h in self.hashes]
+        self.futures[-1].add_done_callback(lambda future, size=stop - self.hashed: runMetrics.count(
+            "hashed", size=size, seconds=time.perf_counter() - start_time))
+        self.hashed = stop
+
+    def wait(self):
+        """
+            Wait for the window being hashed.
+        """
+
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        if self.window is not None:
+            self.window.release()
+            self.window = None
+
+    def getHash(self, dataType):
+        self.wait()
+        self.pool.shutdown()
+        return super().getHash(dataType)
+
+
+def local_hasher(src):
+    """
+        Hash a local file opened by `open_local` with SHA1 and MD5 as it is read.
+    """
+
+    if isinstance(src, MappedFile):
+        return MappedHasher(src, [lexicon.HASH_SHA1, lexicon.HASH_MD5])
+    return MeteredHasher(src, [lexicon.HASH_SHA1, lexicon.HASH_MD5])
+
+
+class PeekedStream:
+    """
+        Reads the first bytes of a stream ahead of time, so the codec can be picked from them before it is written.
+        Reads are still filled to the size asked for, which the chunks of an AFF4 image rely on.
+    """
+
+    def __init__(self, source, size):
+        """
+            Constructor for PeekedStream class.
+
+            Parameters:
+                source: Readable file like object.
+                size: Number of bytes to read ahead.
+        """
+
+        self.source = source
+        self.head = bytes(source.read(size))
+        self.position = 0
+
+    def read(self, size=-1):
+        if self.position >= len(self.head):
+            return self.source.read(size)
+        if size < 0:
+            data = self.head[self.position:] + bytes(self.source.read())
         else:
-            paths = [specified_path[0]]
-        for directory in paths:
-            try:
-                shutil.rmtree(directory)
-                if self.verbose:
-                    print(f"{Fore.GREEN}[+] Cleaned up: {Fore.RESET}{directory}")
-            except FileNotFoundError:
-                continue
-            except PermissionError:
-                printUtils.multi_print(f"{Fore.RED}[-] Could not access temporary folder. Check permissions.\n")
-                return False
+            data = self.head[self.position:self.position + size]
+            if len(data) < size:
+                data += bytes(self.source.read(size - len(data)))
+        self.position += len(data)
+        return data
+
+
+class ChunkCompressor:
+    """
+        Reads a stream in the chunk size of an AFF4 image and compresses the chunks on a thread pool, handing them back
+        in order. zlib, lz4 and snappy release the GIL, so this keeps several cores compressing while the volume is
+        written from one thread.
+    """
+
+    def __init__(self, image, source, pool, window):
+        """
+            Constructor for ChunkCompressor class.
+
+            Parameters:
+                image: AFF4Image the chunks are written to.
+                source: Readable file like object.
+                pool: ThreadPoolExecutor to compress on.
+                window: Number of chunks to read and compress ahead of the writer.
+        """
+
+        self.image = image
+        self.source = source
+        self.pool = pool
+        self.window = window
+        self.compress = COMPRESSORS.get(image.compression)
+        self.pending = deque()
+        self.eof = False
+
+    def next_chunk(self):
+        """
+            Get the next (chunk, compressed chunk) pair, or (None, None) at the end of the stream.
+        """
+
+        while not self.eof and len(self.pending) < self.window:
+            chunk = self.source.read(self.image.chunk_size)
+            if not chunk:
+                self.eof = True
+                break
+            self.pending.append((chunk, self.pool.submit(self.compress_chunk, chunk) if self.compress else None))
+        if not self.pending:
+            return None, None
+        chunk, future = self.pending.popleft()
+        return chunk, future.result() if future is not None else chunk
+
+    def compress_chunk(self, chunk):
+        start_time = time.perf_counter()
+        compressed_chunk = self.compress(chunk)
+        runMetrics.count("compressed", size=len(chunk), seconds=time.perf_counter() - start_time)
+        return compressed_chunk
+
+
+class BevyStream:
+    """
+        Stream of compressed chunks for one bevy of an AFF4 image. It is pyaff4's `_CompressorStream` with the
+        compression done ahead of time by a `ChunkCompressor`.
+    """
+
+    def __init__(self, image, compressor):
+        self.image = image
+        self.compressor = compressor
+        self.chunk_count_in_bevy = 0
+        self.size = 0
+        self.bevy_index = []
+        self.bevy_length = 0
+
+    def tell(self):
+        return self.size
+
+    def read(self, _):
+        # Stop copying when the bevy is full.
+        if self.chunk_count_in_bevy >= self.image.chunks_per_segment:
+            return b""
+
+        chunk, compressed_chunk = self.compressor.next_chunk()
+        if not chunk:
+            return b""
+
+        self.size += len(chunk)
+        self.chunk_count_in_bevy += 1
+        # pyaff4 only writes `bytes`, so a stored chunk of a mapped file is copied here.
+        if len(compressed_chunk) < self.image.chunk_size - 16:
+            self.bevy_index.append((self.bevy_length, len(compressed_chunk)))
+            self.bevy_length += len(compressed_chunk)
+            return bytes(compressed_chunk)
+
+        # Chunks that don't compress are stored as is, padded so they are never decompressed.
+        chunk = bytes(chunk)
+        if len(chunk) < self.image.chunk_size:
+            chunk += b"\x00" * (self.image.chunk_size - len(chunk))
+        self.bevy_index.append((self.bevy_length, self.image.chunk_size))
+        self.bevy_length += self.image.chunk_size
+        return chunk
+
+
+class Journal:
+    """
+        Checkpoint journal kept next to a container as `<container>.journal`. Every file and folder committed to the
+        container is recorded with its size and hashes, and a checkpoint is written each time the container is closed.
+        Only entries before the last checkpoint are really in the container, so those are the ones a resumed
+        acquisition skips.
+    """
+
+    def __init__(self, container_name):
+        """
+            Constructor for Journal class.
+
+            Parameters:
+                container_name: Path of the container the journal belongs to.
+        """
+
+        self.path = container_name + ".journal"
+        self.entries = {}
+        self.offset = None
+        self.file = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+            Load the entries up to the last checkpoint. Returns False if the journal has no checkpoint.
+        """
+
+        if not os.path.exists(self.path):
+            return False
+        pending = {}
+        offset = 0
+        with open(self.path, "rb") as journal:
+            for line in journal:
+                offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line can be cut off if the acquisition was killed while writing it.
+                    break
+                if "checkpoint" in entry:
+                    self.entries.update(pending)
+                    pending = {}
+                    self.offset = offset
+                else:
+                    pending[entry["path"]] = entry
+        return self.offset is not None
+
+    def open(self, append):
+        """
+            Open the journal for writing. A loaded journal is cut back to its last checkpoint first, so entries that
+            never made it into the container are forgotten.
+
+            Parameters:
+                append: Keep the existing entries, otherwise the journal is started over.
+        """
+
+        if self.offset is not None:
+            self.file = open(self.path, "r+")
+            self.file.truncate(self.offset)
+            self.file.seek(self.offset)
+        else:
+            self.file = open(self.path, "a" if append else "w")
+
+    def record(self, pathname, size, hasher=None):
+        """
+            Record a file or folder that was added to the container.
+
+            Parameters:
+                pathname: Path of the file in the container.
+                size: Size of the file in bytes.
+                hasher: StreamHasher the file was written through, if it is a file.
+        """
+
+        entry = {"path": pathname, "size": size}
+        if hasher is not None:
+            for h in hasher.hashes:
+                entry[str(hasher.hashToType[h]).split("#")[-1].lower()] = h.hexdigest()
+        self.write(entry)
+
+    def checkpoint(self):
+        """
+            Mark everything recorded so far as safely in the container.
+        """
+
+        self.write({"checkpoint": datetime.now().isoformat()})
+
+    def write(self, entry):
+        if self.file is None:
+            return
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ContainerIndex:
+    """
+        SQLite index of the folders and files in an AFF4 volume, with each one's path, URN, size, hashes and
+        timestamps. It is stored in the volume as an extra member when an acquisition finishes, so listing and
+        extracting a container doesn't have to query its metadata one file at a time.
+    """
+
+    COLUMNS = ("path", "urn", "kind", "stream", "size", "sha1", "md5", "last_written", "last_accessed",
+               "record_changed", "birth_time")
+    TIMESTAMPS = (lexicon.standard11.lastWritten, lexicon.standard11.lastAccessed, lexicon.standard11.recordChanged,
+                  lexicon.standard11.birthTime)
+    # Kind of each entry, the type it is stored as and the predicate pointing at the stream holding its contents.
+    KINDS = (("folder", lexicon.standard11.FolderImage, None), ("file", lexicon.standard11.FileImage, None),
+             ("duplicate", DUPLICATE_REFERENCE, DUPLICATE_OF), ("prior", PRIOR_REFERENCE, PRIOR_IMAGE))
+
+    def __init__(self, path, remove=False):
+        """
+            Constructor for ContainerIndex class.
+
+            Parameters:
+                path: Path of the SQLite database.
+                remove: Delete the database when the index is closed.
+        """
+
+        self.path = path
+        self.remove = remove
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+
+    @staticmethod
+    def write(resolver, volume):
+        """
+            Build the index from a volume's metadata and store it in the volume, replacing any older index. Has to be
+            called before the volume is closed.
+        """
+
+        handle, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        index = ContainerIndex(path, remove=True)
+        try:
+            connection = index.connection
+            connection.execute("CREATE TABLE files (%s)" % ", ".join(ContainerIndex.COLUMNS))
+            for kind, image_type, stream_predicate in ContainerIndex.KINDS:
+                for image_urn in resolver.QueryPredicateObject(volume.urn, lexicon.AFF4_TYPE, image_type):
+                    connection.execute("INSERT INTO files VALUES (%s)" % ", ".join("?" * len(ContainerIndex.COLUMNS)),
+                                       ContainerIndex.describe(resolver, volume, image_urn, kind, stream_predicate))
+            connection.execute("CREATE INDEX files_path ON files (path)")
+            connection.commit()
+            index.connection.close()
+
+            member_urn = volume.urn.Append("afflux-index-%s.sqlite" % uuid.uuid4())
+            with resolver.AFF4FactoryOpen(volume.urn) as zip_volume:
+                with zip_volume.CreateMember(member_urn) as member:
+                    member.compression_method = zipfile.ZIP_DEFLATED
+                    with open(path, "rb") as database:
+                        member.WriteStream(database)
+            resolver.Add(volume.urn, member_urn, rdfvalue.URN(lexicon.AFF4_TYPE), rdfvalue.URN(INDEX_TYPE))
+            resolver.Set(volume.urn, member_urn, rdfvalue.URN(lexicon.standard11.lastWritten),
+                         rdfvalue.XSDDateTime(datetime.now(tzlocal.get_localzone())))
+        finally:
+            os.remove(path)
+
+    @staticmethod
+    def describe(resolver, volume, image_urn, kind, stream_predicate=None):
+        """
+            Read one folder or file's row of the index from the volume's metadata.
+        """
+
+        def value(predicate):
+            found = next_or_none(resolver.QuerySubjectPredicate(volume.urn, image_urn, predicate))
+            return None if found is None else utils.SmartUnicode(found.value)
+
+        digests = {}
+        for h in resolver.QuerySubjectPredicate(volume.urn, image_urn, lexicon.standard.hash):
+            digests[str(h.datatype).split("#")[-1].lower()] = utils.SmartUnicode(h.value)
+        size = value(lexicon.AFF4_STREAM_SIZE)
+        return ((value(lexicon.standard11.pathName), utils.SmartUnicode(image_urn), kind,
+                 value(stream_predicate) if stream_predicate is not None else None,
+                 int(size) if size is not None else None, digests.get("sha1"), digests.get("md5"))
+                + tuple(value(predicate) for predicate in ContainerIndex.TIMESTAMPS))
+
+    @staticmethod
+    def load(volume):
+        """
+            Load the index stored in a volume. Returns None if the volume doesn't have one or it can't be read.
+        """
+
+        resolver = volume.resolver
+        members = {}
+        for member_urn in resolver.QueryPredicateObject(volume.urn, lexicon.AFF4_TYPE, INDEX_TYPE):
+            written = next_or_none(resolver.QuerySubjectPredicate(volume.urn, member_urn,
+                                                                  lexicon.standard11.lastWritten))
+            members[member_urn] = parse_datetime(written)
+        if not members or None in members.values():
+            return None
+        member_urn = max(members, key=members.get)
+        handle, path = tempfile.mkstemp(suffix=".sqlite")
+        try:
+            with os.fdopen(handle, "wb") as database:
+                with resolver.AFF4FactoryOpen(member_urn) as member:
+                    shutil.copyfileobj(member, database)
+            return ContainerIndex(path, remove=True)
+        except Exception as e:
+            printUtils.multi_print(Fore.RED + "[-] Unable to read the container's index, querying its metadata "
+                                              "instead: " + Fore.RESET + "%s" % e)
+            os.remove(path)
+            return None
+
+    def summary(self):
+        """
+            Count the entries of each kind and add up their sizes. Returns a dictionary of kind to (count, bytes).
+        """
+
+        query = "SELECT kind, COUNT(*), SUM(size) FROM files GROUP BY kind"
+        return {kind: (count, size or 0) for kind, count, size in self.connection.execute(query)}
+
+    def entries(self, *kinds):
+        """
+            Yield the rows for the given kinds of entries ("folder", "file", "duplicate" or "prior"), as
+            `sqlite3.Row` objects.
+        """
+
+        query = "SELECT * FROM files"
+        if kinds:
+            query += " WHERE kind IN (%s)" % ", ".join("?" * len(kinds))
+        return self.connection.execute(query, kinds)
+
+    @staticmethod
+    def rows(volume, index, *kinds):
+        """
+            Yield the rows for the given kinds of entries from a volume's index, or read them from its metadata if it
+            doesn't have one. Rows read from the metadata are dictionaries with the same keys.
+        """
+
+        if index is not None:
+            yield from index.entries(*kinds)
+            return
+        resolver = volume.resolver
+        for kind, image_type, stream_predicate in ContainerIndex.KINDS:
+            if kind not in kinds:
+                continue
+            for image_urn in resolver.QueryPredicateObject(volume.urn, lexicon.AFF4_TYPE, image_type):
+                yield dict(zip(ContainerIndex.COLUMNS,
+                               ContainerIndex.describe(resolver, volume, image_urn, kind, stream_predicate)))
+
+    @staticmethod
+    def stored_file(row):
+        """
+            Turn a file or duplicate reference's row into a `StoredFile`.
+        """
+
+        timestamps = tuple(rdfvalue.XSDDateTime(row[column]) if row[column] is not None else None
+                           for column in ("last_written", "last_accessed", "record_changed", "birth_time"))
+        return StoredFile(row["path"], row["stream"] or row["urn"], row["size"], row["sha1"], row["md5"], timestamps)
+
+    def close(self):
+        self.connection.close()
+        if self.remove:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ExtractFilter:
+    """
+        Picks the files `Imager.extract_all` extracts by path, hash, size and modified time. Files are matched against
+        the metadata stored for them, so no stream is opened for a file that isn't extracted.
+    """
+
+    def __init__(self, include=None, exclude=None, hashes=None, min_size=None, max_size=None, modified_after=None,
+                 modified_before=None):
+        """
+            Constructor for ExtractFilter class.
+
+            Parameters:
+                include: Globs matched against each file's path in the container, one has to match.
+                exclude: Globs matched against each file's path in the container, none may match.
+                hashes: SHA1 or MD5 hashes, the file has to have one of them.
+                min_size: Smallest size in bytes.
+                max_size: Largest size in bytes.
+                modified_after: Earliest modified time, see `parse_time`.
+                modified_before: Latest modified time, see `parse_time`.
+        """
+
+        self.include = include or []
+        self.exclude = exclude or []
+        self.hashes = {h.lower() for h in hashes or []}
+        self.min_size = min_size
+        self.max_size = max_size
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+
+    @staticmethod
+    def from_arguments(arguments):
+        """
+            Create an ExtractFilter from afflux's parsed arguments. Returns None if no filter was given.
+        """
+
+        filters = ExtractFilter(arguments.include, arguments.exclude, arguments.hash, arguments.min_size,
+                                arguments.max_size, arguments.modified_after, arguments.modified_before)
+        if not (filters.include or filters.exclude or filters.hashes) and all(
+                value is None for value in (filters.min_size, filters.max_size, filters.modified_after,
+                                            filters.modified_before)):
+            return None
+        return filters
+
+    def matches(self, stored):
+        """
+            Check if a `StoredFile` passes the filters.
+        """
+
+        if self.include and not any(fnmatch(stored.path, pattern) for pattern in self.include):
+            return False
+        if any(fnmatch(stored.path, pattern) for pattern in self.exclude):
+            return False
+        if self.hashes and not {stored.sha1, stored.md5} & self.hashes:
+            return False
+        if self.min_size is not None and (stored.size is None or stored.size < self.min_size):
+            return False
+        if self.max_size is not None and (stored.size is None or stored.size > self.max_size):
+            return False
+        if self.modified_after is not None or self.modified_before is not None:
+            modified = parse_datetime(stored.timestamps[0])
+            if modified is None:
+                return False
+            if modified.tzinfo is None:
+                modified = modified.astimezone()
+            if self.modified_after is not None and modified < self.modified_after:
+                return False
+            if self.modified_before is not None and modified > self.modified_before:
+                return False
+        return True
+
+
+def print_volume_info(file, volume):
+    """
+        Print AFF4 volume information.
+    """
+
+    volume_urn = volume.urn
+    printUtils.multi_print("AFF4Container: file://%s <%s>" % (file, str(volume_urn)))
+
+
+def print_turtle(resolver, volume):
+    """
+        Print the data stored in information.turtle.
+
+        Parameters:
+            resolver:
+            volume:
+    """
+
+    metadata_urn = volume.urn.Append("information.turtle")
+    try:
+        with resolver.AFF4FactoryOpen(metadata_urn) as fd:
+            txt = fd.ReadAll()
+            for line in txt.split(b'\n'):
+                if b'aff4://' in line:
+                    printUtils.multi_print(Fore.GREEN + utils.SmartUnicode(line))
+                else:
+                    printUtils.multi_print(utils.SmartUnicode(line))
+    except:
+        pass
+
+
+class Imager:
+    """
+        This class is used to image files and folders using the AFF4 image format. This code is largely from
+        https://github.com/aff4/pyaff4 with more error handling and cross-platform support.
+    """
+
+    def __init__(self, verbose, zip=False, workers=1, resume=False, base=None, dedup=False, compression="auto"):
+        """
+            Constructor for Imager class.
+
+            Parameters:
+                    verbose: Include verbose messages in output.
+                    zip: Write a Zip file instead of an AFF4 container.
+                    workers: Number of threads to read, hash and compress files with.
+                    resume: Continue an interrupted acquisition, skipping what its journal says is in the container.
+                    base: Previous AFF4 image of the device, only files that are new or changed since it are added.
+                    dedup: Store files whose contents are already in the container as references to them.
+                    compression: Policy for picking the codec each file is stored with, see `compression.POLICIES`.
+        """
+
+        self.verbose = verbose
+        self.os = ""
+        self.container_path = ""
+        self.separator = ""
+        self.check_os()
+        self.zip = zip
+        self.workers = max(1, workers or 1)
+        self.pool = None
+        self.resume = resume
+        self.journal = None
+        # Paths already in the container when resuming. Plugins can check it to avoid transferring them at all.
+        self.committed = set()
+        self.base = base
+        self.base_urn = None
+        self.base_index = {}
+        self.base_folders = set()
+        self.base_is_output = False
+        self.incremental_stats = {"changed": 0, "unchanged": 0, "bytes_written": 0, "bytes_skipped": 0,
+                                  "bytes_read": 0}
+        self.dedup = dedup and not zip
+        # SHA1 of each file stored in the container, mapped to its stream URN and hashes.
+        self.digests = {}
+        # Sizes of the files stored so far. Only a file with one of these sizes can be a duplicate.
+        self.digest_sizes = set()
+        self.dedup_stats = {"files": 0, "bytes": 0}
+        self.compression = compression or "auto"
+
+    @staticmethod
+    def from_arguments(arguments, zip=False):
+        """
+            Create an Imager from a plugin's parsed arguments.
+
+            Parameters:
+                arguments: Parsed afflux and plugin arguments.
+                zip: Write a Zip file instead of an AFF4 container.
+        """
+
+        return Imager(arguments.verbose, zip=zip, workers=getattr(arguments, "workers", 1),
+                      resume=getattr(arguments, "resume", False),
+                      base=(getattr(arguments, "incremental", None) or [None])[0],
+                      dedup=getattr(arguments, "dedup", False),
+                      compression=getattr(arguments, "compression", "auto"))
+
+    def check_os(self):
+        """
+            Check and set the OS.
+        """
+
+        self.os = platform.system()
+        if self.os == "Windows":
+            self.separator = "\\"
+        else:
+            self.separator = "/"
+        return True
+
+    def cleanup(self, specified_path=None):
+        """
+            Cleanup any temporary directories.
+
+            Parameters:
+                specified_path: Custom temporary folder if specified.
+        """
+
+        try:
+            username = os.getlogin()
+        except OSError:
+            username = ""
+        if not specified_path:
+            paths = ["/tmp/afflux_files_download",
+                     "C:\\Users\\" + username + "\\AppData\\Local\\Temp\\afflux_files_download"]
+        else:
+            paths = [specified_path[0]]
+        for directory in paths:
+            try:
+                shutil.rmtree(directory)
+                if self.verbose:
+                    print(f"{Fore.GREEN}[+] Cleaned up: {Fore.RESET}{directory}")
+            except FileNotFoundError:
+                continue
+            except PermissionError:
+                printUtils.multi_print(f"{Fore.RED}[-] Could not access temporary folder. Check permissions.\n")
+                return False
+        return True
+
+    def setup_tmp_directory(self, specified_temp_folder, output_file):
+        """
+            Get the temporary directory made and return the output path, old path, and temporary path.
+
+            Parameters:
+                specified_temp_folder: The temporary folder name and location if specified.
+                output_file: Output file name.
+
+            Returns:
+                output_path: Full path to the output AFF4 file.
+                old_path: Original path afflux was launched from.
+                tmp_path: Path to write temporary files.
+        """
+
+        old_path = os.getcwd()
+        if not specified_temp_folder:
+            self.separator = "/"
+            tmp_path = "/tmp/afflux_files_download"
+            if self.os == "Windows":
+                self.separator = "\\"
+                tmp_path = "C:\\Users\\" + os.getlogin() + "\\AppData\\Local\\Temp\\afflux_files_download"
+        else:
+            if self.os == "Windows":
+                self.separator = "\\"
+            else:
+                self.separator = "/"
+            tmp_path = specified_temp_folder[0]
+        os.mkdir(tmp_path)
+        # Check if output file is a positional path or not.
+        if os.path.isabs(output_file):
+            output_path = output_file
+        else:
+            output_path = old_path + self.separator + output_file
+
+        return [output_path, old_path, tmp_path]
+
+    def print_image_metadata(self, resolver, volume, image):
+        """
+            Print all the metadata stored in the AFF4 image.
+
+            Parameters:
+                resolver:
+                volume: AFF4 Image volume
+                image: AFF4 image
+        """
+
+        printUtils.multi_print(Fore.GREEN + "\t%s " % (image.name()) + Fore.RESET + "<%s>"
+                               % (self.trim_volume(volume.urn, image.urn)))
+        with resolver.AFF4FactoryOpen(image.urn) as srcStream:
+            if type(srcStream) == aff4_map.AFF4Map2:
+                source_ranges = sorted(srcStream.tree)
+                for n in source_ranges:
+                    d = n.data
+                    printUtils.multi_print("\t\t[%x,%x] -> %s[%x,%x]" % (
+                        d.map_offset, d.length, srcStream.targets[d.target_id], d.target_offset, d.length))
+
+    def trim_volume(self, volume, image):
+        """
+            Trim the volume.
+
+            Parameters:
+                volume:
+                image:
+        """
+
+        if not self.verbose:
+            vol_string = utils.SmartUnicode(volume)
+            image_string = utils.SmartUnicode(image)
+            if image_string.startswith(vol_string):
+                image_string = image_string[len(vol_string):]
+            return image_string
+        else:
+            return image
+
+    def meta(self, file, password):
+        """
+            Get metadata.
+
+            Parameters:
+                file:
+                password:
+        """
+        with container.Container.openURNtoContainer(rdfvalue.URN.FromFileName(file)) as volume:
+            if password is not None:
+                assert not issubclass(volume.__class__, container.PhysicalImageContainer)
+                print_turtle(volume.resolver, volume)
+                volume.setPassword(password[0])
+                volume = volume.getChildContainer()
+
+            index = ContainerIndex.load(volume)
+            try:
+                if index is None:
+                    print_turtle(volume.resolver, volume)
+                else:
+                    # The turtle repeats every property of every file, the index already has them one row per file.
+                    print_volume_info(file, volume)
+                    self.print_index_summary(index)
+                self.print_images(volume, index)
+            finally:
+                if index is not None:
+                    index.close()
+
+    def print_index_summary(self, index):
+        """
+            Print how many folders, files and references a volume's index lists, in place of its full metadata.
+        """
+
+        counts = index.summary()
+        for kind, label in (("folder", "Folders"), ("file", "Files"), ("duplicate", "Duplicates"),
+                            ("prior", "Unchanged, in the previous image")):
+            files, size = counts.get(kind, (0, 0))
+            if kind == "folder":
+                printUtils.multi_print(Fore.GREEN + "[*] %s: " % label + Fore.RESET + "%d" % files)
+            else:
+                printUtils.multi_print(Fore.GREEN + "[*] %s: " % label + Fore.RESET + "%d, %.2f MB"
+                                       % (files, size / 1048576))
+
+    def print_images(self, volume, index=None):
+        """
+            Print the images in a volume, listing them from its index if it has one. Duplicate references and files
+            stored in the previous image are listed with the stream holding their contents.
+
+            Parameters:
+                volume:
+                index: The volume's `ContainerIndex`, if it was already loaded.
+        """
+
+        if index is None:
+            for image in volume.images():
+                self.print_image_metadata(volume.resolver, volume, image)
+            return
+        for row in index.entries("file", "duplicate", "prior"):
+            line = Fore.GREEN + "\t%s " % row["path"] + Fore.RESET + "<%s>" % self.trim_volume(volume.urn, row["urn"])
+            if row["kind"] == "duplicate":
+                line += Fore.GREEN + " duplicate of " + Fore.RESET + "<%s>" % self.trim_volume(volume.urn,
+                                                                                               row["stream"])
+            elif row["kind"] == "prior":
+                line += Fore.GREEN + " in the previous image " + Fore.RESET + "<%s>" % row["stream"]
+            printUtils.multi_print(line)
+
+    def add_folder_image(self, resolver, volume, pathname, fsmeta):
+        """
+            Add a folder to an AFF4 volume.
+
+            Parameters:
+                resolver:
+                volume:
+                pathname: Path of the folder in the container.
+                fsmeta: FSMetadata for the folder.
+        """
+
+        image_urn = new_image_urn(volume, pathname)
+        fsmeta.urn = image_urn
+        fsmeta.store(resolver)
+        store_unix_attributes(resolver, fsmeta)
+        resolver.Set(volume.urn, image_urn, rdfvalue.URN(lexicon.standard11.pathName),
+                     rdfvalue.XSDString(pathname))
+        resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE),
+                     rdfvalue.URN(lexicon.standard11.FolderImage))
+        resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE),
+                     rdfvalue.URN(lexicon.standard.Image))
+        if self.journal is not None:
+            self.journal.record(pathname, 0)
+        return image_urn
+
+    def store_file_metadata(self, resolver, urn, pathname, fsmeta, hasher):
+        """
+            Store a written file's metadata and hashes, and record it in the journal.
+
+            Parameters:
+                resolver:
+                urn: URN of the written stream.
+                pathname: Path of the file in the container.
+                fsmeta: FSMetadata for the file.
+                hasher: StreamHasher the file was written through.
+        """
+
+        fsmeta.urn = urn
+        fsmeta.store(resolver)
+        store_unix_attributes(resolver, fsmeta)
+        stored = []
+        for h in hasher.hashes:
+            hh = hashes.newImmutableHash(h.hexdigest(), hasher.hashToType[h])
+            resolver.Add(urn, urn, rdfvalue.URN(lexicon.standard.hash), hh)
+            stored.append(hh)
+        if self.dedup:
+            self.register_digest(urn, fsmeta.length, hasher, stored)
+        if self.journal is not None:
+            self.journal.record(pathname, fsmeta.length, hasher)
+        runMetrics.count("transferred", files=1)
+        runMetrics.count("hashed", files=1)
+
+    def write_logical_stream(self, resolver, volume, pathname, src, length):
+        """
+            Write a file to a volume and return its URN. The codec is picked from the file's name and first bytes by
+            the compression policy and recorded with the file. Small files are stored as zip segments, deflated unless
+            the codec is "store", larger ones as AFF4 images with their chunks compressed on the worker pool.
+
+            Parameters:
+                resolver:
+                volume:
+                pathname: Path of the file in the container.
+                src: Readable file like object.
+                length: Size of the file in bytes, as listed.
+        """
+
+        src = PeekedStream(src, compression.SAMPLE_SIZE)
+        codec = compression.choose_codec(self.compression, pathname, src.head)
+        image_urn = new_image_urn(volume, pathname)
+
+        # Zip segments are held in memory until they are written, so a stream that turns out longer than it was
+        # listed is written as an image.
+        if length <= volume.maxSegmentResidentSize and len(src.head) <= length:
+            # Zip segments can only be deflated or stored.
+            codec = "store" if codec == "store" else "deflate"
+            with resolver.AFF4FactoryOpen(volume.urn) as owner:
+                with owner.CreateMember(image_urn) as segment:
+                    segment.compression_method = zipfile.ZIP_STORED if codec == "store" else zipfile.ZIP_DEFLATED
+                    segment.WriteStream(src)
+            image_type = lexicon.AFF4_ZIP_SEGMENT_IMAGE_TYPE
+        else:
+            self.write_image(resolver, volume, image_urn, src, CODECS[codec])
+            image_type = lexicon.AFF4_IMAGE_TYPE
+        resolver.Set(volume.urn, image_urn, rdfvalue.URN(CODEC), rdfvalue.XSDString(codec))
+
+        resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE), rdfvalue.URN(image_type))
+        resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE),
+                     rdfvalue.URN(lexicon.standard11.FileImage))
+        resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE), rdfvalue.URN(lexicon.standard.Image))
+        resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.standard11.pathName), rdfvalue.XSDString(pathname))
+        return image_urn
+
+    def write_image(self, resolver, volume, image_urn, src, compression_method):
+        """
+            Write a stream to a volume as an AFF4 image, with its chunks compressed on the worker pool.
+
+            Parameters:
+                resolver:
+                volume:
+                image_urn: URN of the image.
+                src: Readable file like object.
+                compression_method: AFF4 compression method of the chunks.
+        """
+
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        with aff4_image.AFF4Image.NewAFF4Image(resolver, image_urn, volume.urn) as image:
+            image.compression = compression_method
+            compressor = ChunkCompressor(image, src, self.pool, self.workers * 4)
+            # Same as AFF4Image.WriteStream, a bevy at a time.
+            with resolver.AFF4FactoryOpen(volume.urn) as owner:
+                while True:
+                    bevy_stream = BevyStream(image, compressor)
+                    bevy_urn = image.urn.Append("%08d" % image.bevy_number)
+                    with owner.CreateMember(bevy_urn) as bevy:
+                        bevy.WriteStream(bevy_stream)
+                    image._write_bevy_index(owner, bevy_urn, bevy_stream.bevy_index)
+                    image.bevy_number += 1
+                    image.size += bevy_stream.size
+                    image.writeptr += bevy_stream.size
+                    if bevy_stream.chunk_count_in_bevy != image.chunks_per_segment:
+                        break
+            image._write_metadata()
+        if compressor.compress is not None:
+            runMetrics.count("compressed", files=1)
+
+    def read_ahead(self, pathname):
+        """
+            Start reading and hashing a local file on its own thread, so several files are read and hashed while the
+            volume is written. Returns the hasher and the pipe to write the file from; the hashes are complete once the
+            pipe has been read to the end.
+
+            Parameters:
+                pathname: Path of the file.
+        """
+
+        src = open(pathname, "rb")
+        hasher = MeteredHasher(src, [lexicon.HASH_SHA1, lexicon.HASH_MD5])
+
+        def copy(pipe):
+            try:
+                data = hasher.read(READ_AHEAD_BLOCK)
+                while data:
+                    pipe.write(data)
+                    data = hasher.read(READ_AHEAD_BLOCK)
+            finally:
+                src.close()
+
+        pipe = StreamPipe(copy, max_chunks=16)
+        pipe.start()
+        return hasher, pipe
+
+    def write_read_ahead(self, resolver, volume, pending, error_paths):
+        """
+            Write the oldest file started by `read_ahead` to the volume. Returns False if the machine is out of space.
+
+            Parameters:
+                resolver:
+                volume:
+                pending: Deque of (path name, FSMetadata, hasher, pipe) tuples in the order the files were found.
+                error_paths: List to add errors to.
+        """
+
+        pathname, fsmeta, hasher, pipe = pending.popleft()
+        try:
+            start_time = time.time()
+            urn = self.write_logical_stream(resolver, volume, pathname, pipe, fsmeta.length)
+            self.store_file_metadata(resolver, urn, pathname, fsmeta, hasher)
+            self.count_written(fsmeta, time.time() - start_time)
+        except OSError as e:
+            if "Errno 28" in str(e):
+                printUtils.multi_print(Fore.RED + "[-] Out of storage space on machine.")
+                return False
+            if self.verbose:
+                printUtils.multi_print(Fore.RED + "\tError: Unable to copy: " + Fore.RESET + "%s (%s)" % (pathname, e))
+            error_paths.append("\t[-] Unable to copy: " + Fore.RESET + "%s (%s)" % (pathname, e))
+        except Exception as e:
+            if self.verbose:
+                printUtils.multi_print(Fore.RED + "\tError: Unable to copy: " + Fore.RESET + "%s (%s)" % (pathname, e))
+            error_paths.append("\t[-] Unable to copy: " + Fore.RESET + "%s (%s)" % (pathname, e))
+        finally:
+            pipe.close()
+        return True
+
+    def close_read_ahead(self, pending):
+        """
+            Stop any files still being read ahead.
+        """
+
+        while pending:
+            pending.popleft()[3].close()
+
+    def add_streams_to_volume(self, resolver, volume, streams):
+        """
+            Add files and folders to an AFF4 volume as they are read from a device, without a temporary copy.
+
+            Parameters:
+                resolver:
+                volume:
+                streams: Iterable of (path name, FSMetadata, stream) tuples. The stream is a readable file like object,
+                         a callable that opens one, or None for a folder.
+        """
+
+        error_paths = []
+        for pathname, fsmeta, stream in streams:
+            pathname = utils.SmartUnicode(pathname)
+            if self.is_committed(pathname):
+                if self.verbose:
+                    printUtils.multi_print(Fore.GREEN + "\tAlready added:" + Fore.RESET + " %s" % pathname)
+                if stream is not None:
+                    runMetrics.count(metrics.SKIPPED, 1, fsmeta.length)
+                    if not callable(stream) and hasattr(stream, "close"):
+                        stream.close()
+                continue
+            if stream is None:
+                if self.base_is_output and pathname in self.base_folders:
+                    continue
+                if self.verbose:
+                    printUtils.multi_print(Fore.GREEN + "\tAdding folder:" + Fore.RESET + " %s" % pathname)
+                self.add_folder_image(resolver, volume, pathname, fsmeta)
+                continue
+            if self.skip_unchanged(resolver, volume, pathname, fsmeta):
+                if not callable(stream) and hasattr(stream, "close"):
+                    stream.close()
+                self.incremental_stats["bytes_read"] += received_size(stream, fsmeta.length)
+                continue
+
+            if self.verbose:
+                printUtils.multi_print(Fore.GREEN + "\tAdding:" + Fore.RESET + " %s" % pathname)
+            src = None
+            try:
+                start_time = time.time()
+                src = stream() if callable(stream) else stream
+                data = src
+                if self.needs_digest(fsmeta.length) and fsmeta.length <= DEDUP_BUFFER_SIZE:
+                    # Could be a copy of a stored file, hash it in memory before deciding whether to write it.
+                    read_time = time.perf_counter()
+                    data = io.BytesIO(src.read())
+                    runMetrics.count("transferred", size=data.getbuffer().nbytes,
+                                     seconds=time.perf_counter() - read_time)
+                    if self.add_duplicate(resolver, volume, pathname, fsmeta,
+                                          hashlib.sha1(data.getbuffer()).hexdigest()):
+                        continue
+                hasher = MeteredHasher(data, [lexicon.HASH_SHA1, lexicon.HASH_MD5], transferred=data is src)
+                urn = self.write_logical_stream(resolver, volume, pathname, hasher, fsmeta.length)
+                # The size a plugin lists can be missing or wrong (an HTTP response without a Content-Length), the
+                # stored size is what was actually written.
+                fsmeta.length = hasher.size
+                self.store_file_metadata(resolver, urn, pathname, fsmeta, hasher)
+                self.count_written(fsmeta, time.time() - start_time)
+            except OSError as e:
+                if "Errno 28" in str(e):
+                    printUtils.multi_print(Fore.RED + "[-] Out of storage space on machine.")
+                    return False
+                if self.verbose:
+                    printUtils.multi_print(Fore.RED + "\tError: Unable to copy: " + Fore.RESET + "%s (%s)"
+                                           % (pathname, e))
+                error_paths.append("\t[-] Unable to copy: " + Fore.RESET + "%s (%s)" % (pathname, e))
+            except Exception as e:
+                if self.verbose:
+                    printUtils.multi_print(Fore.RED + "\tError: Unable to copy: " + Fore.RESET + "%s (%s)"
+                                           % (pathname, e))
+                error_paths.append("\t[-] Unable to copy: " + Fore.RESET + "%s (%s)" % (pathname, e))
+            finally:
+                if src is not None and hasattr(src, "close"):
+                    src.close()
+
+        if self.verbose:
+            if error_paths:
+                printUtils.multi_print(Fore.RED + "\n\t[-] Errors:")
+                for path in error_paths:
+                    printUtils.multi_print(Fore.RED + "%s" % path)
+        return True
+
+    def walk_local(self, path_names, recursive, follow_symlinks, error_paths):
+        """
+            Walk local paths breadth first and yield each file and folder to add as (path name, FSMetadata, mode,
+            is_dir) tuples. Folders are read with `os.scandir` so the type of each entry comes from the listing, and
+            the stat it already took is reused for its metadata. Only the folders still to be listed are kept, so the
+            memory used depends on the width of the tree rather than its size. Paths ending in "-" are not imaged.
+
+            Parameters:
+                path_names: Files and folders to add.
+                recursive: Walk every folder, instead of only the contents of the given ones.
+                follow_symlinks: Add what symlinks point to, unless it is already being imaged.
+                error_paths: List the errors are added to.
+        """
+
+        found_container = False
+
+        # Check if the user supplied paths to not image
+        no_image = {pathname[:-1] for pathname in path_names if pathname[-1] == "-"}
+        roots = [utils.SmartUnicode(pathname) for pathname in path_names if pathname[-1] != "-"]
+
+        # Where the given paths really are, so a symlink to something in them is skipped, and the folders walked so
+        # far, so a symlink to a folder further up can't loop.
+        root_targets = [os.path.realpath(pathname) for pathname in roots]
+        walked = set()
+
+        def already_imaged(target):
+            for root in root_targets:
+                if target == root:
+                    return True
+                parent = root.rstrip(os.sep) + os.sep
+                if target.startswith(parent) and (recursive or os.sep not in target[len(parent):]):
+                    return True
+            return False
+
+        # Folders to list, with how deep they are in the walk.
+        frontier = deque()
+        entries = [(pathname, None) for pathname in roots]
+        depth = -1
+        while True:
+            for pathname, entry in entries:
+                if pathname in no_image:
+                    if self.verbose:
+                        printUtils.multi_print(Fore.RED + "\t[*] Skipping path: %s" % pathname)
+                    continue
+                if not found_container and pathname.lower() == self.container_path:
+                    found_container = True
+                    if self.verbose:
+                        printUtils.multi_print(Fore.RED + "\tSkipping our container.")
+                    continue
+                if self.verbose:
+                    printUtils.multi_print(Fore.GREEN + "\tAdding:" + Fore.RESET + " %s" % pathname)
+                try:
+                    is_link = entry.is_symlink() if entry is not None else os.path.islink(pathname)
+                    if is_link:  # Symlink logic
+                        if not follow_symlinks:
+                            if self.verbose:
+                                printUtils.multi_print(Fore.RED + "\tSkipping symlink:" + Fore.RESET + " %s"
+                                                       % pathname)
+                            continue
+                        symlink_target = os.path.realpath(pathname)  # Check if we are already imaging the symlink
+                        if self.verbose:
+                            printUtils.multi_print(Fore.GREEN + "\tFound symlink, points to:" + Fore.RESET
+                                                   + " %s" % symlink_target)
+                        if already_imaged(symlink_target):
+                            if self.verbose:
+                                printUtils.multi_print(Fore.RED + "\tAlready imaging symlink target, skipping:"
+                                                       + Fore.RESET + " %s" % pathname)
+                            continue
+                    # Only a followed symlink needs its target stat, anything else has its stat from the listing.
+                    stat_result = entry.stat(follow_symlinks=is_link) if entry is not None else os.stat(pathname)
+                    fsmeta = stat_metadata(pathname, stat_result)
+                except FileNotFoundError:
+                    if self.verbose:
+                        printUtils.multi_print(Fore.RED + "\tFile not found: " + Fore.RESET + "%s" % pathname)
+                    error_paths.append("\t[-] File not found: " + Fore.RESET + "%s" % pathname)
+                    continue
+                except PermissionError:
+                    if self.verbose:
+                        printUtils.multi_print(Fore.RED + "\tUnable to access: " + Fore.RESET + "%s" % pathname)
+                    error_paths.append("\t[-] Unable to access: " + Fore.RESET + "%s" % pathname)
+                    continue
+                except OSError as e:
+                    if self.verbose:
+                        printUtils.multi_print(Fore.RED + "\tUnable to add: " + Fore.RESET + "%s (%s)" % (pathname, e))
+                    error_paths.append("\t[-] Unable to add: " + Fore.RESET + "%s (%s)" % (pathname, e))
+                    continue
+
+                is_dir = S_ISDIR(stat_result.st_mode)
+                yield pathname, fsmeta, stat_result.st_mode, is_dir
+                # Recursively image. If just a folder is given, the paths and files inside it are still added.
+                if is_dir and (recursive or depth < 0):
+                    if follow_symlinks:
+                        folder_id = (stat_result.st_dev, stat_result.st_ino)
+                        if folder_id in walked:
+                            continue
+                        walked.add(folder_id)
+                    frontier.append((pathname, depth + 1))
+
+            if not frontier:
+                return
+            pathname, depth = frontier.popleft()
+            try:
+                start_time = time.perf_counter()
+                with os.scandir(pathname) as listing:
+                    entries = [(os.path.join(pathname, entry.name), entry) for entry in listing]
+                runMetrics.count("listed", seconds=time.perf_counter() - start_time)
+            except PermissionError:
+                if self.verbose:
+                    printUtils.multi_print(Fore.RED + "\tUnable to access: " + Fore.RESET + "%s" % pathname)
+                error_paths.append("\t[-] Unable to access: " + Fore.RESET + "%s" % pathname)
+                entries = []
+            except OSError as e:
+                if "Errno 22" in str(e):
+                    if self.verbose:
+                        printUtils.multi_print(
+                            Fore.RED + "\tUnable to add, file non-existent: " + Fore.RESET + "%s" % pathname)
+                    error_paths.append(
+                        "\t[-] Unable to add, file non-existent: " + Fore.RESET + "%s" % pathname)
+                else:
+                    printUtils.multi_print(e)
+                entries = []
+
+    def add_path_names_to_volume(self, resolver, volume, path_names, recursive, follow_symlinks=False):
+        """
+            Add paths to an AFF4 file.
+
+            Parameters:
+                resolver:
+                volume:
+                path_names: Files and folders to add, paths ending in "-" are not imaged.
+                recursive:
+                follow_symlinks:
+        """
+
+        error_paths = []
+        # Files being read and hashed ahead of the writer, see `read_ahead`.
+        pending = deque()
+
+        # TODO: Positional path changes?
+        # Imaging for example:
+        #   C:\User\test\Desktop
+        # Will extract to:
+        #   out/c/User/test/Desktop
+        # We should probably not do that.
+        for pathname, fsmeta, mode, is_dir in self.walk_local(path_names, recursive, follow_symlinks, error_paths):
+            if is_dir:
+                if not self.is_committed(pathname) and not (self.base_is_output and pathname in self.base_folders):
+                    self.add_folder_image(resolver, volume, pathname, fsmeta)
+                continue
+
+            runMetrics.count("listed", 1, fsmeta.length)
+            if self.is_committed(pathname):
+                if self.verbose:
+                    printUtils.multi_print(Fore.GREEN + "\tAlready added:" + Fore.RESET + " %s" % pathname)
+                runMetrics.count(metrics.SKIPPED, 1, fsmeta.length)
+                continue
+            if self.skip_unchanged(resolver, volume, pathname, fsmeta):
+                continue
+            if S_ISCHR(mode) or S_ISFIFO(mode) or S_ISBLK(mode) or S_ISPORT(mode) or S_ISSOCK(mode):
+                if self.verbose:
+                    printUtils.multi_print(Fore.RED + "\tError: Pipe or descriptor file: %s" % pathname)
+                error_paths.append("\t[-] Pipe or descriptor file: %s" % pathname)
+                continue
+            try:
+                copy = None
+                if self.needs_digest(fsmeta.length):
+                    # Could be a copy of a stored file, hash it as it is read and write it from what was read.
+                    copy, digest = read_local_copy(pathname)
+                    # The file it is a copy of may still be being read ahead.
+                    while pending and digest not in self.digests:
+                        if not self.write_read_ahead(resolver, volume, pending, error_paths):
+                            copy.close()
+                            self.close_read_ahead(pending)
+                            return False
+                    if self.add_duplicate(resolver, volume, pathname, fsmeta, digest):
+                        copy.close()
+                        continue
+                # Large files are mapped and hashed in place rather than copied through a read ahead thread.
+                elif self.workers > 1 and fsmeta.length < MMAP_THRESHOLD:
+                    pending.append((pathname, fsmeta) + self.read_ahead(pathname))
+                    if len(pending) >= self.workers:
+                        if not self.write_read_ahead(resolver, volume, pending, error_paths):
+                            self.close_read_ahead(pending)
+                            return False
+                    continue
+                start_time = time.time()
+                with copy if copy is not None else open_local(pathname, fsmeta.length) as src:
+                    hasher = local_hasher(src) if copy is None else \
+                        MeteredHasher(src, [lexicon.HASH_SHA1, lexicon.HASH_MD5], transferred=False)
+                    try:
+                        urn = self.write_logical_stream(resolver, volume, pathname, hasher, fsmeta.length)
+                    except OSError as e:
+                        if "Errno 28" in str(e):
+                            printUtils.multi_print(Fore.RED + "[-] Out of storage space on machine.")
+                            return False
+                    self.store_file_metadata(resolver, urn, pathname, fsmeta, hasher)
+                self.count_written(fsmeta, time.time() - start_time)
+            except PermissionError:
+                if self.verbose:
+                    printUtils.multi_print(Fore.RED + "\tError: Unable to access: " + Fore.RESET + "%s" % pathname)
+                error_paths.append("\t[-] Unable to access: " + Fore.RESET + "%s" % pathname)
+                continue
+            except OSError as e:
+                if "Errno 22" in str(e):
+                    if self.verbose:
+                        printUtils.multi_print(Fore.RED + "\tError: Unable to add, file non-existent: "
+                                               + Fore.RESET + "%s" % pathname)
+                    error_paths.append("\t[-] Unable to add, file non-existent: " + Fore.RESET + "%s" % pathname)
+                    continue
+                if "Errno 6" in str(e):
+                    if self.verbose:
+                        printUtils.multi_print(Fore.RED + "\tError: No such device or address: " + Fore.RESET
+                                               + "%s" % pathname)
+                    error_paths.append("\t[-] No such device or address: " + Fore.RESET + "%s" % pathname)
+                    continue
+                if "Errno 123" in str(e):
+                    if self.verbose:
+                        printUtils.multi_print(Fore.RED + "\tError: No medium found: " + Fore.RESET + "%s"
+                                               % pathname)
+                    error_paths.append("\t[-] No medium found: " + Fore.RESET + "%s" % pathname)
+                    continue
+                else:
+                    printUtils.multi_print(e)
+                    exit()
+        while pending:
+            if not self.write_read_ahead(resolver, volume, pending, error_paths):
+                self.close_read_ahead(pending)
+                return False
+        if self.verbose:
+            if error_paths:
+                printUtils.multi_print(Fore.RED + "\n\t[-] Errors:")
+                for path in error_paths:
+                    printUtils.multi_print(Fore.RED + "%s" % path)
+
+    def add_path_names_to_zip(self, zip_name, path_names, recursive, follow_symlinks=False):
+        """
+            Add paths to a Zip container, walked the same way as for an AFF4 container. Files are deflated on the
+            worker pool and their hashes are listed in the container's manifest, see `zip_container.ZipWriter`.
+
+            Parameters:
+                zip_name: Path of the zip file.
+                path_names: Files and folders to add, paths ending in "-" are not imaged.
+                recursive:
+                follow_symlinks:
+        """
+
+        error_paths = []
+        self.container_path = os.path.abspath(zip_name).lower()
+        with zip_container.ZipWriter(zip_name, self.workers, self.compression) as zip_writer:
+            for pathname, fsmeta, mode, is_dir in self.walk_local(path_names, recursive, follow_symlinks,
+                                                                  error_paths):
+                if is_dir:
+                    zip_writer.add_folder(pathname, fsmeta, mode)
+                    continue
+                runMetrics.count("listed", 1, fsmeta.length)
+                if S_ISCHR(mode) or S_ISFIFO(mode) or S_ISBLK(mode) or S_ISPORT(mode) or S_ISSOCK(mode):
+                    if self.verbose:
+                        printUtils.multi_print(Fore.RED + "\tError: Pipe or descriptor file: %s" % pathname)
+                    error_paths.append("\t[-] Pipe or descriptor file: %s" % pathname)
+                    continue
+                try:
+                    start_time = time.time()
+                    with open_local(pathname, fsmeta.length) as src:
+                        zip_writer.add_file(pathname, fsmeta, src, mode)
+                    self.count_written(fsmeta, time.time() - start_time)
+                except OSError as e:
+                    if "Errno 28" in str(e):
+                        printUtils.multi_print(Fore.RED + "[-] Out of storage space on machine.")
+                        return False
+                    if self.verbose:
+                        printUtils.multi_print(Fore.RED + "\tError: Unable to copy: " + Fore.RESET + "%s (%s)"
+                                               % (pathname, e))
+                    error_paths.append("\t[-] Unable to copy: " + Fore.RESET + "%s (%s)" % (pathname, e))
+
+        if self.verbose:
+            if error_paths:
+                printUtils.multi_print(Fore.RED + "\n\t[-] Errors:")
+                for path in error_paths:
+                    printUtils.multi_print(Fore.RED + "%s" % path)
+        return True
+
+    def add_path_names(self, container_name, path_names, recursive, append, password, continuing=False,
+                       symlinks=False):
+        """
+            Add paths to a volume.
+
+            Parameters:
+                container_name:
+                path_names:
+                recursive:
+                append:
+                password:
+                continuing:
+                symlinks:
+        """
+
+        append = self.check_resume(container_name, append)
+        if append is None or not self.load_base(container_name, password):
+            return False
+        append = append or self.base_is_output
+
+        try:
+            if self.zip:
+                return self.add_path_names_to_zip(self.zip_name(container_name), path_names, recursive,
+                                                  follow_symlinks=symlinks)
+        except IsADirectoryError:
+            printUtils.multi_print(Fore.RED + "[-] Error: " + Fore.RESET + container_name + " is a directory.")
+            return False
+
+        with self.open_volume(container_name, append, password, continuing=continuing) as (resolver, volume):
+            self.add_path_names_to_volume(resolver, volume, path_names, recursive, follow_symlinks=symlinks)
+        self.print_incremental_stats()
+        self.print_dedup_stats()
+        return True
+
+    def add_streams(self, container_name, streams, append, password, continuing=False):
+        """
+            Add files and folders to a container straight from a plugin as they are transferred.
+
+            Parameters:
+                container_name:
+                streams: Iterable of (path name, FSMetadata, stream) tuples, see `add_streams_to_volume`.
+                append:
+                password:
+                continuing:
+        """
+
+        append = self.check_resume(container_name, append)
+        if append is None or not self.load_base(container_name, password):
+            return False
+        append = append or self.base_is_output
+
+        try:
+            if self.zip:
+                with zip_container.ZipWriter(self.zip_name(container_name), self.workers,
+                                             self.compression) as zip_writer:
+                    return self.add_streams_to_zip(zip_writer, streams)
+        except IsADirectoryError:
+            printUtils.multi_print(Fore.RED + "[-] Error: " + Fore.RESET + container_name + " is a directory.")
+            return False
+
+        with self.open_volume(container_name, append, password, continuing=continuing) as (resolver, volume):
+            result = self.add_streams_to_volume(resolver, volume, streams)
+        self.print_incremental_stats()
+        self.print_dedup_stats()
+        return result
+
+    def add_streams_to_zip(self, zip_writer, streams):
+        """
+            Add files and folders to a Zip container as they are read from a device. A file that fails part way is
+            kept with what was read and marked incomplete in the container's manifest, see `zip_container.ZipWriter`.
+
+            Parameters:
+                zip_writer: ZipWriter of the container.
+                streams: Iterable of (path name, FSMetadata, stream) tuples, see `add_streams_to_volume`.
+        """
+
+        error_paths = []
+        for pathname, fsmeta, stream in streams:
+            if self.verbose:
+                printUtils.multi_print(Fore.GREEN + "\tAdding: " + Fore.RESET + pathname)
+            if stream is None:
+                zip_writer.add_folder(pathname, fsmeta)
+                continue
+            src = None
+            try:
+                start_time = time.time()
+                src = stream() if callable(stream) else stream
+                size = zip_writer.add_file(pathname, fsmeta, src)[0]
+                runMetrics.count("written", 1, size, time.time() - start_time)
+            except OSError as e:
+                if "Errno 28" in str(e):
+                    printUtils.multi_print(Fore.RED + "[-] Out of storage space on machine.")
+                    return False
+                if self.verbose:
+                    printUtils.multi_print(Fore.RED + "\tError: Unable to copy: " + Fore.RESET + "%s (%s)"
+                                           % (pathname, e))
+                error_paths.append("\t[-] Unable to copy: " + Fore.RESET + "%s (%s)" % (pathname, e))
+            except Exception as e:
+                if self.verbose:
+                    printUtils.multi_print(Fore.RED + "\tError: Unable to copy: " + Fore.RESET + "%s (%s)"
+                                           % (pathname, e))
+                error_paths.append("\t[-] Unable to copy: " + Fore.RESET + "%s (%s)" % (pathname, e))
+            finally:
+                if src is not None and hasattr(src, "close"):
+                    src.close()
+
+        if self.verbose:
+            if error_paths:
+                printUtils.multi_print(Fore.RED + "\n\t[-] Errors:")
+                for path in error_paths:
+                    printUtils.multi_print(Fore.RED + "%s" % path)
+        return True
+
+    def zip_name(self, container_name):
+        """
+            Get the zip file name to use for a container name.
+        """
+
+        if ".zip" not in container_name:
+            return container_name.replace(".aff4", ".zip")
+        return container_name.replace(".aff4", "")
+
+    def check_resume(self, container_name, append):
+        """
+            Load the journal of the container being resumed. Returns whether the container should be appended to, or
+            None if it can't be resumed.
+
+            Parameters:
+                container_name:
+                append:
+        """
+
+        if not self.resume:
+            return append
+        if self.zip:
+            printUtils.multi_print(Fore.RED + "[-] Resuming is only supported for AFF4 containers.")
+            return None
+        if not os.path.exists(container_name):
+            printUtils.multi_print(Fore.GREEN + "[*] Nothing to resume, creating a new container.")
+            return False
+        journal = Journal(container_name)
+        if not journal.load():
+            printUtils.multi_print(Fore.RED + "[-] The container was not closed cleanly and can't be resumed: "
+                                   + Fore.RESET + container_name)
+            return None
+        self.journal = journal
+        self.committed.update(journal.entries)
+        printUtils.multi_print(Fore.GREEN + "[*] Resuming, " + Fore.RESET + str(len(journal.entries)) + Fore.GREEN
+                               + " files and folders are already in the container.")
+        return True
+
+    def load_base(self, container_name, password):
+        """
+            Load the file index of the image an incremental acquisition is based on: the size, modified time and hashes
+            of each file, keyed by path. Returns False if the image can't be read.
+
+            Parameters:
+                container_name: Container being written.
+                password:
+        """
+
+        if self.base is None:
+            return True
+        if self.zip:
+            printUtils.multi_print(Fore.RED + "[-] Incremental acquisition is only supported for AFF4 containers.")
+            return False
+        self.base_is_output = os.path.abspath(self.base) == os.path.abspath(container_name)
+        try:
+            with container.Container.openURNtoContainer(rdfvalue.URN.FromFileName(self.base)) as volume:
+                if password is not None:
+                    volume.setPassword(password[0])
+                    volume = volume.getChildContainer()
+                resolver = volume.resolver
+                self.base_urn = volume.urn
+                for image_urn in resolver.QueryPredicateObject(volume.urn, lexicon.AFF4_TYPE,
+                                                               lexicon.standard11.FolderImage):
+                    path_name = next_or_none(resolver.QuerySubjectPredicate(volume.urn, image_urn,
+                                                                            lexicon.standard11.pathName))
+                    if path_name is not None:
+                        self.base_folders.add(utils.SmartUnicode(path_name.value))
+                for image_urn in resolver.QueryPredicateObject(volume.urn, lexicon.AFF4_TYPE,
+                                                               lexicon.standard11.FileImage):
+                    path_name = next_or_none(resolver.QuerySubjectPredicate(volume.urn, image_urn,
+                                                                            lexicon.standard11.pathName))
+                    if path_name is None:
+                        continue
+                    size = next_or_none(resolver.QuerySubjectPredicate(volume.urn, image_urn,
+                                                                       lexicon.AFF4_STREAM_SIZE))
+                    last_written = next_or_none(resolver.QuerySubjectPredicate(volume.urn, image_urn,
+                                                                               lexicon.standard11.lastWritten))
+                    self.base_index[utils.SmartUnicode(path_name.value)] = {
+                        "urn": image_urn,
+                        "size": int(size.value) if size is not None else None,
+                        "last_written": parse_datetime(last_written),
+                        "hashes": list(resolver.QuerySubjectPredicate(volume.urn, image_urn, lexicon.standard.hash))
+                    }
+        except Exception as e:
+            printUtils.multi_print(Fore.RED + "[-] Unable to read the previous image: " + Fore.RESET
+                                   + "%s (%s)" % (self.base, e))
+            return False
+        printUtils.multi_print(Fore.GREEN + "[*] Incremental acquisition against " + Fore.RESET + self.base
+                               + Fore.GREEN + ", " + Fore.RESET + str(len(self.base_index)) + Fore.GREEN
+                               + " files in the previous image.")
         return True
 
-    def setup_tmp_directory(self, specified_temp_folder, output_file):
+    def is_unchanged(self, pathname, fsmeta):
+        """
+            Check if a file is in the previous image with the same size and modified time.
         """
-            Get the temporary directory made and return the output path, old path, and temporary path.
 
-            Parameters:
-                specified_temp_folder: The temporary folder name and location if specified.
-                output_file: Output file name.
+        entry = self.base_index.get(pathname)
+        last_written = getattr(fsmeta, "lastWritten", None)
+        if entry is None or entry["size"] != fsmeta.length or entry["last_written"] is None or last_written is None:
+            return False
+        return int(entry["last_written"].timestamp()) == int(last_written.timestamp())
 
-            Returns:
-                output_path: Full path to the output AFF4 file.
-                old_path: Original path afflux was launched from.
-                tmp_path: Path to write temporary files.
+    def skip_unchanged(self, resolver, volume, pathname, fsmeta):
+        """
+            Skip a file that hasn't changed since the previous image. If the previous image is a different container,
+            the file is recorded as a reference to it. Returns True if the file was skipped.
         """
 
-        old_path = os.getcwd()
-        if not specified_temp_folder:
-            self.separator = "/"
-            tmp_path = "/tmp/afflux_files_download"
-            if self.os == "Windows":
-                self.separator = "\\"
-                tmp_path = "C:\\Users\\" + os.getlogin() + "\\AppData\\Local\\Temp\\afflux_files_download"
-        else:
-            if self.os == "Windows":
-                self.separator = "\\"
-            else:
-                self.separator = "/"
-            tmp_path = specified_temp_folder[0]
-        os.mkdir(tmp_path)
-        # Check if output file is a positional path or not.
-        if os.path.isabs(output_file):
-            output_path = output_file
-        else:
-            output_path = old_path + self.separator + output_file
-
-        return [output_path, old_path, tmp_path]
+        if not self.base_index or not self.is_unchanged(pathname, fsmeta):
+            return False
+        if self.verbose:
+            printUtils.multi_print(Fore.GREEN + "\tUnchanged:" + Fore.RESET + " %s" % pathname)
+        if not self.base_is_output:
+            self.add_prior_reference(resolver, volume, pathname, fsmeta, self.base_index[pathname])
+        self.incremental_stats["unchanged"] += 1
+        self.incremental_stats["bytes_skipped"] += fsmeta.length
+        runMetrics.count(metrics.SKIPPED, 1, fsmeta.length)
+        return True
 
-    def print_image_metadata(self, resolver, volume, image):
+    def add_prior_reference(self, resolver, volume, pathname, fsmeta, entry):
         """
-            Print all the metadata stored in the AFF4 image.
+            Record a file as a reference to the same file in the previous image, with its metadata and hashes.
 
             Parameters:
                 resolver:
-                volume: AFF4 Image volume
-                image: AFF4 image
+                volume:
+                pathname: Path of the file in the container.
+                fsmeta: FSMetadata for the file.
+                entry: The file's entry in the previous image's index.
         """
 
-        printUtils.multi_print(Fore.GREEN + "\t%s " % (image.name()) + Fore.RESET + "<%s>"
-                               % (self.trim_volume(volume.urn, image.urn)))
-        with resolver.AFF4FactoryOpen(image.urn) as srcStream:
-            if type(srcStream) == aff4_map.AFF4Map2:
-                source_ranges = sorted(srcStream.tree)
-                for n in source_ranges:
-                    d = n.data
-                    printUtils.multi_print("\t\t[%x,%x] -> %s[%x,%x]" % (
-                        d.map_offset, d.length, srcStream.targets[d.target_id], d.target_offset, d.length))
-
-    def trim_volume(self, volume, image):
+        image_urn = new_image_urn(volume, pathname)
+        fsmeta.urn = image_urn
+        fsmeta.store(resolver)
+        store_unix_attributes(resolver, fsmeta)
+        resolver.Set(volume.urn, image_urn, rdfvalue.URN(lexicon.standard11.pathName), rdfvalue.XSDString(pathname))
+        resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE), rdfvalue.URN(PRIOR_REFERENCE))
+        resolver.Set(volume.urn, image_urn, rdfvalue.URN(PRIOR_IMAGE), rdfvalue.URN(entry["urn"]))
+        resolver.Set(volume.urn, image_urn, rdfvalue.URN(PRIOR_VOLUME), rdfvalue.URN(self.base_urn))
+        for h in entry["hashes"]:
+            resolver.Add(image_urn, image_urn, rdfvalue.URN(lexicon.standard.hash), h)
+        if self.journal is not None:
+            self.journal.record(pathname, fsmeta.length)
+
+    def needs_digest(self, length):
         """
-            Trim the volume.
-
-            Parameters:
-                volume:
-                image:
+            With deduplication, check if a file has to be hashed before it is written. Only a file the size of one that
+            was already seen can be a copy of it, so every other file is written and hashed in one pass as usual.
         """
 
-        if not self.verbose:
-            vol_string = utils.SmartUnicode(volume)
-            image_string = utils.SmartUnicode(image)
-            if image_string.startswith(vol_string):
-                image_string = image_string[len(vol_string):]
-            return image_string
-        else:
-            return image
+        if not self.dedup or not length:
+            return False
+        if length in self.digest_sizes:
+            return True
+        self.digest_sizes.add(length)
+        return False
 
-    def meta(self, file, password):
+    def register_digest(self, urn, length, hasher, stored):
         """
-            Get metadata.
+            Remember a stored file's SHA1 so later copies of it can reference its stream.
 
             Parameters:
-                file:
-                password:
+                urn: URN of the written stream.
+                length: Size of the file in bytes.
+                hasher: StreamHasher the file was written through.
+                stored: The file's hashes as stored in the container.
         """
-        with container.Container.openURNtoContainer(rdfvalue.URN.FromFileName(file)) as volume:
-            print_turtle(volume.resolver, volume)
 
-            if password is not None:
-                assert not issubclass(volume.__class__, container.PhysicalImageContainer)
-                volume.setPassword(password[0])
-                child_volume = volume.getChildContainer()
-                print_turtle(child_volume.resolver, child_volume)
-                for image in child_volume.images():
-                    self.print_image_metadata(child_volume.resolver, child_volume, image)
-            else:
-                for image in volume.images():
-                    self.print_image_metadata(volume.resolver, volume, image)
+        for h in hasher.hashes:
+            if hasher.hashToType[h] == lexicon.HASH_SHA1:
+                self.digests.setdefault(h.hexdigest(), {"urn": urn, "hashes": stored})
+        self.digest_sizes.add(length)
 
-    def add_path_names_to_volume(self, resolver, volume, path_names, recursive, follow_symlinks=False):
+    def add_duplicate(self, resolver, volume, pathname, fsmeta, digest):
         """
-            Add a path to an AFF4 file.
+            Record a file whose contents are already in the container as a reference to the stream they are stored in,
+            with its own metadata and the stream's hashes. Returns False if no file with the same SHA1 was stored.
 
             Parameters:
                 resolver:
                 volume:
-                path_names:
-                recursive:
-                follow_symlinks:
+                pathname: Path of the file in the container.
+                fsmeta: FSMetadata for the file.
+                digest: SHA1 of the file as a hex string.
         """
 
-        fsmeta = None
-        error_paths = []
-        no_image = []
-        found_container = False
-        first_run = True
+        entry = self.digests.get(digest)
+        if entry is None:
+            return False
+        if self.verbose:
+            printUtils.multi_print(Fore.GREEN + "\tDuplicate of:" + Fore.RESET + " %s (%s)" % (entry["urn"], pathname))
+        image_urn = new_image_urn(volume, pathname)
+        fsmeta.urn = image_urn
+        fsmeta.store(resolver)
+        store_unix_attributes(resolver, fsmeta)
+        resolver.Set(volume.urn, image_urn, rdfvalue.URN(lexicon.standard11.pathName), rdfvalue.XSDString(pathname))
+        resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE), rdfvalue.URN(DUPLICATE_REFERENCE))
+        resolver.Set(volume.urn, image_urn, rdfvalue.URN(DUPLICATE_OF), rdfvalue.URN(entry["urn"]))
+        for h in entry["hashes"]:
+            resolver.Add(image_urn, image_urn, rdfvalue.URN(lexicon.standard.hash), h)
+        if self.journal is not None:
+            self.journal.record(pathname, fsmeta.length)
+        self.dedup_stats["files"] += 1
+        self.dedup_stats["bytes"] += fsmeta.length
+        runMetrics.count(metrics.SKIPPED, 1, fsmeta.length)
+        return True
 
-        # Check if the user supplied paths to not image
-        for pathname in path_names:
-            if pathname[-1] == "-":
-                no_image.append(pathname[:-1])
+    def print_dedup_stats(self):
+        """
+            Print how many files were stored as references to a copy already in the container.
+        """
 
-        # Remove them from the main path list to image
-        for path in no_image:
-            path_names.remove(path + "-")
+        if self.dedup:
+            printUtils.multi_print(Fore.GREEN + "[*] Duplicates: " + Fore.RESET + "%d files, %.2f MB not stored again"
+                                   % (self.dedup_stats["files"], self.dedup_stats["bytes"] / 1048576))
 
-        # Skip the specified paths
-        # TODO: Positional path changes?
-        # Imaging for example:
-        #   C:\User\test\Desktop
-        # Will extract to:
-        #   out/c/User/test/Desktop
-        # We should probably not do that.
-        for pathname in path_names:
-            if pathname in no_image:
-                if self.verbose:
-                    printUtils.multi_print(Fore.RED + "\t[*] Skipping path: %s" % pathname)
-                continue
+    def count_written(self, fsmeta, seconds):
+        """
+            Count a file written to the container, for the run's metrics and an incremental acquisition's statistics.
+        """
 
-            if not os.access(pathname, os.R_OK):
-                if self.verbose:
-                    printUtils.multi_print(Fore.RED + "\tUnable to access: " + Fore.RESET + "%s" % pathname)
-                error_paths.append("\t[-] Unable to access: " + Fore.RESET + "%s" % pathname)
-                continue
-            if not found_container:
-                if pathname.lower() == self.container_path:
-                    found_container = True
-                    if self.verbose:
-                        printUtils.multi_print(Fore.RED + "\tSkipping our container.")
-                    continue
-            pathname = utils.SmartUnicode(pathname)
-            if self.verbose:
-                printUtils.multi_print(Fore.GREEN + "\tAdding:" + Fore.RESET + " %s" % pathname)
-            try:
-                fsmeta = logical.FSMetadata.create(pathname)
-            except FileNotFoundError:
-                if self.verbose:
-                    printUtils.multi_print(Fore.RED + "\tFile not found: " + Fore.RESET + "%s" % pathname)
-                error_paths.append("\t[-] File not found: " + Fore.RESET + "%s" % pathname)
-                continue
-            if os.path.islink(pathname):  # Symlink logic
-                if not follow_symlinks:
-                    if self.verbose:
-                        printUtils.multi_print(Fore.RED + "\tSkipping symlink:" + Fore.RESET + " %s" % pathname)
-                    continue
-                else:
-                    symlink_target = os.readlink(pathname)  # Check if we are already imaging the symlink
-                    ignore_symlink = False
-                    if self.verbose:
-                        printUtils.multi_print(Fore.GREEN + "\tFound symlink, points to:" + Fore.RESET
-                                               + " %s" % symlink_target)
-                    for name in path_names:
-                        if name in symlink_target:
-                            if self.verbose:
-                                printUtils.multi_print(Fore.RED + "\tAlready imaging symlink target, skipping:"
-                                                       + Fore.RESET + " %s" % pathname)
-                            ignore_symlink = True
-                            break
-                    if ignore_symlink:
-                        continue
+        runMetrics.count("written", 1, fsmeta.length, seconds)
+        if self.base is not None:
+            self.incremental_stats["changed"] += 1
+            self.incremental_stats["bytes_written"] += fsmeta.length
+            self.incremental_stats["bytes_read"] += fsmeta.length
 
-            if os.path.isdir(pathname):
-                if volume.isAFF4Collision(pathname):
-                    image_urn = rdfvalue.URN("aff4://%s" % uuid.uuid4())
-                else:
-                    image_urn = volume.urn.Append(escaping.arnPathFragment_from_path(pathname), quote=False)
-
-                fsmeta.urn = image_urn
-                fsmeta.store(resolver)
-                resolver.Set(volume.urn, image_urn, rdfvalue.URN(lexicon.standard11.pathName),
-                             rdfvalue.XSDString(pathname))
-                resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE),
-                             rdfvalue.URN(lexicon.standard11.FolderImage))
-                resolver.Add(volume.urn, image_urn, rdfvalue.URN(lexicon.AFF4_TYPE),
-                             rdfvalue.URN(lexicon.standard.Image))
-                # Recursively image. If just a single folder is specified, we still need to get the paths and files
-                # inside it at least once, use first_run for that.
-                if recursive or first_run:
-                    try:
-                        first_run = False
-                        for child in os.listdir(pathname):
-                            path_names.append(os.path.join(pathname, child))
-                    except PermissionError:
-                        if self.verbose:
-                            printUtils.multi_print(Fore.RED + "\tUnable to access: " + Fore.RESET + "%s" % pathname)
-                        error_paths.append("\t[-] Unable to access: " + Fore.RESET + "%s" % pathname)
-                        continue
-                    except OSError as e:
-                        if "Errno 22" in str(e):
-                            if self.verbose:
-                                printUtils.multi_print(
-                                    Fore.RED + "\tUnable to add, file non-existent: " + Fore.RESET + "%s" % pathname)
-                            error_paths.append(
-                                "\t[-] Unable to add, file non-existent: " + Fore.RESET + "%s" % pathname)
-                            continue
-                        else:
-                            print(e)
-            else:
-                try:
-                    mode = os.stat(pathname).st_mode
-                    if S_ISCHR(mode) or S_ISFIFO(mode) or S_ISBLK(mode) or S_ISPORT(mode) or S_ISSOCK(mode):
-                        if self.verbose:
-                            printUtils.multi_print(Fore.RED + "\tError: Pipe or descriptor file: %s" % pathname)
-                        error_paths.append("\t[-] Pipe or descriptor file: %s" % pathname)
-                        continue
-                    with open(pathname, "rb") as src:
-                        hasher = linear_hasher.StreamHasher(src, [lexicon.HASH_SHA1, lexicon.HASH_MD5])
-                        try:
-                            urn = volume.writeLogicalStream(pathname, hasher, fsmeta.length)
-                        except OSError as e:
-                            if "Errno 28" in str(e):
-                                printUtils.multi_print(Fore.RED + "[-] Out of storage space on machine.")
-                                return False
-                        fsmeta.urn = urn
-                        fsmeta.store(resolver)
-                        for h in hasher.hashes:
-                            hh = hashes.newImmutableHash(h.hexdigest(), hasher.hashToType[h])
-                            resolver.Add(urn, urn, rdfvalue.URN(lexicon.standard.hash), hh)
-                except PermissionError:
-                    if self.verbose:
-                        printUtils.multi_print(Fore.RED + "\tError: Unable to access: " + Fore.RESET + "%s" % pathname)
-                    error_paths.append("\t[-] Unable to access: " + Fore.RESET + "%s" % pathname)
-                    continue
-                except OSError as e:
-                    if "Errno 22" in str(e):
-                        if self.verbose:
-                            printUtils.multi_print(Fore.RED + "\tError: Unable to add, file non-existent: "
-                                                   + Fore.RESET + "%s" % pathname)
-                        error_paths.append("\t[-] Unable to add, file non-existent: " + Fore.RESET + "%s" % pathname)
-                        continue
-                    if "Errno 6" in str(e):
-                        if self.verbose:
-                            printUtils.multi_print(Fore.RED + "\tError: No such device or address: " + Fore.RESET
-                                                   + "%s" % pathname)
-                        error_paths.append("\t[-] No such device or address: " + Fore.RESET + "%s" % pathname)
-                        continue
-                    if "Errno 123" in str(e):
-                        if self.verbose:
-                            printUtils.multi_print(Fore.RED + "\tError: No medium found: " + Fore.RESET + "%s"
-                                                   % pathname)
-                        error_paths.append("\t[-] No medium found: " + Fore.RESET + "%s" % pathname)
-                        continue
-                    else:
-                        printUtils.multi_print(e)
-                        exit()
-        if self.verbose:
-            if error_paths:
-                printUtils.multi_print(Fore.RED + "\n\t[-] Errors:")
-                for path in error_paths:
-                    printUtils.multi_print(Fore.RED + "%s" % path)
+    def print_incremental_stats(self):
+        """
+            Print how much an incremental acquisition read from the source and, if enough was transferred to measure
+            the transfer rate, roughly how much time not reading the unchanged files saved.
+        """
 
-    def add_path_names(self, container_name, path_names, recursive, append, password, continuing=False,
-                       symlinks=False):
+        if self.base is None:
+            return
+        stats = self.incremental_stats
+        # Unchanged files that came in a tar stream, or whose transfer had already started, were read all the same.
+        not_read = max(0, stats["bytes_written"] + stats["bytes_skipped"] - stats["bytes_read"])
+        printUtils.multi_print(Fore.GREEN + "[*] New or changed: " + Fore.RESET + "%d files, %.2f MB written"
+                               % (stats["changed"], stats["bytes_written"] / 1048576))
+        printUtils.multi_print(Fore.GREEN + "[*] Unchanged: " + Fore.RESET + "%d files, %.2f MB "
+                               "(%.2f MB not transferred)"
+                               % (stats["unchanged"], stats["bytes_skipped"] / 1048576, not_read / 1048576))
+        printUtils.multi_print(Fore.GREEN + "[*] Read from the source: " + Fore.RESET + "%.2f MB"
+                               % (stats["bytes_read"] / 1048576))
+        transferred, seconds = runMetrics.totals("transferred")
+        if not_read and transferred >= ESTIMATE_MIN_BYTES and seconds >= ESTIMATE_MIN_SECONDS:
+            printUtils.multi_print(Fore.GREEN + "[*] Time saved: " + Fore.RESET + "about %s at %.2f MB/s"
+                                   % (str(timedelta(seconds=int(not_read / (transferred / seconds)))),
+                                      transferred / seconds / 1048576))
+
+    def is_committed(self, pathname):
+        """
+            Check if a path was already added to the container by the run being resumed.
         """
-            Add paths to a volume.
+
+        return pathname in self.committed
+
+    @contextmanager
+    def open_volume(self, container_name, append, password, continuing=False):
+        """
+            Create or open an AFF4 container for writing and yield the resolver and volume to add images to. If a
+            password is given, the encrypted child volume is yielded.
 
             Parameters:
                 container_name:
-                path_names:
-                recursive:
-                append:
+                append: Open an existing container instead of creating one.
                 password:
                 continuing:
-                symlinks:
         """
 
+        if self.journal is None or self.journal.path != container_name + ".journal":
+            self.journal = Journal(container_name)
+        self.journal.open(append)
+        failure = None
         try:
-            if self.zip:
-                if ".zip" not in container_name:
-                    zip_name = container_name.replace(".aff4", ".zip")
-                else:
-                    zip_name = container_name.replace(".aff4", "")
-                with zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_DEFLATED, strict_timestamps=False) as zip_ref:
-                    for path in path_names:
-                        for folder_name, subfolders, filenames in os.walk(path):
-                            # Add the folder
-                            if self.verbose:
-                                printUtils.multi_print(Fore.GREEN + "\tAdding: " + Fore.RESET + folder_name)
-                            zip_ref.write(folder_name, arcname=folder_name)
-                            # Add the files
-                            for filename in filenames:
-                                if self.verbose:
-                                    printUtils.multi_print(Fore.GREEN + "\tAdding: " + Fore.RESET + folder_name +
-                                                           self.separator + filename)
-                                file_path = os.path.join(folder_name, filename)
-                                zip_ref.write(file_path, arcname=file_path)
-
-                zip_ref.close()
-                return True
-        except IsADirectoryError:
-            printUtils.multi_print(Fore.RED + "[-] Error: " + Fore.RESET + container_name + " is a directory.")
-            return False
+            with self.open_container(container_name, append, password, continuing) as volumes:
+                try:
+                    yield volumes
+                except BaseException as e:
+                    failure = e
+                    raise
+        except BaseException as e:
+            # pyaff4 writes the container out when it is closed, so its files are only safe if that went through.
+            # An error from adding files is re-raised after the close, anything else came from the close itself.
+            if e is failure:
+                self.journal.checkpoint()
+            raise
+        else:
+            self.journal.checkpoint()
+        finally:
+            self.journal.close()
+
+    @contextmanager
+    def open_container(self, container_name, append, password, continuing=False):
+        """
+            Create or open the AFF4 container for `open_volume`.
+        """
 
         with data_store.MemoryDataStore() as resolver:
             container_urn = rdfvalue.URN.FromFileName(container_name)
-            urn = None
             encryption = False
             self.container_path = os.path.abspath(container_name).lower()
 
@@ -445,110 +2420,231 @@ class Imager:
             if not append:
                 # The 'aff4:ImageStream' value that Magnet doesn't like is generated here.
                 # Specifically 'aff4_image.AFF4Image.NewAFF4Image'. Magnet expects a 'size' value?
-                with container.Container.createURN(resolver, container_urn, encryption=encryption) as volume:
-                    if not continuing:
-                        printUtils.multi_print(Fore.GREEN + "[*] Creating AFF4Container: " + Fore.RESET
-                                               + "file://%s <%s>" % (container_name, volume.urn))
-                    if password is not None:
-                        volume.setPassword(password[0])
-                        child_volume = volume.getChildContainer()
-                        self.add_path_names_to_volume(child_volume.resolver, child_volume, path_names, recursive,
-                                                      follow_symlinks=symlinks)
-                    else:
-                        self.add_path_names_to_volume(resolver, volume, path_names, recursive, follow_symlinks=symlinks)
+                volume_context = container.Container.createURN(resolver, container_urn, encryption=encryption)
             else:
-                with container.Container.openURNtoContainer(container_urn, mode="+") as volume:
+                volume_context = container.Container.openURNtoContainer(container_urn, mode="+")
+            with volume_context as volume:
+                if not append and not continuing:
+                    printUtils.multi_print(Fore.GREEN + "[*] Creating AFF4Container: " + Fore.RESET
+                                           + "file://%s <%s>" % (container_name, volume.urn))
+                target = volume
+                try:
                     if password is not None:
                         volume.setPassword(password[0])
-                        child_volume = volume.getChildContainer()
-                        self.add_path_names_to_volume(child_volume.resolver, child_volume, path_names, recursive,
-                                                      follow_symlinks=symlinks)
-                    else:
-                        self.add_path_names_to_volume(resolver, volume, path_names, recursive, follow_symlinks=symlinks)
-            return True
+                        target = volume.getChildContainer()
+                    # An appended container is read into a resolver of its own, metadata has to go there too.
+                    yield target.resolver, target
+                finally:
+                    if self.pool is not None:
+                        self.pool.shutdown()
+                        self.pool = None
+                    try:
+                        ContainerIndex.write(target.resolver, target)
+                    except Exception as e:
+                        printUtils.multi_print(Fore.RED + "[-] Unable to write the container's index: " + Fore.RESET
+                                               + "%s" % e)
+
+    def extract_destination(self, path_name, dest_folder):
+        """
+            Work out where a stored file is extracted to. Returns None if it has to be skipped.
+
+            Parameters:
+                path_name: Path of the file in the container.
+                dest_folder:
+        """
+
+        if path_name.startswith("/"):
+            path_name = "." + path_name
+        if path_name[1:3] == """:\\""":
+            path_name = path_name[3:]
+        dest_file = os.path.join(dest_folder, path_name)
+        if self.verbose:
+            printUtils.multi_print(f"{Fore.GREEN}Extracting:{Fore.RESET} [{path_name}] -> [{dest_file}]")
+        if self.os == "Windows":  # Desktop.ini requires systems
+            if "desktop.ini" in dest_file:  # privileges to overwrite.
+                if self.verbose:
+                    printUtils.multi_print(f"{Fore.RED}Skipping:{Fore.RESET} [{path_name}] -> [{dest_file}]")
+                return None
+        return dest_file
+
+    def extract_file(self, resolver, stored, dest_folder):
+        """
+            Extract a file from a volume to a destination folder, or to stdout if the folder is "-".
+
+            Parameters:
+                resolver:
+                stored: `StoredFile` to extract.
+                dest_folder:
+        """
+
+        with open_stream(resolver, stored.stream) as srcStream:
+            if dest_folder != "-":
+                dest_file = self.extract_destination(stored.path, dest_folder)
+                if dest_file is None:
+                    return
+                if not os.path.exists(os.path.dirname(dest_file)):
+                    try:
+                        os.makedirs(os.path.dirname(dest_file))
+                    except OSError as exc:  # Guard against race condition
+                        if exc.errno != errno.EEXIST:
+                            raise
+                start_time = time.time()
+                with open(dest_file, "wb") as destStream:
+                    shutil.copyfileobj(srcStream, destStream)
+                    runMetrics.count("written", 1, destStream.tell(), time.time() - start_time)
+                logical.resetTimestamps(dest_file, *stored.timestamps)
+
+            else:
+                shutil.copyfileobj(srcStream, sys.stdout)
+
+    def stored_folders(self, volume, index=None):
+        """
+            Yield the path name of each folder in a volume, from its index if it has one.
+        """
+
+        for row in ContainerIndex.rows(volume, index, "folder"):
+            yield row["path"]
+
+    def stored_files(self, volume, index=None):
+        """
+            Yield a `StoredFile` for each file in a volume, from its index if it has one. The stream is the file's own
+            unless it is a duplicate reference, whose contents are stored in another file's stream.
+        """
+
+        for row in ContainerIndex.rows(volume, index, "file", "duplicate"):
+            if row["kind"] == "duplicate" and row["stream"] is None:
+                continue
+            yield ContainerIndex.stored_file(row)
+
+    def extract_files_parallel(self, container_urn, files, dest_folder, jobs, password=None):
+        """
+            Extract files on several threads. A resolver and its streams can't be shared between threads, so each
+            thread opens its own reader on the container and takes files from a shared queue. The folders are created
+            in one pass before anything is written, and the timestamps are set once every file is written.
+
+            Parameters:
+                container_urn:
+                files: Files to extract, see `stored_files`.
+                dest_folder:
+                jobs: Number of threads to extract files with.
+                password:
+        """
+
+        entries = queue.Queue()
+        folders = set()
+        for stored in files:
+            dest_file = self.extract_destination(stored.path, dest_folder)
+            if dest_file is not None:
+                folders.add(os.path.dirname(dest_file))
+                entries.put((stored.stream, stored.timestamps, dest_file))
+        for folder in folders:
+            os.makedirs(folder, exist_ok=True)
+
+        written = []
+        error_paths = []
 
-    def extract_all_from_volume(self, container_urn, volume, dest_folder):
+        def extract():
+            with self.open_reader(container_urn, password) as reader:
+                while True:
+                    try:
+                        stream_urn, timestamps, dest_file = entries.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        start_time = time.time()
+                        with open_stream(reader.resolver, stream_urn) as srcStream:
+                            with open(dest_file, "wb") as destStream:
+                                shutil.copyfileobj(srcStream, destStream, EXTRACT_BLOCK)
+                                runMetrics.count("written", 1, destStream.tell(), time.time() - start_time)
+                        written.append((dest_file, timestamps))
+                    except Exception as e:
+                        error_paths.append("\t[-] Unable to extract: " + Fore.RESET + "%s (%s)" % (dest_file, e))
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for future in [pool.submit(extract) for _ in range(jobs)]:
+                future.result()
+        for dest_file, timestamps in written:
+            logical.resetTimestamps(dest_file, *timestamps)
+
+        if error_paths:
+            printUtils.multi_print(Fore.RED + "\n\t[-] Errors:")
+            for path in error_paths:
+                printUtils.multi_print(Fore.RED + "%s" % path)
+
+    def extract_all_from_volume(self, container_urn, volume, dest_folder, jobs=1, password=None, filters=None):
         """
-            Extract files from a volume to a destination folder.
+            Extract files from a volume to a destination folder. The volume's index is used to list them if it has
+            one.
 
             Parameters:
                 container_urn:
                 volume:
                 dest_folder:
+                jobs: Number of threads to extract files with.
+                password:
+                filters: `ExtractFilter` picking the files to extract, all files and folders are extracted without one.
         """
 
         print_volume_info(container_urn.original_filename, volume)
         resolver = volume.resolver
-        for image_urn in resolver.QueryPredicateObject(volume.urn, lexicon.AFF4_TYPE, lexicon.standard11.FolderImage):
-            image_urn = utils.SmartUnicode(image_urn)
-            path_name = next(resolver.QuerySubjectPredicate(volume.urn, image_urn, lexicon.standard11.pathName)).value
-            if path_name.startswith("/"):
-                path_name = "." + path_name
-            if path_name[1:3] == """:\\""":
-                path_name = path_name[3:]
-            dest_file = os.path.join(dest_folder, path_name)
-            if not os.path.exists(dest_file):
-                if self.verbose:
-                    printUtils.multi_print(Fore.GREEN + "   Creating directory: " + Fore.RESET + str(path_name))
-                os.makedirs(dest_file)
-
-        for image_urn in resolver.QueryPredicateObject(volume.urn, lexicon.AFF4_TYPE, lexicon.standard11.FileImage):
-            image_urn = utils.SmartUnicode(image_urn)
-
-            path_name = next(resolver.QuerySubjectPredicate(volume.urn, image_urn, lexicon.standard11.pathName)).value
-            if path_name.startswith("/"):
-                path_name = "." + path_name
-            with resolver.AFF4FactoryOpen(image_urn) as srcStream:
-                if dest_folder != "-":
-                    if path_name.startswith("/"):
-                        path_name = "." + path_name
-                    if path_name[1:3] == """:\\""":
-                        path_name = path_name[3:]
-                    dest_file = os.path.join(dest_folder, path_name)
+        index = ContainerIndex.load(volume)
+        try:
+            files = self.stored_files(volume, index)
+            if filters is not None:
+                # Only the folders the matching files are in are created, by the extraction itself.
+                stored = list(files)
+                files = [file for file in stored if filters.matches(file)]
+                printUtils.multi_print(Fore.GREEN + "[*] " + Fore.RESET + str(len(files)) + Fore.GREEN + " of "
+                                       + Fore.RESET + str(len(stored)) + Fore.GREEN + " files match the filters.")
+            for path_name in (self.stored_folders(volume, index) if filters is None else ()):
+                if path_name.startswith("/"):
+                    path_name = "." + path_name
+                if path_name[1:3] == """:\\""":
+                    path_name = path_name[3:]
+                dest_file = os.path.join(dest_folder, path_name)
+                if not os.path.exists(dest_file):
                     if self.verbose:
-                        printUtils.multi_print(f"{Fore.GREEN}Extracting:{Fore.RESET} [{path_name}] -> [{dest_file}]")
-                    if self.os == "Windows":  # Desktop.ini requires systems
-                        if "desktop.ini" in dest_file:  # privileges to overwrite.
-                            if self.verbose:
-                                printUtils.multi_print(f"{Fore.RED}Skipping:{Fore.RESET} [{path_name}] -> "
-                                                       f"[{dest_file}]")
-                            continue
-                    if not os.path.exists(os.path.dirname(dest_file)):
-                        try:
-                            os.makedirs(os.path.dirname(dest_file))
-                        except OSError as exc:  # Guard against race condition
-                            if exc.errno != errno.EEXIST:
-                                raise
-                    with open(dest_file, "wb") as destStream:
-                        shutil.copyfileobj(srcStream, destStream)
-                    last_written = next_or_none(
-                        resolver.QuerySubjectPredicate(volume.urn, image_urn, lexicon.standard11.lastWritten))
-                    last_accessed = next_or_none(
-                        resolver.QuerySubjectPredicate(volume.urn, image_urn, lexicon.standard11.lastAccessed))
-                    record_changed = next_or_none(
-                        resolver.QuerySubjectPredicate(volume.urn, image_urn, lexicon.standard11.recordChanged))
-                    birth_time = next_or_none(
-                        resolver.QuerySubjectPredicate(volume.urn, image_urn, lexicon.standard11.birthTime))
-                    logical.resetTimestamps(dest_file, last_written, last_accessed, record_changed, birth_time)
-
-                else:
-                    shutil.copyfileobj(srcStream, sys.stdout)
+                        printUtils.multi_print(Fore.GREEN + "   Creating directory: " + Fore.RESET + str(path_name))
+                    os.makedirs(dest_file)
 
-    def extract_all(self, container_name, dest_folder, password=None):
+            if jobs > 1 and dest_folder != "-":
+                self.extract_files_parallel(container_urn, files, dest_folder, jobs, password)
+            else:
+                for stored in files:
+                    self.extract_file(resolver, stored, dest_folder)
+
+            references = [row["urn"] for row in ContainerIndex.rows(volume, index, "prior")]
+        finally:
+            if index is not None:
+                index.close()
+        if references:
+            prior_volume = next_or_none(resolver.QuerySubjectPredicate(volume.urn, references[0], PRIOR_VOLUME))
+            printUtils.multi_print(Fore.GREEN + "[*] " + Fore.RESET + str(len(references)) + Fore.GREEN
+                                   + " unchanged files are stored in the previous image: " + Fore.RESET
+                                   + str(prior_volume))
+
+    @contextmanager
+    def open_reader(self, container_urn, password=None):
         """
-            Extract from volume.
+            Open a container to read from, unlocking it first if it is encrypted.
         """
-        printUtils.multi_print(Fore.GREEN + "\n")
-        container_urn = rdfvalue.URN.FromFileName(container_name)
 
         with container.Container.openURNtoContainer(container_urn) as volume:
             if password is not None:
                 assert not issubclass(volume.__class__, container.PhysicalImageContainer)
                 volume.setPassword(password[0])
-                child_volume = volume.getChildContainer()
-                self.extract_all_from_volume(container_urn, child_volume, dest_folder)
-            else:
-                self.extract_all_from_volume(container_urn, volume, dest_folder)
+                volume = volume.getChildContainer()
+            yield volume
+
+    def extract_all(self, container_name, dest_folder, password=None, jobs=1, filters=None):
+        """
+            Extract from volume.
+        """
+        printUtils.multi_print(Fore.GREEN + "\n")
+        container_urn = rdfvalue.URN.FromFileName(container_name)
+
+        with self.open_reader(container_urn, password) as volume:
+            self.extract_all_from_volume(container_urn, volume, dest_folder, jobs, password, filters)
 
     def extract_from_volume(self, container_urn, volume, image_urns, dest_folder):
         print_volume_info(container_urn.original_filename, volume)
@@ -558,7 +2654,7 @@ class Imager:
 
             path_name = next(resolver.QuerySubjectPredicate(volume.urn, image_urn, volume.lexicon.pathName))
 
-            with resolver.AFF4FactoryOpen(image_urn) as srcStream:
+            with open_stream(resolver, image_urn) as srcStream:
                 if dest_folder != "-":
                     path_name = escaping.arnPathFragment_from_path(path_name.value)
                     while path_name.startswith("/"):
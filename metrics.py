@@ -0,0 +1,300 @@
+# Counters, latency histograms and progress reporting for an acquisition, shared by the imager and the plugins.
+
+import bisect
+import json
+import sys
+import threading
+import time
+from datetime import timedelta
+
+from colorama import reinit, Fore
+
+import utilities
+
+reinit()  # Colorama
+printUtils = utilities.Utilities.get_instance()
+
+# Stages a file goes through, in order. Listing is done by the plugins, the rest by the imager.
+STAGES = ("listed", "transferred", "hashed", "compressed", "written")
+
+# Files that were not written because they are already in the container or its base image. They count as done for the
+# progress bar.
+SKIPPED = "skipped"
+
+# Upper bounds of the latency histogram buckets, in seconds. Anything slower goes in the last bucket.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BUCKET_LABELS = ["<=%g" % bound for bound in BUCKETS] + [">%g" % BUCKETS[-1]]
+
+# Seconds between progress updates.
+PROGRESS_INTERVAL = 0.5
+
+
+class Histogram:
+    """
+        Latency histogram with fixed buckets, cheap enough to record every read and write of an acquisition.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """
+            Estimate a percentile as the upper bound of the bucket it falls in.
+        """
+
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "seconds": round(self.total, 6),
+            "mean": round(self.total / self.count, 6) if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": round(self.max, 6),
+            "buckets": {label: count for label, count in zip(BUCKET_LABELS, self.counts) if count},
+        }
+
+
+class Metrics:
+    """
+        This class is used to count the files and bytes an acquisition lists, transfers, hashes, compresses and writes,
+        and how long each operation takes, so a slow run shows which stage it is waiting on. One instance is shared by
+        every module of a run, the same way as `utilities.Utilities`.
+    """
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        """ Static access method. """
+        if Metrics.__instance is None:
+            Metrics()
+        return Metrics.__instance
+
+    def __init__(self):
+        """
+            Constructor for Metrics class.
+        """
+
+        Metrics.__instance = self
+        self.lock = threading.Lock()
+        self.watchers = []
+        self.reset()
+
+    def reset(self):
+        """
+            Clear the counters, at the start of a run.
+        """
+
+        with self.lock:
+            self.started = time.time()
+            self.finished = None
+            self.counters = {stage: {"files": 0, "bytes": 0} for stage in STAGES + (SKIPPED,)}
+            self.histograms = {stage: Histogram() for stage in STAGES}
+            self.info = {}
+
+    def count(self, stage, files=0, size=0, seconds=None):
+        """
+            Count files and bytes through a stage, and the time one operation of it took.
+
+            Parameters:
+                stage: One of `STAGES`, or `SKIPPED`.
+                files: Number of files the operation finished.
+                size: Number of bytes it handled.
+                seconds: How long it took, if it should be in the stage's latency histogram.
+        """
+
+        with self.lock:
+            counter = self.counters[stage]
+            counter["files"] += files
+            counter["bytes"] += size
+            if seconds is not None:
+                self.histograms[stage].record(seconds)
+
+    def totals(self, stage):
+        """
+            Get the bytes through a stage and the seconds its operations took altogether.
+        """
+
+        with self.lock:
+            return self.counters[stage]["bytes"], self.histograms[stage].total
+
+    def set_info(self, **info):
+        """
+            Add values to the metrics file, such as the output container and its size.
+        """
+
+        with self.lock:
+            self.info.update(info)
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def progress(self):
+        """
+            Get the bytes done, the bytes listed so far (None if the plugin doesn't list ahead), the files done and the
+            files listed.
+        """
+
+        with self.lock:
+            written, skipped, listed = (self.counters[stage] for stage in ("written", SKIPPED, "listed"))
+            done = written["bytes"] + skipped["bytes"]
+            files = written["files"] + skipped["files"]
+            total = max(listed["bytes"], done) if listed["files"] else None
+            return done, total, files, max(listed["files"], files)
+
+    def snapshot(self):
+        """
+            Get every counter and histogram as a dictionary for the metrics file.
+        """
+
+        with self.lock:
+            elapsed = self.elapsed()
+            stages = {}
+            for stage in STAGES:
+                counter = self.counters[stage]
+                stages[stage] = dict(counter, latency=self.histograms[stage].to_dict())
+                busy = self.histograms[stage].total
+                stages[stage]["mb_per_second"] = round(counter["bytes"] / busy / 1048576, 3) if busy else 0.0
+            return dict(self.info, started=time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                        seconds=round(elapsed, 3), stages=stages, skipped=dict(self.counters[SKIPPED]),
+                        files_per_second=round(self.counters["written"]["files"] / elapsed, 3) if elapsed else 0.0,
+                        mb_per_second=round(self.counters["written"]["bytes"] / elapsed / 1048576, 3)
+                        if elapsed else 0.0)
+
+    def watch(self, callback, interval=PROGRESS_INTERVAL):
+        """
+            Call `callback` with this instance every `interval` seconds, on its own thread, until `stop` is called.
+        """
+
+        stopped = threading.Event()
+
+        def run():
+            while not stopped.wait(interval):
+                callback(self)
+            callback(self)
+
+        thread = threading.Thread(target=run, daemon=True)
+        self.watchers.append((stopped, thread))
+        thread.start()
+
+    def stop(self):
+        """
+            Stop the clock and any progress updates.
+        """
+
+        self.finished = time.time()
+        for stopped, thread in self.watchers:
+            stopped.set()
+            thread.join()
+        self.watchers = []
+
+    def write(self, path):
+        """
+            Write the metrics of the run to a JSON file.
+        """
+
+        try:
+            with open(path, "w", encoding="utf-8") as metrics_file:
+                json.dump(self.snapshot(), metrics_file, indent=2)
+            printUtils.multi_print(f"{Fore.GREEN}[+] Metrics written to: {Fore.RESET}{path}")
+        except OSError as e:
+            printUtils.multi_print(f"{Fore.RED}[-] Could not write metrics: {Fore.RESET}{e}")
+
+    def print_summary(self):
+        """
+            Print how much went through each stage and how long it spent on it, if anything was counted.
+        """
+
+        snapshot = self.snapshot()
+        if not any(stage["files"] or stage["bytes"] for stage in snapshot["stages"].values()):
+            return
+        printUtils.multi_print(f"{Fore.GREEN}[*] Stages:")
+        for name, stage in snapshot["stages"].items():
+            latency = stage["latency"]
+            if not (stage["files"] or stage["bytes"] or latency["count"]):
+                continue
+            printUtils.multi_print(f"{Fore.GREEN}\t{name.capitalize()}: {Fore.RESET}{stage['files']} files, "
+                                   f"{stage['bytes'] / 1048576:.2f} MB, {latency['seconds']:.2f} s busy, "
+                                   f"p50 {latency['p50'] * 1000:.2f} ms, p99 {latency['p99'] * 1000:.2f} ms")
+
+
+def format_progress(metrics):
+    """
+        Describe the progress of a run in one line, with an ETA once the total is known.
+    """
+
+    done, total, files, listed = metrics.progress()
+    elapsed = metrics.elapsed()
+    rate = done / elapsed if elapsed else 0
+    text = f"{files}/{listed} files, {done / 1048576:.1f} MB, {rate / 1048576:.2f} MB/s"
+    if total and rate:
+        text += f", ETA {timedelta(seconds=int((total - done) / rate))}"
+    return text
+
+
+class ProgressBar:
+    """
+        Live progress bar with throughput and ETA for the command line. The total grows as the plugin lists more of
+        the device, so the ETA is for what has been found so far. It is only shown once something has been found, so it
+        stays out of the way of any prompts while connecting, and output printed while it is shown goes above it.
+    """
+
+    def __init__(self, metrics, enabled=None):
+        """
+            Constructor for ProgressBar class.
+
+            Parameters:
+                metrics: Metrics of the run.
+                enabled: Show the bar, by default only when the output is a terminal.
+        """
+
+        self.metrics = metrics
+        self.enabled = sys.stderr.isatty() if enabled is None else enabled
+        self.tqdm = None
+        self.bar = None
+
+    def update(self, metrics):
+        done, total, files, listed = metrics.progress()
+        if self.bar is None:
+            if not listed:
+                return
+            self.bar = self.tqdm(unit="B", unit_scale=True, unit_divisor=1024, dynamic_ncols=True, leave=False)
+            printUtils.progress = self.bar
+        self.bar.total = total
+        self.bar.set_postfix_str(f"{files}/{listed} files", refresh=False)
+        self.bar.update(done - self.bar.n)
+
+    def __enter__(self):
+        if self.enabled:
+            try:
+                from tqdm import tqdm
+                self.tqdm = tqdm
+                self.metrics.watch(self.update)
+            except ImportError:
+                pass
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.stop()
+        if self.bar is not None:
+            printUtils.progress = None
+            self.bar.close()
@@ -1,4 +1,7 @@
+import ast
+import importlib
 import inspect
+import json
 import os
 import pkgutil
 import utilities
@@ -7,6 +10,10 @@ from colorama import reinit, Fore
 reinit()  # Colorama
 utils = utilities.Utilities.get_instance()
 
+# Plugins found by scanning a package's modules are cached in its __pycache__, next to their bytecode, so later runs
+# only parse the modules that changed.
+CACHE_NAME = "afflux-plugins.json"
+
 
 class Plugin(object):
     """
@@ -38,10 +45,65 @@ class Plugin(object):
         raise NotImplementedError
 
 
+def read_plugin_classes(tree):
+    """
+        Find the plugin classes in a module's syntax tree, with the name and description they set in `__init__`.
+        Returns a list of (class name, name, description), or None if a plugin's name isn't set to a plain string, so
+        the module has to be imported to know it.
+    """
+    found = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        if not any(getattr(base, "id", getattr(base, "attr", None)) == "Plugin" for base in node.bases):
+            continue
+        values = {}
+        for item in node.body:
+            if not isinstance(item, ast.FunctionDef) or item.name != "__init__":
+                continue
+            for statement in ast.walk(item):
+                if not isinstance(statement, ast.Assign) or len(statement.targets) != 1:
+                    continue
+                target = statement.targets[0]
+                if (isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name)
+                        and target.value.id == "self" and target.attr in ("name", "description")
+                        and isinstance(statement.value, ast.Constant) and isinstance(statement.value.value, str)):
+                    values[target.attr] = statement.value.value
+        if "name" not in values:
+            return None
+        found.append((node.name, values["name"], values.get("description", "UNKNOWN")))
+    return found
+
+
+class PluginEntry(object):
+    """
+        A plugin found in the plugins package. Its module is only imported, and the plugin created, when it is
+        loaded, so listing the plugins doesn't import every plugin's dependencies.
+    """
+
+    def __init__(self, name, description, module_name, class_name, plugin=None):
+        self.name = name
+        self.description = description
+        self.module_name = module_name
+        self.class_name = class_name
+        self.plugin = plugin
+
+    def load(self):
+        """
+            Import the plugin's module and create the plugin, the first time it is needed.
+        """
+        if self.plugin is None:
+            plugin_module = importlib.import_module(self.module_name)
+            self.plugin = getattr(plugin_module, self.class_name)()
+        return self.plugin
+
+
 class PluginCollection(object):
     """
         Upon creation, this class will read the plugins package for modules
-        that contain a class definition that is inheriting from the Plugin class
+        that contain a class definition that is inheriting from the Plugin class.
+        The modules are scanned without importing them; a plugin's module is
+        only imported when it is returned by `return_plugin`.
     """
 
     def __init__(self, plugin_package, verbose):
@@ -51,6 +113,7 @@ class PluginCollection(object):
         """
         self.seen_paths = None
         self.plugins = None
+        self.caches = None
         self.verbose = verbose
         self.plugin_package = plugin_package
         self.reload_plugins()
@@ -62,9 +125,11 @@ class PluginCollection(object):
         """
         self.plugins = []
         self.seen_paths = []
+        self.caches = {}
         if self.verbose:
             utils.multi_print(f"{Fore.GREEN}\n[*] Looking for plugins: {self.plugin_package}", worker=False)
         self.walk_package(self.plugin_package)
+        self.save_caches()
         utils.multi_print("\n", worker=False)
 
     def list_plugins(self):
@@ -78,11 +143,17 @@ class PluginCollection(object):
 
     def return_plugin(self, plugin_name):
         """
-            When given a plugin name, return a handle to that plugin.
+            When given a plugin name, return a handle to that plugin, importing
+            its module if it hasn't been loaded yet.
         """
         for plugin in self.plugins:
             if plugin_name == plugin.name:
-                return plugin
+                try:
+                    return plugin.load()
+                except (ImportError, AttributeError) as e:
+                    utils.multi_print(f"{Fore.RED}[-] Could not load plugin {plugin_name}: {Fore.RESET}{e}",
+                                      worker=False)
+                    return False
         return False
 
     def walk_package(self, package):
@@ -91,8 +162,19 @@ class PluginCollection(object):
         """
         imported_package = __import__(package, fromlist=['blah'])
 
-        for _, plugin_name, is_pkg in pkgutil.iter_modules(imported_package.__path__, imported_package.__name__ + '.'):
+        for module_finder, plugin_name, is_pkg in pkgutil.iter_modules(imported_package.__path__,
+                                                                       imported_package.__name__ + '.'):
             if not is_pkg:
+                found = self.scan_module(module_finder, plugin_name)
+                if found is not None:
+                    for class_name, name, description in found:
+                        if self.verbose:
+                            utils.multi_print(f"{Fore.GREEN}\tFound plugin class: {Fore.RESET} "
+                                              f"{plugin_name}.{class_name}", worker=False)
+                        self.plugins.append(PluginEntry(name, description, plugin_name, class_name))
+                    continue
+
+                # The plugins can't be read from the source, so import the module to find them.
                 plugin_module = __import__(plugin_name, fromlist=['blah'])
                 cls_members = inspect.getmembers(plugin_module, inspect.isclass)
                 for (_, c) in cls_members:
@@ -101,7 +183,9 @@ class PluginCollection(object):
                         if self.verbose:
                             utils.multi_print(f"{Fore.GREEN}\tFound plugin class: {Fore.RESET} "
                                               f"{c.__module__}.{c.__name__}", worker=False)
-                        self.plugins.append(c())
+                        plugin = c()
+                        self.plugins.append(PluginEntry(plugin.name, plugin.description, c.__module__, c.__name__,
+                                                        plugin))
 
         # Now that we have looked at all the modules in the current package, start looking
         # recursively for additional modules in sub packages
@@ -121,3 +205,63 @@ class PluginCollection(object):
                 # For each subdirectory, apply the walk_package method recursively
                 for child_pkg in child_pkgs:
                     self.walk_package(package + '.' + child_pkg)
+
+    def scan_module(self, module_finder, plugin_name):
+        """
+            Find the plugins in a module without importing it, from the cache or
+            by parsing its source. Returns a list of (class name, name,
+            description), or None if the module has to be imported instead.
+        """
+        folder = getattr(module_finder, "path", None)
+        if folder is None:
+            return None
+        file_name = plugin_name.rpartition('.')[2] + ".py"
+        try:
+            source_stat = os.stat(os.path.join(folder, file_name))
+        except OSError:
+            return None
+
+        cache = self.load_cache(folder)
+        cached = cache["modules"].get(file_name)
+        if cached and cached["size"] == source_stat.st_size and cached["mtime"] == source_stat.st_mtime_ns:
+            return cached["plugins"]
+
+        try:
+            with open(os.path.join(folder, file_name), "rb") as source:
+                tree = ast.parse(source.read(), file_name)
+        except (OSError, SyntaxError, ValueError):
+            return None
+        found = read_plugin_classes(tree)
+        cache["modules"][file_name] = {"size": source_stat.st_size, "mtime": source_stat.st_mtime_ns,
+                                       "plugins": found}
+        cache["changed"] = True
+        return found
+
+    def load_cache(self, folder):
+        """
+            Load the cached scan of a plugin folder.
+        """
+        if folder not in self.caches:
+            modules = {}
+            try:
+                with open(os.path.join(folder, "__pycache__", CACHE_NAME), "r") as cache_file:
+                    modules = json.load(cache_file)
+            except (OSError, ValueError):
+                pass
+            self.caches[folder] = {"modules": modules if isinstance(modules, dict) else {}, "changed": False}
+        return self.caches[folder]
+
+    def save_caches(self):
+        """
+            Write the scans that changed back to their caches. A plugin folder
+            that isn't writable is just scanned again next time.
+        """
+        for folder, cache in self.caches.items():
+            if not cache["changed"]:
+                continue
+            try:
+                os.makedirs(os.path.join(folder, "__pycache__"), exist_ok=True)
+                with open(os.path.join(folder, "__pycache__", CACHE_NAME), "w") as cache_file:
+                    json.dump(cache["modules"], cache_file)
+            except OSError:
+                pass
@@ -4,20 +4,19 @@
 # pip install adb-shell, pip install adb-shell[usb]
 
 import argparse
-from datetime import datetime
-from os import getlogin, path, mkdir, makedirs, chdir, listdir
-from shutil import rmtree
-from socket import timeout
+import posixpath
+from os import getlogin, path
 from stat import *
 
 from adb_shell.adb_device import AdbDeviceTcp, AdbDeviceUsb
 from adb_shell.auth.keygen import keygen
 from adb_shell.auth.sign_pythonrsa import PythonRSASigner
-from adb_shell.exceptions import UsbReadFailedError, AdbCommandFailureException, TcpTimeoutException, \
-    UsbDeviceNotFoundError, AdbTimeoutError, AdbConnectionError
+from adb_shell.exceptions import UsbReadFailedError, TcpTimeoutException, UsbDeviceNotFoundError, \
+    AdbTimeoutError, AdbConnectionError
 from adb_shell.transport.usb_transport import UsbTransport
 from colorama import reinit, Fore
 
+import acquisition
 import imaging
 import plugin_manager
 import utilities
@@ -25,6 +24,9 @@ import utilities
 reinit()  # Colorama
 utils = utilities.Utilities.get_instance()
 
+TAR_ERRORS = "/data/local/tmp/afflux_tar_errors"
+TAR_READ_TIMEOUT = 60
+
 
 class AndroidImage(plugin_manager.Plugin):
     """
@@ -45,6 +47,10 @@ class AndroidImage(plugin_manager.Plugin):
         self.signer = None
         self.temp = None
         self.no_image = []
+        self.ip_address = None
+        self.port = 5555
+        self.auth_timeout = 0.1
+        self.transport_timeout = 5
 
     def sign(self, keys):
         """
@@ -96,6 +102,10 @@ class AndroidImage(plugin_manager.Plugin):
             Connect to the device via ADB over USB or with IP address.
         """
 
+        self.ip_address = ip_address
+        self.port = port
+        self.auth_timeout = auth_timeout
+        self.transport_timeout = transport_timeout
         try:
             # Connect via IP address
             if ip_address:
@@ -167,75 +177,143 @@ class AndroidImage(plugin_manager.Plugin):
             devices.append(device.serial_number)
         return devices
 
-    def walk(self, directory, symlink_follow, no_image):
+    def open_sessions(self, count):
+        """
+            Get up to `count` ADB sessions to pull files with, one worker is started for each. Over the network each
+            session is its own connection to the device, over USB there is only the one connection. adb_shell drops a
+            stream's CLSE when another thread reads it off a shared connection, which stalls that pull until it times
+            out, so workers never share a session.
+        """
+
+        sessions = [self.device]
+        while self.ip_address is not None and len(sessions) < count:
+            try:
+                device = AdbDeviceTcp(self.ip_address, self.port, default_transport_timeout_s=self.transport_timeout)
+                device.connect(rsa_keys=[self.signer], auth_timeout_s=self.auth_timeout)
+                sessions.append(device)
+            except (TcpTimeoutException, OSError, AdbConnectionError) as e:
+                if self.arguments.verbose:
+                    utils.multi_print(f"{Fore.RED}\tCould not open another ADB session: {Fore.RESET}{e}")
+                break
+        return sessions
+
+    def acquire(self, specified_directories, symlink_follow, no_image, connections=1, tar=False, skip=None,
+                unchanged=None):
         """
-            Traverse the Android file structure.
+            Walk the device and yield each folder and file as a (path, metadata, stream) tuple for the imager, pulling
+            files over `connections` ADB sessions at once. Container paths in `skip` are not pulled, and files
+            `unchanged(path, metadata)` is true for are only pulled if the imager asks for them.
         """
 
-        dirs = []
-        files = []
+        skip = skip if skip is not None else set()
+        if tar:
+            yield from self.acquire_tar(specified_directories, symlink_follow, no_image, connections, skip, unchanged)
+            return
+
+        for directory in specified_directories:
+            if directory != "/":
+                stat = self.device.stat(directory)
+                yield directory.lstrip("/"), imaging.create_metadata(directory, 0, stat[2]), None
+
+        engine = AdbEngine(self.open_sessions(connections), self.arguments.verbose, skip=skip, unchanged=unchanged)
         try:
-            directories = self.device.list(directory)
-            for path_name in directories:
-                name = bytes(path_name.filename).decode("utf-8")
-                if name in ('.', '..', ''):
-                    continue
-                # Directory
-                if S_ISDIR(path_name.mode):
-                    dirs.append(name)
-                # Symlink
-                elif S_ISLNK(path_name.mode):
-                    if symlink_follow:
-                        dirs.append(name)
-                    else:
-                        utils.multi_print(f"{Fore.RED}\tSkipping Symlink: {Fore.RESET}{name}")
-                # File
-                else:
-                    files.append(name)
+            yield from engine.copy(specified_directories, symlink_follow, no_image)
+            engine.report()
+        finally:
+            engine.close()
+
+    def acquire_tar(self, specified_directories, symlink_follow, no_image, connections=1, skip=frozenset(),
+                    unchanged=None):
+        """
+            Stream the specified directories off the device as a single tar archive and yield its members for the
+            imager, which avoids a sync round trip per file. Files tar could not read are retried with a sync pull, and
+            if the archive ends early the rest of the directories are pulled the usual way.
+        """
+
+        targets = []
+        for directory in specified_directories:
+            if directory.strip("/"):
+                targets.append(directory.strip("/"))
+                continue
+            # Name the top level entries so the excluded ones are never opened (tar would hang on /proc).
+            for entry in self.device.list("/"):
+                name = bytes(entry.filename).decode("utf-8")
+                if name not in ('.', '..', '') and "/" + name not in no_image:
+                    targets.append(name)
+        command = (f"tar -c{'h' if symlink_follow else ''}f - {imaging.tar_arguments(targets, no_image)} "
+                   f"2>{TAR_ERRORS}")
+        if self.arguments.verbose:
+            utils.multi_print(f"{Fore.GREEN}[*] Streaming archive: {Fore.RESET}{command}")
 
-        except TcpTimeoutException as e:
-            utils.multi_print(f"{Fore.RED}\tTimeout: {Fore.RESET}{str(e)}")
+        def stream_archive(pipe):
+            for chunk in self.device.streaming_shell(command, read_timeout_s=TAR_READ_TIMEOUT, decode=False):
+                pipe.write(chunk)
 
+        archived = set()
+        pathname = None
+        complete = False
+        pipe = imaging.StreamPipe(stream_archive, max_chunks=256)
+        try:
+            for pathname, fsmeta, stream in imaging.tar_streams(pipe):
+                archived.add(pathname)
+                yield pathname, fsmeta, stream
+            complete = pipe.error is None
         except Exception as e:
-            print(e)
-
-        yield directory, dirs, files
-
-        if dirs:
-            for d in dirs:
-                if directory == "/":
-                    directory = ""
-                result = directory + "/" + d
-                if no_image:
-
-                    # Check if the path is in a directory we shouldn't traverse
-                    dont_image = False
-                    for no_image_path in no_image:
-                        if result in no_image_path:
-                            dont_image = True
-
-                    # Safe to traverse path
-                    if dont_image is False:
-                        for walk_result in self.walk(result, symlink_follow, no_image):
-                            yield walk_result
-
-                    # Don't traverse path
-                    else:
-                        if self.arguments.verbose:
-                            utils.multi_print(Fore.RED + "\t[*] Skipping path: %s" % result)
-
-                # No excluded directories specified, so traverse away.
-                else:
-                    for walk_result in self.walk(result, symlink_follow, no_image):
-                        yield walk_result
+            utils.multi_print(f"{Fore.RED}[-] Archive stream failed: {Fore.RESET}{e}")
+        finally:
+            pipe.close()
+
+        failed = self.tar_errors()
+        retry_directories = []
+        if complete:
+            utils.multi_print(f"{Fore.GREEN}[+] Archive streamed, {Fore.RESET}{len(failed)}{Fore.GREEN} "
+                              f"paths to retry.")
+        else:
+            # The file being read when the stream broke is incomplete, so it is pulled again with the rest.
+            if pipe.error is not None:
+                utils.multi_print(f"{Fore.RED}[-] Archive stream failed: {Fore.RESET}{pipe.error}")
+            utils.multi_print(f"{Fore.RED}[-] Pulling the remaining files one at a time.")
+            archived.discard(pathname)
+            retry_directories = ["/" + target for target in targets]
+            failed = []
+
+        retry_files = []
+        for remote_path in failed:
+            if remote_path.lstrip("/") in archived or remote_path.lstrip("/") in skip:
+                continue
+            mode, size, mtime = self.device.stat(remote_path)
+            if S_ISDIR(mode):
+                retry_directories.append(remote_path)
+            elif S_ISREG(mode):
+                if self.arguments.verbose:
+                    utils.multi_print(f"{Fore.GREEN}\tRetrying file: {Fore.RESET}{remote_path}")
+                retry_files.append((remote_path, imaging.create_metadata(remote_path, size, mtime)))
+        if retry_directories or retry_files:
+            engine = AdbEngine(self.open_sessions(connections), self.arguments.verbose, skip=archived | skip,
+                               unchanged=unchanged)
+            engine.files.extend(retry_files)
+            try:
+                yield from engine.copy(retry_directories, symlink_follow, no_image)
+            finally:
+                engine.close()
+
+    def tar_errors(self):
+        """
+            Read and remove the error output of the archive stream, returning the paths tar could not read.
+        """
+
+        output = self.execute_command(f"cat {TAR_ERRORS}; rm -f {TAR_ERRORS}") or ""
+        if self.arguments.verbose:
+            for line in output.splitlines():
+                utils.multi_print(f"{Fore.RED}\t{line}")
+        return imaging.tar_error_paths(output)
 
     def image_device(self, specified_directories, output_file, encryption_password, symlink_follow, root, zip_image):
         """
             Image an Android device.
         """
         no_image = []
-        imager = imaging.Imager(self.arguments.verbose, zip=zip_image)
-        output_path, old_path, tmp_path = self.imager.setup_tmp_directory(self.temp, output_file)
+        imager = imaging.Imager.from_arguments(self.arguments, zip=zip_image)
 
         if specified_directories[0] == '':
             specified_directories = ["/"]
@@ -247,10 +325,6 @@ class AndroidImage(plugin_manager.Plugin):
         for not_image_path in no_image:
             specified_directories.remove(not_image_path + "-")
 
-        if output_file[1:2] != ":":
-            if output_file[:1] != "/":
-                output_file = old_path + self.imager.separator + output_file
-
         try:
             # Check if we want to attempt root access
             if root:
@@ -270,63 +344,15 @@ class AndroidImage(plugin_manager.Plugin):
             utils.multi_print(f"{Fore.RED}\tDevice connection timeout.")
             return False
 
-        for directory in specified_directories:
-            if directory != "/":
-                makedirs(tmp_path + directory)
-
-            for path_name in self.walk(directory, symlink_follow, no_image):
-                try:
-                    for directories in path_name[1]:
-                        local_dir = utils.check_file_names(tmp_path + path_name[0] + self.imager.separator + directories)
-                        if self.arguments.verbose:
-                            if path_name[0] == "/":  # TODO: Find a better solution for the path printing issue
-                                utils.multi_print(f"{Fore.GREEN}\tMaking dir: {Fore.RESET}{path_name[0] + directories}")
-                            else:
-                                utils.multi_print(f"{Fore.GREEN}\tMaking dir: "
-                                                  f"{Fore.RESET}{str(path_name[0]) + '/' + directories}")
-                        mkdir(local_dir)
-
-                    for file_name in path_name[2]:
-                        output_file_path = utils.check_file_names(tmp_path + path_name[0] + self.imager.separator +
-                                                                  file_name)
-                        stat = self.device.stat((str(path_name[0]) + "/" + file_name))
-                        if self.arguments.verbose:
-                            if path_name[0] == "/":
-                                utils.multi_print(f"{Fore.GREEN}\tCopying file: {Fore.RESET}{path_name[0] + file_name}")
-                            else:
-                                utils.multi_print(f"{Fore.GREEN}\tCopying file: "
-                                                  f"{Fore.RESET}{str(path_name[0]) + '/' + file_name}")
-                        self.device.pull((str(path_name[0]) + "/" + file_name), output_file_path)
-                        # Change 'st_mtime' to the original time from the device
-                        info = {'st_mtime': datetime.fromtimestamp(stat[2])}
-                        utils.modify_time(info, output_file_path)
-
-                except AdbCommandFailureException:
-                    utils.multi_print(f"{Fore.RED}\tPermission error: "
-                                      f"{Fore.RESET}{str(path_name[0]) + '/' + file_name}")
-                    continue
-
-                except TcpTimeoutException:
-                    utils.multi_print(f"{Fore.RED}\tTimeout: {Fore.RESET}{str(path_name[0]) + '/' + file_name}")
-                    continue
-
-                except ConnectionResetError:
-                    utils.multi_print(f"{Fore.RED}[-] Error: {Fore.RESET}Connection Reset.")
-                    continue
-
-        self.close()
-        chdir(tmp_path)
-        directories = listdir()
-        if self.arguments.verbose:
-            utils.multi_print(f"{Fore.GREEN}[+] Directory list: {Fore.RESET}{', '.join(directories)}")
         utils.multi_print(f"{Fore.GREEN}[+] Adding to container...")
         if self.arguments.verbose:
-            utils.multi_print(f"{Fore.GREEN}[*] Container path: {Fore.RESET}{output_file}")
-        success = imager.add_path_names(output_file, directories, True, self.arguments.append, encryption_password)
-        chdir(old_path)
-        if self.arguments.verbose:
-            utils.multi_print(f"{Fore.GREEN}[*] Cleaning up...")
-        rmtree(tmp_path, ignore_errors=True)
+            utils.multi_print(f"{Fore.GREEN}[*] Container path: {Fore.RESET}{path.abspath(output_file)}")
+        streams = self.acquire(specified_directories, symlink_follow, no_image,
+                               connections=getattr(self.arguments, "connections", 1),
+                               tar=getattr(self.arguments, "tar", False), skip=imager.committed,
+                               unchanged=imager.is_unchanged)
+        success = imager.add_streams(output_file, streams, self.arguments.append, encryption_password)
+        self.close()
         utils.multi_print(f"{Fore.GREEN}[+] Imaging completed.")
         return success
 
@@ -347,6 +373,11 @@ class AndroidImage(plugin_manager.Plugin):
                                  help='regenerate pairing keys for the device.')
         self.parser.add_argument("--timeout", action="store", nargs=1, default=5, type=int, metavar='TIMEOUT',
                                  help='ADB timeout.')
+        self.parser.add_argument("--connections", action="store", default=4, type=int, metavar='N',
+                                 help='number of ADB sessions to pull files over at once, over IP only. Default is 4.')
+        self.parser.add_argument("--tar", action="store_true",
+                                 help='stream the directories off the device as one tar archive instead of pulling '
+                                      'each file. Best used with --root.')
         self.parser.add_argument("--auth-timeout", action="store", nargs=1, default=0.1, type=int,
                                  metavar='AUTH TIMEOUT', help='Timeout for \'CNXN\' authentication response.')
         self.arguments, extra = self.parser.parse_known_args(plugin_args, parent_args)
@@ -356,7 +387,7 @@ class AndroidImage(plugin_manager.Plugin):
         utils.multi_print(f"{Fore.GREEN}[+] Loaded Android plugin!")
         if self.arguments.temp:
             self.temp = self.arguments.temp
-        self.imager = imaging.Imager(self.arguments.verbose)
+        self.imager = imaging.Imager.from_arguments(self.arguments)
         if not self.arguments.directory:
             self.arguments.directory = ["/"]
         if self.arguments.output is None:
@@ -374,12 +405,12 @@ class AndroidImage(plugin_manager.Plugin):
                 result = self.connect(transport_timeout=self.arguments.timeout,
                                       auth_timeout=self.arguments.auth_timeout)
                 if result:
-                    self.image_device(self.arguments.directory,
-                                      self.arguments.output[0],
-                                      self.arguments.container_password,
-                                      self.arguments.symlinks,
-                                      self.arguments.root,
-                                      self.arguments.zip)
+                    result = self.image_device(self.arguments.directory,
+                                               self.arguments.output[0],
+                                               self.arguments.container_password,
+                                               self.arguments.symlinks,
+                                               self.arguments.root,
+                                               self.arguments.zip)
             else:
                 if ":" in self.arguments.android:
                     ip_address, port = self.arguments.android.split(":")
@@ -394,14 +425,95 @@ class AndroidImage(plugin_manager.Plugin):
                                           transport_timeout=self.arguments.timeout,
                                           auth_timeout=self.arguments.auth_timeout)
                 if result:
-                    self.image_device(self.arguments.directory,
-                                      self.arguments.output[0],
-                                      self.arguments.container_password,
-                                      self.arguments.symlinks,
-                                      self.arguments.root,
-                                      self.arguments.zip)
-            return True
+                    result = self.image_device(self.arguments.directory,
+                                               self.arguments.output[0],
+                                               self.arguments.container_password,
+                                               self.arguments.symlinks,
+                                               self.arguments.root,
+                                               self.arguments.zip)
+            return bool(result)
 
         else:
             self.parser.print_help()
             return False
+
+
+class AdbEngine(acquisition.PooledSource):
+    """
+        This class is used to pull files from an Android device over several ADB sessions at once, as an
+        `acquisition.PooledSource`. Folders and files are described from the sync listing itself, so their mode, size
+        and mtime don't need to be looked up again.
+    """
+
+    protocol = "ADB"
+
+    def __init__(self, sessions, verbose=False, skip=None, unchanged=None):
+        """
+            Constructor for the AdbEngine class.
+
+            Parameters:
+                sessions: Connected ADB devices, the first one belongs to the plugin. One worker is started for each.
+                verbose: Print each folder and file as it is found.
+                skip: Container paths that are already in the image.
+                unchanged: Callable taking a container path and its metadata, files it is true for are not pulled
+                           unless the imager opens them.
+        """
+
+        super().__init__(sessions, verbose, buffer_chunks=256, skip=skip, unchanged=unchanged)
+
+    def close(self):
+        """
+            Close every session but the first, which belongs to the plugin.
+        """
+
+        for session in self.sessions[1:]:
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    def list(self, session, remote_dir, folders, symlinks, no_image, recursive, directories, files):
+        """
+            List a directory on the device, collecting its folders for the imager, the directories to walk next and the
+            files to pull.
+        """
+
+        for entry in session.list(remote_dir):
+            name = bytes(entry.filename).decode("utf-8")
+            if name in ('.', '..', ''):
+                continue
+            remote_path = posixpath.join(remote_dir, name)
+            # Directory
+            if S_ISDIR(entry.mode):
+                if remote_path in no_image:
+                    if self.verbose:
+                        utils.multi_print(f"{Fore.RED}\t[*] Skipping path: {Fore.RESET}{remote_path}")
+                    continue
+                if self.container_path(remote_path) not in self.skip:
+                    if self.verbose:
+                        utils.multi_print(f"{Fore.GREEN}\tMaking dir: {Fore.RESET}{remote_path}")
+                    folders.append((self.container_path(remote_path),
+                                    imaging.create_metadata(remote_path, 0, entry.mtime), None))
+                if recursive:
+                    directories.append(remote_path)
+            # Symlink
+            elif S_ISLNK(entry.mode):
+                if symlinks and recursive:
+                    directories.append(remote_path)
+                else:
+                    utils.multi_print(f"{Fore.RED}\tSkipping Symlink: {Fore.RESET}{remote_path}")
+            # File
+            elif S_ISREG(entry.mode):
+                if remote_path in no_image or self.container_path(remote_path) in self.skip:
+                    continue
+                files.append((remote_path, imaging.create_metadata(remote_path, entry.size, entry.mtime)))
+            elif self.verbose:
+                utils.multi_print(f"{Fore.RED}\tSkipping special file: {Fore.RESET}{remote_path}")
+
+    @staticmethod
+    def read(session, remote_path, size, stream):
+        """
+            Pull a file off the device into `stream`.
+        """
+
+        session.pull(remote_path, stream)
@@ -4,7 +4,8 @@
 # His AFC copying method and timestamp copying is implemented here for pymobiledevice3
 
 import argparse
-from os import mkdir, chdir, listdir
+from collections import deque
+from os import path
 from posixpath import join as posixpath_join
 from shutil import rmtree
 
@@ -13,9 +14,10 @@ from pymobiledevice3 import usbmux
 from pymobiledevice3.lockdown import LockdownClient, StartServiceError, LockdownError
 from pymobiledevice3.exceptions import NotTrustedError, AfcException, MuxException, PasswordRequiredError, \
     InvalidServiceError
-from pymobiledevice3.services.afc import AfcService
+from pymobiledevice3.services.afc import AfcService, afc_opcode_t, afc_fread_req_t, afc_error_t
 from pymobiledevice3.common import get_home_folder
 
+import acquisition
 import imaging
 import plugin_manager
 import utilities
@@ -23,6 +25,9 @@ import utilities
 reinit()  # Colorama
 utils = utilities.Utilities.get_instance()
 
+# Number of reads kept in flight on an AFC connection while a file is copied.
+READ_DEPTH = 4
+
 
 class IosImagerAFC(plugin_manager.Plugin):
     """
@@ -42,35 +47,6 @@ class IosImagerAFC(plugin_manager.Plugin):
         self.service = None
         self.temp = None
 
-    def walk(self, afc_service, dir_name):
-        """
-            Walk through all directories on a device via AFC. Adapted from
-            https://github.com/jfarley248/pymobiledevice2.
-        """
-
-        dirs = []
-        files = []
-        try:
-            for fd in afc_service.listdir(dir_name):
-                if fd in ('.', '..', ''):
-                    continue
-                info = afc_service.stat(posixpath_join(dir_name, fd))
-                if info and info.get('st_ifmt') == 'S_IFDIR':
-                    dirs.append(fd)
-                else:
-                    files.append(fd)
-        except AfcException as e:
-            if 'PERM_DENIED' in str(e):
-                if self.arguments.verbose:
-                    utils.multi_print(f"{Fore.RED}\tPermission denied: {Fore.RESET}{dir_name}")
-
-        yield dir_name, dirs, files
-
-        if dirs:
-            for d in dirs:
-                for walk_result in self.walk(afc_service, posixpath_join(dir_name, d)):
-                    yield walk_result
-
     @staticmethod
     def get_device():
         """
@@ -167,6 +143,8 @@ class IosImagerAFC(plugin_manager.Plugin):
 
             afc = AfcService(lockdown=LockdownClient(serial=device.all_values['UniqueDeviceID']),
                              service_name=self.service)
+            sessions = [afc] + self.open_sessions(device.all_values['UniqueDeviceID'],
+                                                  getattr(self.arguments, "connections", acquisition.CONNECTIONS) - 1)
 
         # Catch errors that can happen and give a message.
         except StartServiceError as e:
@@ -185,101 +163,52 @@ class IosImagerAFC(plugin_manager.Plugin):
             utils.multi_print(f"{Fore.RED}[-] Error: Lockdownd: {Fore.RESET}{e}")
             return False
 
-        utils.multi_print(f"{Fore.GREEN}[+] Connected to service.")
-        imager = imaging.Imager(self.arguments.verbose, zip=zip_image)
-        output_path, old_path, tmp_path = self.imager.setup_tmp_directory(self.temp, output_file)
-        chdir(tmp_path)
-        utils.multi_print(f"{Fore.GREEN}[+] Pulling filesystem...")
+        utils.multi_print(f"{Fore.GREEN}[+] Connected to service over {Fore.RESET}{len(sessions)}{Fore.GREEN} "
+                          f"connections.")
+        imager = imaging.Imager.from_arguments(self.arguments, zip=zip_image)
+        output_path = path.abspath(output_file)
+        utils.multi_print(f"{Fore.GREEN}[+] Pulling filesystem and adding to container...")
+        if self.arguments.verbose:
+            utils.multi_print(f"{Fore.GREEN}[*] Container path: {Fore.RESET}{output_path}")
+        engine = AfcEngine(sessions, self.arguments.verbose, skip=imager.committed,
+                           read_depth=getattr(self.arguments, "read_depth", READ_DEPTH), unchanged=imager.is_unchanged)
         try:
-            data = None
-            for file_system in self.walk(afc, "/"):
-                # Make directories
-                for directory in file_system[1]:
-                    full_path = utils.check_file_names(tmp_path + file_system[0].replace("/", self.imager.separator)
-                                                       + self.imager.separator + directory)
-                    info = afc.stat(file_system[0] + "/" + directory)
-                    path = "/"
-                    if file_system[0] == "/":
-                        path = ""
-                    if self.arguments.verbose:
-                        utils.multi_print(f"{Fore.GREEN}\tMaking directory: "
-                                          f"{Fore.RESET}{file_system[0] + path + directory}")
-                    try:
-                        mkdir(full_path)
-                    # On Windows, folder names are case-insensitive. This catches and renames them.
-                    except FileExistsError:
-                        if "_AFFLUX_DUPLICATE_" in full_path:
-                            full_path = full_path[:-1] + str(int(full_path[-1]) + 1)
-                        else:
-                            full_path = full_path + "_AFFLUX_DUPLICATE_FOLDERNAME_1"
-                        mkdir(full_path)
-                        continue
-                    # Change directory modify time
-                    utils.modify_time(info, full_path)
-                # Make and copy file data
-                for file in file_system[2]:
-                    info = afc.stat(file_system[0] + "/" + file)
-                    if info['st_ifmt'] == 'S_IFLNK':
-                        if self.arguments.verbose:
-                            utils.multi_print(f"{Fore.GREEN}\tIgnoring symlink: {Fore.RESET}{file}")
-                        continue
-                    path = file_system[0] + "/"
-                    if file_system[0] == "/":
-                        path = "/"
-                    local_file = utils.check_file_names(tmp_path + path.replace("/", self.imager.separator) + file)
-                    open(local_file, 'a').close()
-                    if self.arguments.verbose:
-                        utils.multi_print(f"{Fore.GREEN}\tCopying file: {Fore.RESET}{path + file}")
-                    try:
-                        data = afc.get_file_contents(file_system[0] + "/" + file)
-                        fd = open(local_file, 'ab')
-                        fd.write(data)
-                        fd.close()
-                    except AfcException:
-                        if self.arguments.verbose:
-                            utils.multi_print(f"{Fore.RED}\tPermission denied: {Fore.RESET}{path + file}")
-                        continue
-                    # Files are also case-insensitive.
-                    except FileExistsError:
-                        if "_AFFLUX_DUPLICATE_FILENAME_" in local_file:
-                            local_file = local_file[:-1] + str(int(local_file[-1]) + 1)
-                        else:
-                            local_file = local_file + "_AFFLUX_DUPLICATE_FILENAME_1"
-                        fd = open(local_file, 'ab')
-                        fd.write(data)
-                        fd.close()
-                        continue
-
-                    # Change file modify time
-                    utils.modify_time(info, local_file)
+            success = imager.add_streams(output_path, engine.copy(["/"]), self.arguments.append, encryption_password)
+            engine.report()
 
         except ConnectionAbortedError:
             utils.multi_print(f"{Fore.RED}[-] Error: Device closed connection.")
-            chdir(old_path)
-            rmtree(tmp_path, ignore_errors=True)
             return False
 
         except OSError as e:
             if "Errno 28" in str(e):
                 utils.multi_print(f"{Fore.RED}[-] Error: Out of storage space on machine.")
-                rmtree(tmp_path, ignore_errors=True)
                 return False
             else:
                 utils.multi_print(f"{Fore.RED}[-] Error: {e}")
+                return False
+
+        finally:
+            engine.close()
 
-        directories = listdir()
-        if self.arguments.verbose:
-            utils.multi_print(f"{Fore.GREEN}[+] Directory list: {Fore.RESET}{', '.join(directories)}")
-        utils.multi_print(f"{Fore.GREEN}[+] Adding to container...")
-        if self.arguments.verbose:
-            utils.multi_print(f"{Fore.GREEN}[*] Container path: {Fore.RESET}{output_path}")
-        success = imager.add_path_names(output_path, directories, True, self.arguments.append, encryption_password)
-        chdir(old_path)
-        if self.arguments.verbose:
-            utils.multi_print(f"{Fore.GREEN}[*] Cleaning up...")
-        rmtree(tmp_path, ignore_errors=True)
         utils.multi_print(f"{Fore.GREEN}[+] Imaging completed.")
-        return success
+        return engine.result and success
+
+    def open_sessions(self, serial, count):
+        """
+            Start extra AFC connections to the device, so listing and copying can overlap. Stops at the first one the
+            device refuses and carries on with the connections it has.
+        """
+
+        sessions = []
+        for _ in range(max(0, count)):
+            try:
+                sessions.append(AfcService(lockdown=LockdownClient(serial=serial), service_name=self.service))
+            except (StartServiceError, InvalidServiceError, LockdownError, ConnectionError) as e:
+                if self.arguments.verbose:
+                    utils.multi_print(f"{Fore.RED}\t[-] Could not open another AFC connection: {Fore.RESET}{e}")
+                break
+        return sessions
 
     def setup_arg_parser(self, plugin_args, parent_args, parent_parser):
         self.parser = argparse.ArgumentParser(parents=[parent_parser],
@@ -293,6 +222,10 @@ class IosImagerAFC(plugin_manager.Plugin):
                                  help='clear any pairing records made by Afflux.')
         self.parser.add_argument('-k', "--pair", action="store_true",
                                  help='pair or re-pair the device before imaging.')
+        self.parser.add_argument("--connections", action="store", default=acquisition.CONNECTIONS, type=int,
+                                 metavar='N', help='number of AFC connections listing and copying at once. Default is 4.')
+        self.parser.add_argument("--read-depth", action="store", default=READ_DEPTH, type=int, metavar='N',
+                                 help='number of reads kept in flight for each file. Default is 4.')
         self.arguments, extra = self.parser.parse_known_args(plugin_args, parent_args)
         return True
 
@@ -303,7 +236,7 @@ class IosImagerAFC(plugin_manager.Plugin):
         if self.arguments.output is None:
             utils.multi_print(f"{Fore.RED}\tNo output file specified.")
             return False
-        self.imager = imaging.Imager(self.arguments.verbose)
+        self.imager = imaging.Imager.from_arguments(self.arguments)
         if self.arguments.iOS is not None:
             # Image an iOS device via AFC or AFC2
             self.arguments.iOS = self.arguments.iOS[0].strip().lower()
@@ -314,12 +247,150 @@ class IosImagerAFC(plugin_manager.Plugin):
             else:
                 utils.multi_print(f"{Fore.RED}[-] Error: Method {self.arguments.iOS} is not supported.")
                 return False
-            self.image_device_afc(self.arguments.output[0],
-                                  self.arguments.container_password,
-                                  self.arguments.pair,
-                                  self.arguments.clear,
-                                  self.arguments.zip)
+            return self.image_device_afc(self.arguments.output[0],
+                                         self.arguments.container_password,
+                                         self.arguments.pair,
+                                         self.arguments.clear,
+                                         self.arguments.zip)
         else:
             utils.multi_print(f"{Fore.RED}[-] Error: No method specified. Use '-h' to see the plugin options.")
             return False
-        return True
+
+
+def read_pipelined(afc, remote_path, size, stream, read_size=acquisition.READ_SIZE, depth=READ_DEPTH):
+    """
+        Read the first `size` bytes of a file on the device into `stream` through an AFC file handle, keeping up to
+        `depth` read requests outstanding so the device is never waiting on the next request. Only one block per
+        request is held in memory, however big the file is.
+
+        Parameters:
+            afc: AfcService to read with, not used by anything else until the read is done.
+            remote_path: Path of the file on the device.
+            size: Number of bytes to read.
+            stream: File like object the data is written to.
+            read_size: Size of each read.
+            depth: Number of reads to keep outstanding.
+    """
+
+    handle = afc.fopen(remote_path)
+    pending = deque()
+    offset = 0
+    try:
+        while offset < size or pending:
+            while offset < size and len(pending) < depth:
+                length = min(read_size, size - offset)
+                # The device answers requests in order, so reads can be sent before the earlier ones are answered.
+                afc._dispatch_packet(afc_opcode_t.READ, afc_fread_req_t.build({'handle': handle, 'size': length}))
+                pending.append(length)
+                offset += length
+            length = pending.popleft()
+            status, data = afc._receive_data()
+            if status != afc_error_t.SUCCESS:
+                raise AfcException('fread error', status)
+            stream.write(data)
+            if len(data) < length:
+                # The file got shorter since it was listed.
+                return
+    finally:
+        # Collect the answers to reads that won't be used, so the next request gets its own answer.
+        while pending:
+            pending.popleft()
+            afc._receive_data()
+        afc.fclose(handle)
+
+
+class AfcEngine(acquisition.PooledSource):
+    """
+        This class is used to copy a device's filesystem over several AFC connections at once, as an
+        `acquisition.PooledSource`. Each entry is stat'ed once while its folder is listed and that result describes it
+        in the container, and files are streamed through AFC file handles with several reads in flight instead of
+        being loaded whole.
+    """
+
+    protocol = "AFC"
+
+    def __init__(self, sessions, verbose=False, skip=None, read_depth=READ_DEPTH, unchanged=None):
+        """
+            Constructor for the AfcEngine class.
+
+            Parameters:
+                sessions: Connected AfcService instances, one worker is started for each.
+                verbose: Print each folder and file as it is found.
+                skip: Container paths that are already in the image.
+                read_depth: Number of reads kept outstanding for each file.
+                unchanged: Callable taking a container path and its metadata, files it is true for are not copied
+                           unless the imager opens them.
+        """
+
+        super().__init__(sessions, verbose, skip=skip, unchanged=unchanged)
+        self.read_depth = read_depth
+
+    def close(self):
+        """
+            Close every AFC connection.
+        """
+
+        for session in self.sessions:
+            try:
+                session.service.close()
+            except OSError:
+                pass
+
+    @staticmethod
+    def metadata(remote_path, size, info):
+        """
+            Build the metadata for an entry from its AFC stat result.
+        """
+
+        return imaging.create_metadata(remote_path, size, info['st_mtime'], birth_time=info.get('st_birthtime'))
+
+    def list(self, session, remote_dir, folders, symlinks, no_image, recursive, directories, files):
+        """
+            List a directory on the device, collecting its folders for the imager, the directories to walk next and
+            the files to copy, each with the stat result it was listed with.
+        """
+
+        try:
+            names = session.listdir(remote_dir)
+        except AfcException as e:
+            if 'PERM_DENIED' in str(e):
+                if self.verbose:
+                    utils.multi_print(f"{Fore.RED}\tPermission denied: {Fore.RESET}{remote_dir}")
+            else:
+                utils.multi_print(f"{Fore.RED}\t[-] Could not list: {Fore.RESET}{remote_dir} ({e})")
+            return
+
+        for name in names:
+            if name in ('.', '..', ''):
+                continue
+            remote_path = posixpath_join(remote_dir, name)
+            container_path = self.container_path(remote_path)
+            try:
+                info = session.stat(remote_path)
+            except AfcException as e:
+                if self.verbose:
+                    utils.multi_print(f"{Fore.RED}\t[-] Could not stat: {Fore.RESET}{remote_path} ({e})")
+                continue
+
+            # Directory
+            if info.get('st_ifmt') == 'S_IFDIR':
+                if container_path not in self.skip:
+                    if self.verbose:
+                        utils.multi_print(f"{Fore.GREEN}\tMaking directory: {Fore.RESET}{remote_path}")
+                    folders.append((container_path, self.metadata(remote_path, 0, info), None))
+                if recursive:
+                    directories.append(remote_path)
+            # Symlinks
+            elif info.get('st_ifmt') == 'S_IFLNK':
+                if self.verbose:
+                    utils.multi_print(f"{Fore.GREEN}\tIgnoring symlink: {Fore.RESET}{name}")
+            # File
+            elif container_path not in self.skip:
+                files.append((remote_path, self.metadata(remote_path, int(info['st_size']), info)))
+
+    def read(self, session, remote_path, size, stream):
+        """
+            Stream a file off the device with pipelined reads.
+        """
+
+        read_pipelined(session, remote_path, size, stream, depth=self.read_depth)
@@ -56,26 +56,25 @@ class DiskImage(plugin_manager.Plugin):
 
     def run(self):
         utils.multi_print(f"{Fore.GREEN}[+] Loaded Disk Imaging plugin.")
-        imager = imaging.Imager(self.arguments.verbose, zip=self.arguments.zip)
+        imager = imaging.Imager.from_arguments(self.arguments, zip=self.arguments.zip)
         # Image a folder
         if self.arguments.folder or self.arguments.file:
             if self.arguments.folder:
-                imager.add_path_names(self.arguments.output[0],             # Output AFF4 container name.
-                                      self.arguments.folder,                # Path names to image.
-                                      self.arguments.recursive,             # Recursively image.
-                                      self.arguments.append,                # Append files to pre-existing image.
-                                      self.arguments.container_password,    # Encryption password.
-                                      symlinks=self.arguments.symlinks)     # Enable symlinks.
+                return imager.add_path_names(self.arguments.output[0],            # Output AFF4 container name.
+                                             self.arguments.folder,               # Path names to image.
+                                             self.arguments.recursive,            # Recursively image.
+                                             self.arguments.append,               # Append files to pre-existing image.
+                                             self.arguments.container_password,   # Encryption password.
+                                             symlinks=self.arguments.symlinks)    # Enable symlinks.
 
             # Image a file
-            elif self.arguments.file:
-                imager.add_path_names(self.arguments.output[0],
-                                      self.arguments.file,
-                                      self.arguments.recursive,
-                                      self.arguments.append,
-                                      self.arguments.container_password,
-                                      symlinks=self.arguments.symlinks)
-            return True
+            else:
+                return imager.add_path_names(self.arguments.output[0],
+                                             self.arguments.file,
+                                             self.arguments.recursive,
+                                             self.arguments.append,
+                                             self.arguments.container_password,
+                                             symlinks=self.arguments.symlinks)
         else:
             utils.multi_print(f"{Fore.RED} \n[-] No folder or file supplied.")
             return False
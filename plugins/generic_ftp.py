@@ -2,14 +2,16 @@
 # Plugin to image a generic device over SSH
 
 import argparse
-from os import makedirs, chdir, listdir
+import posixpath
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from os import path
 
 import ftplib
-from dateutil import parser, relativedelta
-import datetime
-from shutil import rmtree
+from dateutil import parser
 from colorama import reinit, Fore
 
+import acquisition
 import imaging
 import plugin_manager
 import utilities
@@ -39,87 +41,28 @@ class GenericFTP(plugin_manager.Plugin):
         self.temp = None
         self.seperator = "/"
 
-    def ftp_copy_and_image_r(self, ftp_server, remote_dir, password, symlinks, no_image, recursive,
-                             preserve_mtime=True):
+    @staticmethod
+    def connect(hostname, port, username, password, timeout, ftp_server=None):
         """
-            Copy over a file from the device via FTP and immediately append it to the image.
+            Connect and log in to the FTP server. An existing connection can be passed to connect it again.
         """
-        output = []
-        # Get the files on the FTP server
-        ftp_server.dir(remote_dir, output.append)
-        for line in output:
-            line = line.split(None, 8)
 
-            # Fix for year not appearing for timestamps under 6 months old. If there isn't a year, calculate it and
-            # add it to the timestamp.
-            if ":" in line[7]:
-                test = datetime.datetime.now() - relativedelta.relativedelta(months=6)
-                line[6] = line[6] + " " + str(test.year)
+        ftp_server = ftp_server if ftp_server is not None else ftplib.FTP()
+        ftp_server.connect(hostname, port=port, timeout=timeout)
+        ftp_server.login(username, password)
+        return ftp_server
 
-            time_str = line[5] + " " + line[6] + " " + line[7]
-            time = parser.parse(time_str)
+    @staticmethod
+    def features(ftp_server):
+        """
+            Get the extensions the server lists for `FEAT`, such as "MLST", "MDTM" and "REST STREAM".
+        """
 
-            filename = line[-1]
-            if remote_dir != "":
-                remote_path = remote_dir + self.seperator + filename
-            else:
-                remote_path = remote_dir + filename
-            if remote_dir == "/":
-                remote_dir = ""
-            local_path = utils.check_file_names(self.tmp_path + self.seperator + remote_dir + self.seperator + filename)
-            skip = False
-
-            # Directory
-            if line[0][:1] == "d":
-                if no_image:
-                    for dir in no_image:
-                        if dir == remote_path:
-                            utils.multi_print(f"{Fore.RED}\tSkipping directory: {Fore.RESET}{remote_path}")
-                            skip = True
-                if skip:
-                    continue
-                try:
-                    if self.arguments.verbose:
-                        utils.multi_print(f"{Fore.GREEN}\tCreating directory: {Fore.RESET}{remote_path}")
-                    makedirs(local_path)
-                except OSError:
-                    pass
-                if recursive:
-                    self.ftp_copy_and_image_r(ftp_server, remote_path, password, symlinks, no_image, preserve_mtime)
-
-            # File
-            elif line[0][:1] == "-":
-                if no_image:
-                    for dir in no_image:
-                        if dir == remote_path:
-                            utils.multi_print(f"{Fore.RED}\tSkipping file: {Fore.RESET}{remote_path}")
-                            skip = True
-                if skip:
-                    continue
-                try:
-                    if self.arguments.verbose:
-                        utils.multi_print(f"{Fore.GREEN}\tCopying file: {Fore.RESET}{remote_path}")
-                    with open(local_path, "wb") as file:
-                        ftp_server.retrbinary(f"RETR {remote_path}", file.write)
-                    utils.modify_time(time, local_path, st_mtime=False)
-                except PermissionError:
-                    if self.arguments.verbose:
-                        utils.multi_print(f"{Fore.RED}\t[-] Error: Permission denied.")
-                except FileNotFoundError:
-                    if self.arguments.verbose:
-                        utils.multi_print(f"{Fore.RED}\t[-] Error: File not found or not accessible: {remote_dir}")
-
-            # Symlinks? Yes
-            elif line[0][:1] == "l":
-                symlink_target = line[-1]
-                if symlinks:
-                    self.ftp_copy_and_image_r(ftp_server, symlink_target, password, symlinks, no_image, preserve_mtime)
-                else:
-                    utils.multi_print(f"{Fore.GREEN}\tSkipping symlink to: {Fore.RESET}{symlink_target}")
-            else:
-                print(line)
-                print("Permissions thing? Shouldn't be here.")
-                exit()
+        try:
+            response = ftp_server.sendcmd("FEAT")
+        except ftplib.Error:
+            return set()
+        return {line.strip().upper() for line in response.splitlines()[1:-1] if line.strip()}
 
     def image_ftp(self, output_file, encryption_password, remote_dir, hostname, username, password, symlinks, timeout,
                   recursive, zip_image, port=21):
@@ -128,17 +71,18 @@ class GenericFTP(plugin_manager.Plugin):
         """
 
         no_image = []
-        self.imager = imaging.Imager(self.arguments.verbose, zip=zip_image)
+        self.imager = imaging.Imager.from_arguments(self.arguments, zip=zip_image)
 
         if self.arguments.verbose:
             utils.multi_print(f"{Fore.GREEN}[*] Address, Port: {Fore.RESET}{hostname}, {port}")
             utils.multi_print(f"{Fore.GREEN}[*] Username, Password: {Fore.RESET}{username}, {password}")
 
+        connect = partial(self.connect, hostname, port, username, password, timeout)
+        connections = getattr(self.arguments, "connections", acquisition.CONNECTIONS)
         try:
             utils.multi_print(f"{Fore.GREEN}[*] Attempting to connect...")
-            ftp_server = ftplib.FTP()
-            ftp_server.connect(hostname, port=port, timeout=timeout)
-            ftp_server.login(username, password)
+            sessions = FtpEngine.open_sessions(connect, connections, self.arguments.verbose)
+            ftp_server = sessions[0]
         except ConnectionRefusedError:
             utils.multi_print(f"{Fore.RED}[-] Error: Could not connect to service.")
             return False
@@ -148,9 +92,6 @@ class GenericFTP(plugin_manager.Plugin):
         if self.arguments.verbose:
             utils.multi_print(f"{Fore.GREEN}[+] Connected to FTP service.")
 
-        output_path, old_path, self.tmp_path = self.imager.setup_tmp_directory(self.temp, output_file)
-        chdir(self.tmp_path)
-
         # If no `-d` switch is used, start at `/`
         if not remote_dir:
             target_dir = "/"
@@ -168,17 +109,24 @@ class GenericFTP(plugin_manager.Plugin):
             for not_image_path in no_image:
                 remote_dir.remove(not_image_path + "-")
 
-        utils.multi_print(f"{Fore.GREEN}[*] Copying files...")
-        self.ftp_copy_and_image_r(ftp_server, target_dir, encryption_password, symlinks, no_image,
-                                  recursive, preserve_mtime=True)
+        features = self.features(ftp_server)
         if self.arguments.verbose:
-            utils.multi_print(f"{Fore.GREEN}[*] Closing FTP connection.")
-        ftp_server.quit()
-        directories = listdir()
-        self.imager.add_path_names(output_path, directories, True, self.arguments.append, encryption_password)
-        chdir(old_path)
-        rmtree(self.tmp_path, ignore_errors=True)
-        return True
+            utils.multi_print(f"{Fore.GREEN}[*] Server features: {Fore.RESET}{', '.join(sorted(features))}")
+
+        utils.multi_print(f"{Fore.GREEN}[*] Copying files over {Fore.RESET}{len(sessions)}{Fore.GREEN} "
+                          f"FTP connections...")
+        engine = FtpEngine(sessions, connect, features, self.arguments.verbose, skip=self.imager.committed,
+                           unchanged=self.imager.is_unchanged)
+        try:
+            success = self.imager.add_streams(path.abspath(output_file),
+                                              engine.copy([target_dir], symlinks, no_image, recursive),
+                                              self.arguments.append, encryption_password)
+            engine.report()
+        finally:
+            if self.arguments.verbose:
+                utils.multi_print(f"{Fore.GREEN}[*] Closing FTP connections.")
+            engine.close()
+        return success
 
     def setup_arg_parser(self, plugin_args, parent_args, parent_parser):
         self.parser = argparse.ArgumentParser(parents=[parent_parser],
@@ -200,6 +148,9 @@ class GenericFTP(plugin_manager.Plugin):
                                  help='Remote directory to begin imaging.')
         self.parser.add_argument("--timeout", action="store", nargs=1, default=[5], type=int, metavar='TIMEOUT',
                                  help='FTP connection timeout.')
+        self.parser.add_argument("--connections", action="store", default=acquisition.CONNECTIONS, type=int,
+                                 metavar='N', help='number of FTP connections to list and download files over at once. '
+                                                   'Default is 4.')
         self.arguments, extra = self.parser.parse_known_args(plugin_args, parent_args)
         return True
 
@@ -208,28 +159,243 @@ class GenericFTP(plugin_manager.Plugin):
         if self.arguments.temp:
             self.temp = self.arguments.temp
         if self.arguments.address:
-            if self.arguments.port is not None:
-                self.image_ftp(self.arguments.output[0],
-                               self.arguments.container_password,
-                               self.arguments.directory,
-                               self.arguments.address[0],
-                               self.arguments.username[0],
-                               self.arguments.password[0],
-                               self.arguments.symlinks,
-                               self.arguments.timeout,
-                               self.arguments.recursive,
-                               port=int(self.arguments.port[0]))
-            else:
-                self.image_ftp(self.arguments.output[0],
-                               self.arguments.container_password,
-                               self.arguments.directory,
-                               self.arguments.address[0],
-                               self.arguments.username[0],
-                               self.arguments.password[0],
-                               self.arguments.timeout,
-                               self.arguments.recursive,
-                               self.arguments.symlinks)
-            return True
+            return self.image_ftp(self.arguments.output[0],
+                                  self.arguments.container_password,
+                                  self.arguments.directory,
+                                  self.arguments.address[0],
+                                  self.arguments.username[0],
+                                  self.arguments.password[0],
+                                  self.arguments.symlinks,
+                                  self.arguments.timeout[0],
+                                  self.arguments.recursive,
+                                  self.arguments.zip,
+                                  port=int(self.arguments.port[0]) if self.arguments.port is not None else 21)
         else:
             self.parser.print_help()
             return False
+
+
+def parse_mlsd_time(value):
+    """
+        Parse an MLSD `modify` fact or MDTM reply, "YYYYMMDDHHMMSS" with optional fractional seconds, which is UTC.
+    """
+
+    modified = datetime.strptime(value[:14], "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc)
+    if value[14:15] == "." and value[15:].isdigit():
+        modified += timedelta(seconds=float("0." + value[15:]))
+    return modified
+
+
+def parse_list_time(month, day, year_or_time):
+    """
+        Parse the timestamp columns of a Unix style `LIST` line. Recent timestamps have a time instead of a year, and
+        are within the last six months, so they are in this year unless that would put them in the future.
+    """
+
+    if ":" not in year_or_time:
+        return parser.parse(f"{month} {day} {year_or_time}")
+    now = datetime.now()
+    for year in (now.year, now.year - 1):
+        try:
+            modified = parser.parse(f"{month} {day} {year} {year_or_time}")
+        except ValueError:
+            # February 29th in a year that isn't a leap year.
+            continue
+        if modified <= now + timedelta(days=1):
+            return modified
+    return modified
+
+
+class FtpEngine(acquisition.PooledSource):
+    """
+        This class is used to download files from an FTP server over several connections at once, as an
+        `acquisition.PooledSource`. Directories are listed with `MLSD` when the server offers it, which gives exact
+        sizes and UTC timestamps, and with `LIST` and `MDTM` otherwise. Downloads that are cut off are resumed with
+        `REST` on a new connection.
+    """
+
+    protocol = "FTP"
+
+    def __init__(self, sessions, connect, features, verbose=False, skip=None, retries=3, unchanged=None):
+        """
+            Constructor for the FtpEngine class.
+
+            Parameters:
+                sessions: Logged in `ftplib.FTP` connections, one worker is started for each.
+                connect: Callable that connects and logs in the `ftplib.FTP` connection it is given again.
+                features: Extensions the server lists for `FEAT`.
+                verbose: Print each folder and file as it is found.
+                skip: Container paths that are already in the image.
+                retries: Number of times to reconnect and resume a download before giving up on it.
+                unchanged: Callable taking a container path and its metadata, files it is true for are not downloaded
+                           unless the imager opens them.
+        """
+
+        super().__init__(sessions, verbose, skip=skip, unchanged=unchanged)
+        self.connect = connect
+        self.mlsd = any(feature.startswith("MLST") for feature in features)
+        self.mdtm = "MDTM" in features
+        self.rest = "REST STREAM" in features
+        self.retries = retries
+        self.resumed = 0
+
+    def close(self):
+        """
+            Close every connection.
+        """
+
+        for session in self.sessions:
+            try:
+                session.quit()
+            except (ftplib.Error, OSError, EOFError):
+                session.close()
+
+    def entries(self, session, remote_dir):
+        """
+            List a directory, yielding (name, kind, size, modified, mode, target) tuples where kind is "dir", "file" or
+            "link" and target is where a symlink points, if the server says.
+        """
+
+        if self.mlsd:
+            for name, facts in session.mlsd(remote_dir):
+                kind = facts.get("type", "").lower()
+                if kind in ("cdir", "pdir"):
+                    continue
+                target = None
+                if kind.startswith("os.unix=slink") or kind == "os.unix=symlink":
+                    target = facts["type"].split(":", 1)[1] if ":" in facts["type"] else None
+                    kind = "link"
+                elif kind not in ("dir", "file"):
+                    kind = "other"
+                modified = parse_mlsd_time(facts["modify"]) if "modify" in facts else None
+                mode = int(facts["unix.mode"], 8) if facts.get("unix.mode", "").isdigit() else None
+                yield name, kind, int(facts.get("size", 0)), modified, mode, target
+            return
+
+        output = []
+        session.dir(remote_dir, output.append)
+        for line in output:
+            fields = line.split(None, 8)
+            # Skip the "total" line and anything else that isn't a Unix style listing.
+            if len(fields) < 9 or not fields[4].isdigit():
+                continue
+            name, target = fields[8], None
+            kind = {"d": "dir", "-": "file", "l": "link"}.get(fields[0][:1], "other")
+            if kind == "link" and " -> " in name:
+                name, target = name.split(" -> ", 1)
+            if name in (".", ".."):
+                continue
+            try:
+                modified = parse_list_time(fields[5], fields[6], fields[7])
+            except ValueError:
+                modified = None
+            if kind == "file" and self.mdtm:
+                try:
+                    modified = parse_mlsd_time(session.sendcmd(f"MDTM {posixpath.join(remote_dir, name)}")[4:])
+                except (ftplib.Error, ValueError):
+                    pass
+            yield name, kind, int(fields[4]), modified, None, target
+
+    def list(self, session, remote_dir, folders, symlinks, no_image, recursive, directories, files):
+        """
+            List a remote directory, collecting its folders for the imager, the directories to walk next and the
+            files to download.
+        """
+
+        try:
+            for name, kind, size, modified, mode, target in self.entries(session, remote_dir):
+                remote_path = posixpath.join(remote_dir, name)
+                if kind == "dir":
+                    if remote_path in no_image:
+                        utils.multi_print(f"{Fore.RED}\tSkipping directory: {Fore.RESET}{remote_path}")
+                        continue
+                    if remote_path.lstrip("/") not in self.skip:
+                        if self.verbose:
+                            utils.multi_print(f"{Fore.GREEN}\tCreating directory: {Fore.RESET}{remote_path}")
+                        folders.append((remote_path.lstrip("/"),
+                                        imaging.create_metadata(remote_path, 0, modified, mode=mode), None))
+                    if recursive:
+                        directories.append(remote_path)
+                elif kind == "file":
+                    if remote_path in no_image:
+                        utils.multi_print(f"{Fore.RED}\tSkipping file: {Fore.RESET}{remote_path}")
+                        continue
+                    if remote_path.lstrip("/") not in self.skip:
+                        files.append((remote_path, imaging.create_metadata(remote_path, size, modified, mode=mode)))
+                elif kind == "link":
+                    if not (symlinks and recursive):
+                        if self.verbose:
+                            utils.multi_print(f"{Fore.GREEN}\tSkipping symlink: {Fore.RESET}{remote_path}")
+                        continue
+                    # Walk the link as a directory, once for each place links lead to.
+                    real_path = posixpath.normpath(posixpath.join(remote_dir, target)) if target else remote_path
+                    with self.lock:
+                        if real_path in self.visited:
+                            continue
+                        self.visited.add(real_path)
+                    directories.append(remote_path)
+                elif self.verbose:
+                    utils.multi_print(f"{Fore.RED}\t[-] Special file, skipping: {Fore.RESET}{remote_path}")
+
+        except ftplib.error_perm as e:
+            if self.verbose:
+                utils.multi_print(f"{Fore.RED}\t[-] Could not list: {Fore.RESET}{remote_dir} ({e})")
+
+        except (ftplib.Error, OSError, EOFError) as e:
+            utils.multi_print(f"{Fore.RED}[-] Error: Could not list: {Fore.RESET}{remote_dir} ({e})")
+            self.reconnect(session)
+
+    def reconnect(self, session):
+        """
+            Connect a session again after its connection failed. Returns False if it couldn't be.
+        """
+
+        session.close()
+        try:
+            self.connect(ftp_server=session)
+            return True
+        except (ftplib.Error, OSError, EOFError) as e:
+            utils.multi_print(f"{Fore.RED}[-] Could not reconnect to the FTP server: {Fore.RESET}{e}")
+            return False
+
+    def read(self, session, remote_path, size, stream):
+        """
+            Download a remote file into `stream`. If the download is cut off, the connection is opened again and the
+            download carries on from where it stopped with `REST`, or starts again if nothing had arrived yet.
+        """
+
+        received = 0
+
+        def write(data):
+            nonlocal received
+            stream.write(data)
+            received += len(data)
+
+        attempts = 0
+        while True:
+            try:
+                session.retrbinary(f"RETR {remote_path}", write, blocksize=acquisition.READ_SIZE,
+                                   rest=received or None)
+                return
+            except BrokenPipeError:
+                # The imager stopped reading the file.
+                raise
+            except (ftplib.error_temp, ftplib.error_reply, OSError, EOFError) as e:
+                attempts += 1
+                if attempts > self.retries or (received and not self.rest):
+                    raise
+                if self.verbose:
+                    utils.multi_print(f"{Fore.RED}\tDownload interrupted, resuming at {Fore.RESET}{received}"
+                                      f"{Fore.RED} bytes: {Fore.RESET}{remote_path} ({e})")
+                if not self.reconnect(session):
+                    raise
+                self.resumed += 1
+
+    def report(self):
+        """
+            Print the throughput of each worker and how many downloads were resumed.
+        """
+
+        super().report()
+        if self.resumed:
+            utils.multi_print(f"{Fore.GREEN}\tResumed downloads: {Fore.RESET}{self.resumed}")
@@ -2,13 +2,15 @@
 # Pull data from HTTP and toss it in an AFF4 container.
 
 import argparse
+from email.utils import parsedate_to_datetime
 
+import requests
 from colorama import reinit, Fore
-from os import path, listdir, chdir, mkdir
-from requests import get
-from urllib.parse import unquote, urlsplit
+from os import path
+from urllib.parse import unquote, urljoin, urldefrag, urlsplit
 from bs4 import BeautifulSoup
 
+import acquisition
 import imaging
 import plugin_manager
 import utilities
@@ -16,6 +18,9 @@ import utilities
 reinit()  # Colorama
 utils = utilities.Utilities.get_instance()
 
+# Seconds to wait on the server before a request fails.
+HTTP_TIMEOUT = 30
+
 
 class HttpImage(plugin_manager.Plugin):
     """
@@ -37,82 +42,31 @@ class HttpImage(plugin_manager.Plugin):
         self.imager = None
         self.temp = None
         self.base_urls = []
-
-    def generate_links(self, response):
-        """
-            Get the links from the response.
-        """
-
-        urls = []
-        soup = BeautifulSoup(response.text, 'html.parser')
-        for link in soup.find_all('a'):
-            url = link.get('href')
-            if url.strip() == "/":
-                continue
-            urls.append(url)
-        return urls
-
-    def download_dir(self, links, output, recursive, chunk_size):
-        """
-            Recursively download files and folders from a web directory
-        """
-        # TODO: Think about infinite loops?
-        for url in links:
-            try:
-                response = get(url)
-                for item in self.generate_links(response):
-                    item_url = url + item
-                    item_dst = utils.check_file_names(path.join(output, item))
-
-                    # Folders
-                    if item.endswith('/'):
-                        if recursive:
-                            mkdir(unquote(item_dst))
-                            self.download_dir([item_url], item_dst, recursive, chunk_size)
-                    # Files
-                    else:
-                        if self.arguments.verbose:
-                            utils.multi_print(f"\t{Fore.GREEN}Downloading: {Fore.RESET}{item_url}")
-                        r = get(item_url, stream=True)
-                        with open(unquote(item_dst), 'wb') as f:
-                            for chunk in r.iter_content(chunk_size):
-                                if chunk:
-                                    f.write(chunk)
-            except Exception as e:
-                if "[Errno 111] Connection refused" in str(e):
-                    utils.multi_print(f"{Fore.RED}[-] Could not connect to: {Fore.RESET}{url}")
-                    return False
-                elif "[Errno 13] Permission denied" in str(e):
-                    utils.multi_print(f"\t{Fore.RED}Permission denied: {Fore.RESET}{url}")
-                    pass
-                elif "Invalid URL" in str(e):
-                    utils.multi_print(f"\t{Fore.RED}Invalid URL: {Fore.RESET}{url}")
-                    pass
-                else:
-                    utils.multi_print(e)
-                    return False
-        return True
+        self.result = True
 
     def http_image(self):
-        self.imager = imaging.Imager(self.arguments.verbose, zip=self.arguments.zip)
-        output_path, old_path, tmp_path = self.imager.setup_tmp_directory(self.arguments.temp, self.arguments.output[0])
-        chdir(tmp_path)
+        self.imager = imaging.Imager.from_arguments(self.arguments, zip=self.arguments.zip)
 
         # Get base urls, so we can check and make sure we stay within the same domain.
         for link in self.arguments.link:
             self.base_urls.append(urlsplit(link).netloc)
 
-        # Download the directories.
-        result = self.download_dir(self.arguments.link, tmp_path, self.arguments.recursive,
-                                   int(self.arguments.chunk_size[0]))
-
-        # If it succeeds, toss it in an AFF4.
-        if result:
-            directories = listdir()
-            self.imager.add_path_names(output_path, directories, True, self.arguments.append,
-                                       self.arguments.container_password)
-        chdir(old_path)
-        return result
+        # Download the directories straight into the container. Against a previous image, each file's headers are
+        # requested first so unchanged files aren't downloaded.
+        unchanged = self.imager.is_unchanged if self.imager.base is not None else None
+        engine = HttpEngine(self.arguments.link, self.base_urls, self.arguments.connections,
+                            int(self.arguments.chunk_size[0]), self.arguments.verbose, skip=self.imager.committed,
+                            unchanged=unchanged)
+        utils.multi_print(f"{Fore.GREEN}[*] Downloading over {Fore.RESET}{len(engine.sessions)}{Fore.GREEN} "
+                          f"connections...")
+        try:
+            success = self.imager.add_streams(path.abspath(self.arguments.output[0]),
+                                              engine.crawl(self.arguments.recursive),
+                                              self.arguments.append, self.arguments.container_password)
+            engine.report()
+        finally:
+            engine.close()
+        return engine.result and success
 
     def setup_arg_parser(self, plugin_args, parent_args, parent_parser):
         """
@@ -127,10 +81,13 @@ class HttpImage(plugin_manager.Plugin):
                                               add_help=False)
         self.parser.add_argument('-l', "--link", action="store", nargs="*", metavar='LINK',
                                  help='create image from a link.')
-        self.parser.add_argument('-c', "--chunk-size", action="store", nargs="*", default=[1024], type=int,
-                                 help='chunk size to download with. Default is 1024.')
+        self.parser.add_argument('-c', "--chunk-size", action="store", nargs="*", default=[acquisition.READ_SIZE],
+                                 type=int, help='chunk size to download with. Default is 1048576.')
         self.parser.add_argument('-r', "--recursive", action="store_true", default=False,
                                  help='add files and folders recursively.')
+        self.parser.add_argument("--connections", action="store", default=acquisition.CONNECTIONS, type=int,
+                                 metavar='N', help='number of connections to crawl and download over at once. '
+                                                   'Default is 4.')
 
         # Parse afflux and plugin arguments, and store them in `self.arguments`.
         self.arguments, extra = self.parser.parse_known_args(plugin_args, parent_args)
@@ -143,3 +100,214 @@ class HttpImage(plugin_manager.Plugin):
         else:
             self.parser.print_help()
             return False
+
+
+class HttpEngine(acquisition.PooledSource):
+    """
+        This class is used to crawl web directory listings and download their files over several pooled connections at
+        once, as an `acquisition.PooledSource`. Each worker keeps its own `requests.Session`, so connections are reused
+        instead of opened for every request. Every URL is only visited once and links are only followed on the hosts and
+        under the links that were given. Downloads that are cut off are resumed with `Range` requests when the server
+        allows it.
+    """
+
+    protocol = "HTTP"
+
+    def __init__(self, links, hosts, connections=acquisition.CONNECTIONS, chunk_size=acquisition.READ_SIZE,
+                 verbose=False, skip=None, retries=3, unchanged=None):
+        """
+            Constructor for the HttpEngine class.
+
+            Parameters:
+                links: Directory listings or files to download.
+                hosts: Hosts links can be followed to.
+                connections: Number of workers, each with its own session.
+                chunk_size: Size of the chunks downloads are read in.
+                verbose: Print each folder and file as it is found.
+                skip: Container paths that are already in the image.
+                retries: Number of times to resume a download before giving up on it.
+                unchanged: Callable taking a container path and its metadata, files it is true for are not downloaded
+                           unless the imager opens them.
+        """
+
+        super().__init__([requests.Session() for _ in range(max(1, connections))], verbose, skip=skip,
+                         unchanged=unchanged)
+        for session in self.sessions:
+            # Files are stored as they are on the server, and Content-Length is then their size.
+            session.headers["Accept-Encoding"] = "identity"
+        # Longest first, so a URL is stored relative to the deepest link it is under.
+        self.links = sorted(links, key=len, reverse=True)
+        self.hosts = set(hosts)
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.resumed = 0
+
+    def crawl(self, recursive):
+        """
+            Download the links, yielding (path, metadata, stream) tuples as folders are found and files arrive.
+        """
+
+        self.visited.update(urldefrag(link)[0] for link in self.links)
+        self.files.extend((link, None) for link in self.links
+                          if not link.endswith("/") and self.container_path(link) not in self.skip)
+        yield from self.copy([link for link in self.links if link.endswith("/")], recursive=recursive)
+
+    def container_path(self, url):
+        """
+            Get the path a URL is stored under in the container, its path under the link it was found from.
+        """
+
+        for link in self.links:
+            if url.startswith(link) and url != link:
+                return unquote(url[len(link):]).strip("/")
+        return unquote(urlsplit(url).path).strip("/").split("/")[-1]
+
+    def in_scope(self, url):
+        """
+            Check if a URL is on one of the hosts and under one of the links being imaged.
+        """
+
+        parts = urlsplit(url)
+        if parts.netloc not in self.hosts:
+            return False
+        # Query strings are sort orders and the like on directory listings.
+        return not parts.query and any(url.startswith(link) for link in self.links)
+
+    def list(self, session, url, folders, symlinks, no_image, recursive, directories, files):
+        """
+            Fetch a directory listing, collecting its folders for the imager, the listings to crawl next and the files
+            to download.
+        """
+
+        try:
+            response = session.get(url, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+            for link in BeautifulSoup(response.text, 'html.parser').find_all('a'):
+                href = link.get('href')
+                if not href or href.strip() == "/":
+                    continue
+                item_url = urldefrag(urljoin(url, href.strip()))[0]
+                if not self.in_scope(item_url):
+                    if self.verbose and urlsplit(item_url).netloc not in self.hosts:
+                        utils.multi_print(f"\t{Fore.RED}Skipping link to another host: {Fore.RESET}{item_url}")
+                    continue
+                with self.lock:
+                    if item_url in self.visited:
+                        continue
+                    self.visited.add(item_url)
+                container_path = self.container_path(item_url)
+
+                # Folders
+                if item_url.endswith('/'):
+                    if recursive:
+                        if container_path not in self.skip:
+                            folders.append((container_path, imaging.create_metadata(container_path, 0, None), None))
+                        directories.append(item_url)
+                # Files
+                elif container_path not in self.skip:
+                    files.append((item_url, None))
+
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in (401, 403):
+                utils.multi_print(f"\t{Fore.RED}Permission denied: {Fore.RESET}{url}")
+            else:
+                utils.multi_print(f"\t{Fore.RED}Could not list: {Fore.RESET}{url} ({e})")
+
+        except (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema):
+            utils.multi_print(f"\t{Fore.RED}Invalid URL: {Fore.RESET}{url}")
+
+        except requests.RequestException as e:
+            if "Connection refused" in str(e):
+                utils.multi_print(f"{Fore.RED}[-] Could not connect to: {Fore.RESET}{url}")
+            else:
+                utils.multi_print(f"{Fore.RED}[-] Error listing {Fore.RESET}{url}{Fore.RED}: {Fore.RESET}{e}")
+            self.result = False
+
+    @staticmethod
+    def response_metadata(container_path, response):
+        """
+            Build the metadata for a download from its response headers. A chunked response has no Content-Length, it
+            is listed with a size of 0 and the imager stores the size that was actually downloaded.
+        """
+
+        last_modified = response.headers.get("Last-Modified")
+        if last_modified:
+            last_modified = parsedate_to_datetime(last_modified)
+        length = response.headers.get("Content-Length")
+        if response.headers.get("Content-Encoding", "identity").lower() != "identity" or not length:
+            length = 0
+        return imaging.create_metadata(container_path, int(length), last_modified)
+
+    def open(self, session, item):
+        """
+            Start downloading one file. Its metadata comes from the response headers, so the file is only requested
+            once. When files can be unchanged since a previous image, only the headers are requested here and the file
+            is downloaded if the imager reads it.
+        """
+
+        url = item[0]
+        try:
+            if self.unchanged is not None:
+                response = session.head(url, allow_redirects=True, timeout=HTTP_TIMEOUT)
+            else:
+                if self.verbose:
+                    utils.multi_print(f"\t{Fore.GREEN}Downloading: {Fore.RESET}{url}")
+                response = session.get(url, stream=True, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            utils.multi_print(f"\t{Fore.RED}Could not download: {Fore.RESET}{url} ({e})")
+            return None
+        container_path = self.container_path(url)
+        fsmeta = self.response_metadata(container_path, response)
+        if self.unchanged is not None:
+            response.close()
+            response = None
+        return container_path, fsmeta, lambda stream: self.download(session, url, response, stream)
+
+    def download(self, session, url, response, stream):
+        """
+            Write a response's content to `stream`, requesting the file first if `response` is None. If the download
+            is cut off and the server accepts ranges, the rest is requested from where it stopped, as long as the file
+            hasn't changed since.
+        """
+
+        if response is None:
+            if self.verbose:
+                utils.multi_print(f"\t{Fore.GREEN}Downloading: {Fore.RESET}{url}")
+            response = session.get(url, stream=True, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+        received = 0
+        attempts = 0
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        resumable = response.headers.get("Accept-Ranges", "").lower() == "bytes" and validator is not None
+        while True:
+            try:
+                for chunk in response.iter_content(self.chunk_size):
+                    if chunk:
+                        stream.write(chunk)
+                        received += len(chunk)
+                return
+            except requests.RequestException as e:
+                response.close()
+                attempts += 1
+                if not resumable or attempts > self.retries:
+                    raise
+                if self.verbose:
+                    utils.multi_print(f"\t{Fore.RED}Download interrupted, resuming at {Fore.RESET}{received}"
+                                      f"{Fore.RED} bytes: {Fore.RESET}{url} ({e})")
+                response = session.get(url, stream=True, timeout=HTTP_TIMEOUT,
+                                       headers={"Range": f"bytes={received}-", "If-Range": validator})
+                if response.status_code != 206:
+                    # The file changed, or the server sent all of it again.
+                    response.close()
+                    raise IOError(f"Could not resume {url}, the server answered {response.status_code}.")
+                self.resumed += 1
+
+    def report(self):
+        """
+            Print the throughput of each worker and how many downloads were resumed.
+        """
+
+        super().report()
+        if self.resumed:
+            utils.multi_print(f"{Fore.GREEN}\tResumed downloads: {Fore.RESET}{self.resumed}")
@@ -2,14 +2,15 @@
 # Plugin to image a generic device over SSH
 
 import argparse
-from os import makedirs, chdir, listdir
+from collections import deque
+from itertools import chain
+from os import path
 
 from smbclient import scandir, stat, open_file, register_session
 from smbprotocol import exceptions
-from datetime import datetime
-from shutil import rmtree
 from colorama import reinit, Fore
 
+import acquisition
 import imaging
 import plugin_manager
 import utilities
@@ -17,6 +18,11 @@ import utilities
 reinit()  # Colorama
 utils = utilities.Utilities.get_instance()
 
+# Number of SMB2 READ requests kept outstanding for each file.
+READ_DEPTH = 4
+# Bytes covered by one SMB2 credit.
+CREDIT_SIZE = 65536
+
 
 class GenericSMB(plugin_manager.Plugin):
     """
@@ -39,64 +45,13 @@ class GenericSMB(plugin_manager.Plugin):
         self.temp = None
         self.seperator = "/"
 
-    def smb_copy_and_image_r(self, smb, hostname, share, password, symlinks, recursive, preserve_mtime=True):
-        """
-            Copy over a file from the device via SMB and immediately append it to the image.
-        """
-        # Get the files on the SMB server
-        remote_path = f"\\{hostname}\\{share}"
-        for file_info in scandir(remote_path):
-            local_path = utils.check_file_names(self.tmp_path + self.seperator + share.replace("\\", self.seperator) +
-                                                self.seperator + file_info.name)
-
-            # Directory
-            if file_info.is_dir(follow_symlinks=symlinks):
-                try:
-                    if self.arguments.verbose:
-                        utils.multi_print(f"{Fore.GREEN}\tCreating directory: {Fore.RESET}{share}\\{file_info.name}")
-                    makedirs(local_path)
-                except OSError:
-                    pass
-                if recursive:
-                    self.smb_copy_and_image_r(smb, hostname, f"{share}\\{file_info.name}", password, symlinks,
-                                              preserve_mtime)
-
-            # File
-            elif file_info.is_file():
-                try:
-                    # Use stat so we can get the file modified time
-                    file_stat = stat(f"{remote_path}\\{file_info.name}")
-                    if self.arguments.verbose:
-                        utils.multi_print(f"{Fore.GREEN}\tCopying file: {Fore.RESET}{share}\\{file_info.name}")
-                    with open(local_path, "wb") as file:
-                        with open_file(f"{remote_path}\\{file_info.name}", mode="rb") as fd:
-                            file_bytes = fd.read()
-                            file.write(file_bytes)
-                    # Set the modified time.
-                    info = {'st_mtime': datetime.fromtimestamp(file_stat.st_mtime)}
-                    utils.modify_time(info, local_path)
-                except PermissionError:
-                    if self.arguments.verbose:
-                        utils.multi_print(f"{Fore.RED}\t[-] Error: Permission denied.")
-                except FileNotFoundError as e:
-                    print(e)
-                    if self.arguments.verbose:
-                        utils.multi_print(f"{Fore.RED}\t[-] Error: File not found or not accessible: "
-                                          f"{remote_path}\\{file_info.name}")
-
-            else:
-                print(local_path)
-                print(remote_path)
-                print("Permissions thing? Shouldn't be here.")
-                exit()
-
     def image_smb(self, output_file, encryption_password, share, hostname, username, password, symlinks, recursive,
                   zip_image, port=445):
         """
             Connect to the device and initiate the imaging process.
         """
 
-        self.imager = imaging.Imager(self.arguments.verbose, zip=zip_image)
+        self.imager = imaging.Imager.from_arguments(self.arguments, zip=zip_image)
 
         if self.arguments.verbose:
             utils.multi_print(f"{Fore.GREEN}[*] Hostname, share: {Fore.RESET}{hostname}, {share}")
@@ -117,22 +72,28 @@ class GenericSMB(plugin_manager.Plugin):
         if self.arguments.verbose:
             utils.multi_print(f"{Fore.GREEN}[+] Connected to SMB service.")
 
-        output_path, old_path, self.tmp_path = self.imager.setup_tmp_directory(self.temp, output_file)
-        chdir(self.tmp_path)
-
-        makedirs(self.tmp_path + self.seperator + share)
+        try:
+            share_mtime = stat(f"\\{hostname}\\{share}", port=port).st_mtime
+        except (PermissionError, FileNotFoundError, exceptions.SMBException):
+            share_mtime = None
+        threads = getattr(self.arguments, "threads", acquisition.CONNECTIONS)
+        engine = SmbEngine(smb, hostname, port, threads, self.arguments.verbose, skip=self.imager.committed,
+                           read_depth=getattr(self.arguments, "read_depth", READ_DEPTH),
+                           unchanged=self.imager.is_unchanged)
+        share_path = engine.container_path(f"\\{hostname}\\{share}")
+        streams = chain([(share_path, imaging.create_metadata(share_path, 0, share_mtime), None)],
+                        engine.copy([f"\\{hostname}\\{share}"], symlinks, recursive=recursive))
 
-        utils.multi_print(f"{Fore.GREEN}[*] Copying files...")
-        self.smb_copy_and_image_r(smb, hostname, share, encryption_password, symlinks, recursive,
-                                  preserve_mtime=True)
-        if self.arguments.verbose:
-            utils.multi_print(f"{Fore.GREEN}[*] Closing SMB connection.")
-        smb.disconnect()
-        directories = listdir()
-        self.imager.add_path_names(output_path, directories, True, False, encryption_password)
-        chdir(old_path)
-        rmtree(self.tmp_path, ignore_errors=True)
-        return True
+        utils.multi_print(f"{Fore.GREEN}[*] Copying files on {Fore.RESET}{threads}{Fore.GREEN} threads...")
+        try:
+            success = self.imager.add_streams(path.abspath(output_file), streams, self.arguments.append,
+                                              encryption_password)
+            engine.report()
+        finally:
+            if self.arguments.verbose:
+                utils.multi_print(f"{Fore.GREEN}[*] Closing SMB connection.")
+            engine.close()
+        return success
 
     def setup_arg_parser(self, plugin_args, parent_args, parent_parser):
         self.parser = argparse.ArgumentParser(parents=[parent_parser],
@@ -152,6 +113,11 @@ class GenericSMB(plugin_manager.Plugin):
                                  help='Enable traversing symlinks.')
         self.parser.add_argument('-r', "--recursive", action="store_true", default=False,
                                  help='add files and folders recursively.')
+        self.parser.add_argument("--threads", action="store", default=acquisition.CONNECTIONS, type=int, metavar='N',
+                                 help='number of threads listing and reading the share at once over the one SMB '
+                                      'connection. Default is 4.')
+        self.parser.add_argument("--read-depth", action="store", default=READ_DEPTH, type=int, metavar='N',
+                                 help='number of reads kept in flight for each file. Default is 4.')
         self.arguments, extra = self.parser.parse_known_args(plugin_args, parent_args)
         return True
 
@@ -161,16 +127,185 @@ class GenericSMB(plugin_manager.Plugin):
             self.temp = self.arguments.temp
         if self.arguments.address:
             if self.arguments.share:
-                self.image_smb(self.arguments.output[0],
-                               self.arguments.container_password,
-                               self.arguments.share[0],
-                               self.arguments.address[0],
-                               self.arguments.username[0],
-                               self.arguments.password[0],
-                               self.arguments.symlinks,
-                               self.arguments.recursive,
-                               self.arguments.zip)
-                return True
+                return self.image_smb(self.arguments.output[0],
+                                      self.arguments.container_password,
+                                      self.arguments.share[0],
+                                      self.arguments.address[0],
+                                      self.arguments.username[0],
+                                      self.arguments.password[0],
+                                      self.arguments.symlinks,
+                                      self.arguments.recursive,
+                                      self.arguments.zip,
+                                      port=int(self.arguments.port[0]) if self.arguments.port is not None else 445)
         else:
             self.parser.print_help()
             return False
+
+
+def read_pipelined(fd, size, stream, read_size=acquisition.READ_SIZE, depth=READ_DEPTH):
+    """
+        Read the first `size` bytes of an open SMB file into `stream` in fixed size blocks, keeping up to `depth` SMB2
+        READ requests outstanding so the server is never waiting on the next request. Only one block per request is
+        held in memory, however big the file is.
+
+        Parameters:
+            fd: smbprotocol `Open` of the file.
+            size: Number of bytes to read.
+            stream: File like object the data is written to.
+            read_size: Size of each read, capped at what the server negotiated.
+            depth: Number of reads to keep outstanding.
+    """
+
+    connection = fd.connection
+    session_id = fd.tree_connect.session.session_id
+    tree_id = fd.tree_connect.tree_connect_id
+    read_size = min(read_size, connection.max_read_size)
+    pending = deque()
+    offset = 0
+    try:
+        while offset < size or pending:
+            while offset < size and len(pending) < depth:
+                length = min(read_size, size - offset)
+                request, receive = fd.read(offset, length, send=False)
+                charge = (length - 1) // CREDIT_SIZE + 1 if connection.supports_multi_credit else 1
+                try:
+                    # Ask for enough credits to keep the whole window of reads outstanding.
+                    pending.append((connection.send(request, session_id, tree_id, credit_request=charge * depth),
+                                    receive, length))
+                except exceptions.SMBException:
+                    # Out of credits until one of the outstanding reads is answered.
+                    if not pending:
+                        raise
+                    break
+                offset += length
+            sent, receive, length = pending.popleft()
+            try:
+                data = receive(sent)
+            except exceptions.EndOfFile:
+                data = b""
+            stream.write(data)
+            if len(data) < length:
+                # The file got shorter since it was listed.
+                return
+    finally:
+        # Collect the answers to reads that won't be used, so they aren't left with the connection.
+        for sent, receive, length in pending:
+            try:
+                receive(sent)
+            except exceptions.SMBException:
+                pass
+
+
+class SmbEngine(acquisition.PooledSource):
+    """
+        This class is used to copy a share with a pool of threads, as an `acquisition.PooledSource`. The threads share
+        the one SMB connection smbclient registered, which carries all their requests at once. Folders and files are
+        described from the directory listing itself, so there is no extra request per entry, and files are read with
+        several requests in flight.
+    """
+
+    protocol = "SMB"
+
+    def __init__(self, smb, hostname, port=445, threads=acquisition.CONNECTIONS, verbose=False, skip=None,
+                 read_depth=READ_DEPTH, unchanged=None):
+        """
+            Constructor for the SmbEngine class.
+
+            Parameters:
+                smb: Session returned by `register_session`.
+                hostname: Server the share is on.
+                port: Port the session was registered on, so every request uses its connection.
+                threads: Number of threads listing and reading the share.
+                verbose: Print each folder and file as it is found.
+                skip: Container paths that are already in the image.
+                read_depth: Number of reads kept outstanding for each file.
+                unchanged: Callable taking a container path and its metadata, files it is true for are not copied
+                           unless the imager opens them.
+        """
+
+        super().__init__([smb], verbose, skip=skip, workers=max(1, threads), unchanged=unchanged)
+        self.prefix = f"\\{hostname}"
+        self.port = port
+        self.read_depth = read_depth
+
+    def container_path(self, remote_path):
+        """
+            Get the path a remote file or folder is stored under in the container, the share and the path in it.
+        """
+
+        if remote_path.startswith(self.prefix):
+            remote_path = remote_path[len(self.prefix):]
+        return remote_path.replace("\\", "/").strip("/")
+
+    def close(self):
+        """
+            Disconnect the session the threads share.
+        """
+
+        for session in self.sessions:
+            try:
+                session.disconnect()
+            except (exceptions.SMBException, OSError):
+                pass
+
+    @staticmethod
+    def metadata(container_path, size, info):
+        """
+            Build the metadata for an entry from its directory listing information or its stat result.
+        """
+
+        if hasattr(info, "last_write_time"):
+            return imaging.create_metadata(container_path, size, info.last_write_time, info.last_access_time,
+                                           info.change_time, info.creation_time)
+        return imaging.create_metadata(container_path, size, info.st_mtime, info.st_atime, info.st_ctime)
+
+    def list(self, session, remote_dir, folders, symlinks, no_image, recursive, directories, files):
+        """
+            List a directory of the share, collecting its folders for the imager, the directories to walk next and
+            the files to read.
+        """
+
+        try:
+            for entry in scandir(remote_dir, port=self.port):
+                remote_path = f"{remote_dir}\\{entry.name}"
+                container_path = self.container_path(remote_path)
+                # The listing describes a symlink itself, only stat the ones that are followed.
+                info = entry.stat() if symlinks and entry.is_symlink() else entry.smb_info
+
+                # Directory
+                if entry.is_dir(follow_symlinks=symlinks):
+                    if container_path not in self.skip:
+                        if self.verbose:
+                            utils.multi_print(f"{Fore.GREEN}\tCreating directory: {Fore.RESET}{container_path}")
+                        folders.append((container_path, self.metadata(container_path, 0, info), None))
+                    if recursive:
+                        directories.append(remote_path)
+
+                # File
+                elif entry.is_file(follow_symlinks=symlinks):
+                    if container_path in self.skip:
+                        continue
+                    size = info.st_size if hasattr(info, "st_size") else info.end_of_file
+                    files.append((remote_path, self.metadata(container_path, size, info)))
+
+                elif self.verbose:
+                    utils.multi_print(f"{Fore.RED}\t[-] Skipping: {Fore.RESET}{container_path}")
+
+        except PermissionError:
+            if self.verbose:
+                utils.multi_print(f"{Fore.RED}\t[-] Error: Permission denied: {Fore.RESET}{remote_dir}")
+
+        except FileNotFoundError:
+            if self.verbose:
+                utils.multi_print(f"{Fore.RED}\t[-] Error: File not found or not accessible: {Fore.RESET}{remote_dir}")
+
+        except (exceptions.SMBException, OSError) as e:
+            utils.multi_print(f"{Fore.RED}[-] Error: Could not list: {Fore.RESET}{remote_dir} ({e})")
+
+    def read(self, session, remote_path, size, stream):
+        """
+            Read a file of the share into `stream` with several reads in flight.
+        """
+
+        with open_file(remote_path, mode="rb", buffering=0, port=self.port) as remote:
+            read_pipelined(remote.fd, size, stream, depth=self.read_depth)
@@ -2,15 +2,17 @@
 # Plugin to image a generic device over SSH
 
 import argparse
-from os import makedirs, chdir, listdir
-from stat import S_ISDIR, S_ISREG, S_ISLNK, S_ISSOCK
+from functools import partial
+from itertools import chain
+from os import path
 
 import pysftp
-from shutil import rmtree
 from colorama import reinit, Fore
 
+import acquisition
 import imaging
 import plugin_manager
+import sftp_engine
 import utilities
 
 reinit()  # Colorama
@@ -39,80 +41,7 @@ class GenericSSH(plugin_manager.Plugin):
         self.tmp_path = None
         self.temp = None
         self.seperator = "/"
-
-    def sftp_copy_and_image_r(self, sftp, remote_dir, password, symlinks, no_image, recursive, preserve_mtime=True):
-        """
-            Copy over a file from the device via SFTP and immediately append it to the image.
-        """
-        try:
-            for entry in sftp.listdir_attr(remote_dir):
-                remote_path = remote_dir + self.seperator + entry.filename
-                if remote_dir == "/":
-                    remote_dir = ""
-                local_path = utils.check_file_names(self.tmp_path + remote_dir + self.seperator + entry.filename)
-                mode = entry.st_mode
-                skip = False
-                # Directory
-                if S_ISDIR(mode):
-                    try:
-                        if no_image:
-                            for dir in no_image:
-                                if dir == remote_path:
-                                    utils.multi_print(f"{Fore.RED}\tSkipping directory: {Fore.RESET}{remote_path}")
-                                    skip = True
-                        if skip:
-                            continue
-                        if self.arguments.verbose:
-                            utils.multi_print(f"{Fore.GREEN}\tCreating directory: {Fore.RESET}{remote_path}")
-                        makedirs(local_path)
-                    except OSError:
-                        pass
-                    if recursive:
-                        self.sftp_copy_and_image_r(sftp, remote_path, password, symlinks, no_image, recursive,
-                                                   preserve_mtime)
-                # Symlinks
-                elif S_ISLNK(mode):
-                    if symlinks:
-                        if recursive:
-                            self.sftp_copy_and_image_r(sftp, remote_path, password, symlinks, no_image, recursive,
-                                                       preserve_mtime)
-                # File
-                elif S_ISREG(mode):
-                    try:
-                        if no_image:
-                            for dir in no_image:
-                                if dir == remote_path:
-                                    utils.multi_print(f"{Fore.RED}\tSkipping file: {Fore.RESET}{remote_path}")
-                                    skip = True
-                        if skip:
-                            continue
-                        if self.arguments.verbose:
-                            utils.multi_print(f"{Fore.GREEN}\tCopying file: {Fore.RESET}{remote_path}")
-                        sftp.get(remote_path, local_path, preserve_mtime=preserve_mtime)
-                    except PermissionError:
-                        if self.arguments.verbose:
-                            utils.multi_print(f"{Fore.RED}\t[-] Permission denied.")
-                elif S_ISSOCK(mode):
-                    if self.arguments.verbose:
-                        utils.multi_print(f"{Fore.RED}\t[-] Error: Socket, skipping.")
-                    continue
-                else:
-                    utils.multi_print(f"{Fore.RED}[-] Something went wrong: {remote_dir}, {local_path}, {mode}")
-                    continue
-
-        except FileNotFoundError:
-            utils.multi_print(f"{Fore.RED}[-] Error: File not found: {remote_dir}")
-            return False
-
-        except Exception as e:
-            if "EOF during negotiation" in str(e):
-                utils.multi_print(f"{Fore.RED}[-] Error: Could not connect. Server may not support SFTP.")
-                return False
-            else:
-                print(e)
-                pass
-
-        return True
+        self.result = True
 
     def image_ssh(self, output_file, encryption_password, remote_dir, ip_address, username, password, symlinks,
                   recursive, zip_image, port=22):
@@ -124,14 +53,18 @@ class GenericSSH(plugin_manager.Plugin):
         no_image = []
         cnopts = pysftp.CnOpts()
         cnopts.hostkeys = None
-        self.imager = imaging.Imager(self.arguments.verbose, zip=zip_image)
+        self.imager = imaging.Imager.from_arguments(self.arguments, zip=zip_image)
 
         if self.arguments.verbose:
             utils.multi_print(f"{Fore.GREEN}[*] Address, Port: {Fore.RESET}{ip_address}, {port}")
             utils.multi_print(f"{Fore.GREEN}[*] Username, Password: {Fore.RESET}{username}, {password}")
 
+        connect = partial(pysftp.Connection, ip_address, username=username, password=password, cnopts=cnopts,
+                          port=port)
+        connections = getattr(self.arguments, "connections", acquisition.CONNECTIONS)
         try:
-            sftp = pysftp.Connection(ip_address, username=username, password=password, cnopts=cnopts, port=port)
+            sessions = sftp_engine.SftpEngine.open_sessions(connect, connections, self.arguments.verbose)
+            sftp = sessions[0]
         except Exception as e:
             if "Unable to connect" in str(e):
                 utils.multi_print(f"{Fore.RED}[-] Error: Could not connect via SSH.")
@@ -145,9 +78,6 @@ class GenericSSH(plugin_manager.Plugin):
         if self.arguments.verbose:
             utils.multi_print(f"{Fore.GREEN}[+] Connected to device.")
 
-        output_path, old_path, self.tmp_path = self.imager.setup_tmp_directory(self.temp, output_file)
-        chdir(self.tmp_path)
-
         # If no `-d` switch is used, start at `/`
         if not remote_dir:
             target_dir = "/"
@@ -157,9 +87,6 @@ class GenericSSH(plugin_manager.Plugin):
             else:
                 target_dir = remote_dir[0]
 
-                # If the `-d` option is used, go ahead and make the specified path
-                makedirs(self.tmp_path + target_dir)
-
         if remote_dir:
             for pathname in remote_dir:
                 if pathname[-1] == "-":
@@ -168,16 +95,29 @@ class GenericSSH(plugin_manager.Plugin):
             for not_image_path in no_image:
                 remote_dir.remove(not_image_path + "-")
 
-        utils.multi_print(f"{Fore.GREEN}[*] Copying files...")
-        result = self.sftp_copy_and_image_r(sftp, target_dir, encryption_password, symlinks, no_image,
-                                            recursive, preserve_mtime=True)
-        if not result:
-            return False
-        directories = listdir()
-        self.imager.add_path_names(output_path, directories, True, self.arguments.append, encryption_password)
-        chdir(old_path)
-        rmtree(self.tmp_path, ignore_errors=True)
-        return True
+        engine = sftp_engine.SftpEngine(sessions, self.arguments.verbose, skip=self.imager.committed,
+                                        unchanged=self.imager.is_unchanged)
+        stream_archive = getattr(self.arguments, "stream_archive", False)
+        if stream_archive and not recursive:
+            utils.multi_print(f"{Fore.RED}[-] --stream-archive needs -r, copying files over SFTP instead.")
+        if stream_archive and recursive:
+            utils.multi_print(f"{Fore.GREEN}[*] Streaming files as one archive...")
+            streams = engine.archive([target_dir], symlinks, no_image)
+        else:
+            utils.multi_print(f"{Fore.GREEN}[*] Copying files over {Fore.RESET}{len(sessions)}{Fore.GREEN} "
+                              f"SFTP sessions...")
+            streams = engine.copy([target_dir], symlinks, no_image, recursive)
+            if target_dir != "/":
+                target_meta = imaging.create_metadata(target_dir, 0, sftp.stat(target_dir).st_mtime)
+                streams = chain([(target_dir.lstrip("/"), target_meta, None)], streams)
+        try:
+            success = self.imager.add_streams(path.abspath(output_file), streams, self.arguments.append,
+                                              encryption_password)
+            engine.report()
+        finally:
+            engine.close()
+            sftp.close()
+        return engine.result and success
 
     def setup_arg_parser(self, plugin_args, parent_args, parent_parser):
         self.parser = argparse.ArgumentParser(parents=[parent_parser],
@@ -197,6 +137,12 @@ class GenericSSH(plugin_manager.Plugin):
                                  help='add files and folders recursively.')
         self.parser.add_argument('-d', "--directory", nargs=1, action="store", metavar='REMOTE DIR',
                                  help='Remote directory to begin imaging.')
+        self.parser.add_argument("--connections", action="store", default=acquisition.CONNECTIONS, type=int,
+                                 metavar='N', help='number of SFTP sessions to list and copy files over at once. '
+                                                   'Default is 4.')
+        self.parser.add_argument("--stream-archive", action="store_true",
+                                 help='stream the directory off the device as one tar archive over an SSH shell instead '
+                                      'of copying each file over SFTP. Needs tar on the device.')
         self.arguments, extra = self.parser.parse_known_args(plugin_args, parent_args)
         return True
 
@@ -206,27 +152,26 @@ class GenericSSH(plugin_manager.Plugin):
             self.temp = self.arguments.temp
         if self.arguments.address:
             if self.arguments.port is not None:
-                self.image_ssh(self.arguments.output[0],
-                               self.arguments.container_password,
-                               self.arguments.directory,
-                               self.arguments.address[0],
-                               self.arguments.username[0],
-                               self.arguments.password[0],
-                               self.arguments.symlinks,
-                               self.arguments.recursive,
-                               self.arguments.zip,
-                               port=int(self.arguments.port[0]),)
+                return self.image_ssh(self.arguments.output[0],
+                                      self.arguments.container_password,
+                                      self.arguments.directory,
+                                      self.arguments.address[0],
+                                      self.arguments.username[0],
+                                      self.arguments.password[0],
+                                      self.arguments.symlinks,
+                                      self.arguments.recursive,
+                                      self.arguments.zip,
+                                      port=int(self.arguments.port[0]),)
             else:
-                self.image_ssh(self.arguments.output[0],
-                               self.arguments.container_password,
-                               self.arguments.directory,
-                               self.arguments.address[0],
-                               self.arguments.username[0],
-                               self.arguments.password[0],
-                               self.arguments.symlinks,
-                               self.arguments.recursive,
-                               self.arguments.zip,)
-            return True
+                return self.image_ssh(self.arguments.output[0],
+                                      self.arguments.container_password,
+                                      self.arguments.directory,
+                                      self.arguments.address[0],
+                                      self.arguments.username[0],
+                                      self.arguments.password[0],
+                                      self.arguments.symlinks,
+                                      self.arguments.recursive,
+                                      self.arguments.zip,)
         else:
             self.parser.print_help()
             return False
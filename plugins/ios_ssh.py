@@ -3,15 +3,17 @@
 
 import argparse
 import subprocess
-from os import makedirs, chdir, listdir
-from stat import S_ISDIR, S_ISREG, S_ISLNK, S_ISSOCK
+from functools import partial
+from itertools import chain
+from os import path
 
 import pysftp
-from shutil import rmtree
 from colorama import reinit, Fore
 
+import acquisition
 import imaging
 import plugin_manager
+import sftp_engine
 import utilities
 
 reinit()  # Colorama
@@ -39,56 +41,13 @@ class IosImagerSSH(plugin_manager.Plugin):
         self.temp = None
         self.seperator = "/"
 
-    def sftp_copy_and_image_r(self, sftp, remote_dir, password, symlinks, preserve_mtime=True):
-        """
-            Copy over a file from the device via SFTP and immediately append it to the image.
-        """
-        try:
-            for entry in sftp.listdir_attr(remote_dir):
-                remote_path = remote_dir + self.seperator + entry.filename
-                if remote_dir == "/":
-                    remote_dir = ""
-                local_path = utils.check_file_names(self.tmp_path + remote_dir + self.seperator + entry.filename)
-                mode = entry.st_mode
-                # Directory
-                if S_ISDIR(mode):
-                    try:
-                        if self.arguments.verbose:
-                            utils.multi_print(f"{Fore.GREEN}\tCreating directory: {Fore.RESET}{remote_path}")
-                        makedirs(local_path)
-                    except OSError:
-                        pass
-                    self.sftp_copy_and_image_r(sftp, remote_path, password, preserve_mtime)
-                # Symlinks
-                elif S_ISLNK(mode):
-                    if symlinks:
-                        self.sftp_copy_and_image_r(sftp, remote_path, password, preserve_mtime)
-                # File
-                elif S_ISREG(mode):
-                    try:
-                        if self.arguments.verbose:
-                            utils.multi_print(f"{Fore.GREEN}\tCopying file: {Fore.RESET}{remote_path}")
-                        sftp.get(remote_path, local_path, preserve_mtime=preserve_mtime)
-                    except PermissionError:
-                        utils.multi_print(f"{Fore.RED}\t[-] Permission denied.")
-                elif S_ISSOCK(mode):
-                    utils.multi_print(f"{Fore.RED}\t[-] Socket, skipping.")
-                    continue
-                else:
-                    utils.multi_print(f"{Fore.RED}[-] Something went wrong: {remote_dir}, {local_path}, {mode}")
-                    continue
-
-        except FileNotFoundError:
-            utils.multi_print(f"\t{Fore.RED}[-] File not found: {remote_dir}")
-            pass
-
     def image_device_ssh(self, output_file, encryption_password, local, remote_dir, password="alpine",
                          ip_address="127.0.0.1", symlinks=False):
         """
             Connect to the device and initiate the imaging process.
         """
         sftp = None
-        self.imager = imaging.Imager(self.arguments.verbose, zip=self.arguments.zip)
+        self.imager = imaging.Imager.from_arguments(self.arguments, zip=self.arguments.zip)
         port = 22
         if local is True:
             if self.imager.os == "Windows":
@@ -108,8 +67,11 @@ class IosImagerSSH(plugin_manager.Plugin):
         cnopts = pysftp.CnOpts()
         cnopts.hostkeys = None
 
+        connect = partial(pysftp.Connection, ip_address, username='root', password=password, cnopts=cnopts, port=port)
+        connections = getattr(self.arguments, "connections", acquisition.CONNECTIONS)
         try:
-            sftp = pysftp.Connection(ip_address, username='root', password=password, cnopts=cnopts, port=port)
+            sessions = sftp_engine.SftpEngine.open_sessions(connect, connections, self.arguments.verbose)
+            sftp = sessions[0]
         except Exception as e:
             if "Unable to connect" in str(e):
                 utils.multi_print(f"{Fore.RED}[-] Could not connect to device.")
@@ -117,34 +79,44 @@ class IosImagerSSH(plugin_manager.Plugin):
             if "Authentication" in str(e):
                 utils.multi_print(f"{Fore.RED}[-] Wrong SSH password.")
                 return False
+            utils.multi_print(f"{Fore.RED}[-] Error: {e}")
+            return False
 
         if self.arguments.verbose:
             utils.multi_print(f"{Fore.GREEN}[+] Connected to device.")
 
-        output_path, old_path, self.tmp_path = self.imager.setup_tmp_directory(self.temp, output_file)
-        chdir(self.tmp_path)
-
         # If no `-d` switch is used, start at `/`
         if not remote_dir or remote_dir[0] == "/":
             target_dir = "/"
         else:
             target_dir = remote_dir[0]
 
-            # If the `-d` option is used, go ahead and make the specified path
-            makedirs(self.tmp_path + target_dir)
-
-        utils.multi_print(f"{Fore.GREEN}[*] Copying files...")
+        engine = sftp_engine.SftpEngine(sessions, self.arguments.verbose, skip=self.imager.committed,
+                                        unchanged=self.imager.is_unchanged)
+        if getattr(self.arguments, "stream_archive", False):
+            utils.multi_print(f"{Fore.GREEN}[*] Streaming files as one archive...")
+            streams = engine.archive([target_dir], symlinks)
+        else:
+            utils.multi_print(f"{Fore.GREEN}[*] Copying files over {Fore.RESET}{len(sessions)}{Fore.GREEN} "
+                              f"SFTP sessions...")
+            streams = engine.copy([target_dir], symlinks)
         try:
-            self.sftp_copy_and_image_r(sftp, target_dir, encryption_password, symlinks, preserve_mtime=True)
+            if target_dir != "/" and not getattr(self.arguments, "stream_archive", False):
+                target_meta = imaging.create_metadata(target_dir, 0, sftp.stat(target_dir).st_mtime)
+                streams = chain([(target_dir.lstrip("/"), target_meta, None)], streams)
+            success = self.imager.add_streams(path.abspath(output_file), streams, self.arguments.append,
+                                              encryption_password)
+            engine.report()
         except Exception as e:
             if "Server connection dropped" in str(e):
                 utils.multi_print(f"\n\t{Fore.RED}[-] Connection lost.")
                 return False
-        directories = listdir()
-        self.imager.add_path_names(output_path, directories, True, self.arguments.append, encryption_password)
-        chdir(old_path)
-        rmtree(self.tmp_path, ignore_errors=True)
-        return True
+            utils.multi_print(f"{Fore.RED}[-] Error: {e}")
+            return False
+        finally:
+            engine.close()
+            sftp.close()
+        return success
 
     def setup_arg_parser(self, plugin_args, parent_args, parent_parser):
         self.parser = argparse.ArgumentParser(parents=[parent_parser],
@@ -160,6 +132,12 @@ class IosImagerSSH(plugin_manager.Plugin):
                                  help='root password for jailbroken device if using SSH. \nDefaults to \'alpine\'.')
         self.parser.add_argument('-s', "--symlinks", action="store_true",
                                  help='follow and image any symlinks.')
+        self.parser.add_argument("--connections", action="store", default=acquisition.CONNECTIONS, type=int,
+                                 metavar='N', help='number of SFTP sessions to list and copy files over at once. '
+                                                   'Default is 4.')
+        self.parser.add_argument("--stream-archive", action="store_true",
+                                 help='stream the directory off the device as one tar archive over an SSH shell instead '
+                                      'of copying each file over SFTP. Needs tar on the device.')
         self.arguments, extra = self.parser.parse_known_args(plugin_args, parent_args)
         return True
 
@@ -167,35 +145,35 @@ class IosImagerSSH(plugin_manager.Plugin):
         utils.multi_print(f"{Fore.GREEN}[+] Loaded iOS SSH plugin!")
         if self.arguments.temp:
             self.temp = self.arguments.temp
-        self.imager = imaging.Imager(self.arguments.verbose)
+        self.imager = imaging.Imager.from_arguments(self.arguments)
         if self.arguments.address or self.arguments.local:
             if self.arguments.local is True:
                 if self.arguments.root_password is None:
-                    self.image_device_ssh(self.arguments.output[0],
-                                          self.arguments.container_password,
-                                          self.arguments.local,
-                                          self.arguments.directory)
+                    result = self.image_device_ssh(self.arguments.output[0],
+                                                   self.arguments.container_password,
+                                                   self.arguments.local,
+                                                   self.arguments.directory)
                 else:
-                    self.image_device_ssh(self.arguments.output[0],
-                                          self.arguments.container_password,
-                                          self.arguments.local,
-                                          self.arguments.directory,
-                                          password=self.arguments.root_password[0])
+                    result = self.image_device_ssh(self.arguments.output[0],
+                                                   self.arguments.container_password,
+                                                   self.arguments.local,
+                                                   self.arguments.directory,
+                                                   password=self.arguments.root_password[0])
             else:
                 if self.arguments.root_password is None:
-                    self.image_device_ssh(self.arguments.output[0],
-                                          self.arguments.container_password,
-                                          self.arguments.local,
-                                          self.arguments.directory,
-                                          ip_address=self.arguments.address[0])
+                    result = self.image_device_ssh(self.arguments.output[0],
+                                                   self.arguments.container_password,
+                                                   self.arguments.local,
+                                                   self.arguments.directory,
+                                                   ip_address=self.arguments.address[0])
                 else:
-                    self.image_device_ssh(self.arguments.output[0],
-                                          self.arguments.container_password,
-                                          self.arguments.local,
-                                          self.arguments.directory,
-                                          password=self.arguments.root_password[0],
-                                          ip_address=self.arguments.address[0])
-            return True
+                    result = self.image_device_ssh(self.arguments.output[0],
+                                                   self.arguments.container_password,
+                                                   self.arguments.local,
+                                                   self.arguments.directory,
+                                                   password=self.arguments.root_password[0],
+                                                   ip_address=self.arguments.address[0])
+            return result
         else:
             self.parser.print_help()
             return False
@@ -47,7 +47,7 @@ class UsbDriveImage(plugin_manager.Plugin):
         if self.arguments.usb:
             image_path, output_path = "", ""
             current_path = getcwd()
-            imager = imaging.Imager(self.arguments.verbose, zip=self.arguments.zip)
+            imager = imaging.Imager.from_arguments(self.arguments, zip=self.arguments.zip)
             utils.multi_print(f"{Fore.GREEN}[*] Make sure your USB device is mounted.")
             if '/' in self.arguments.usb or '\\' in self.arguments.usb:
                 image_path = self.arguments.usb
@@ -59,14 +59,14 @@ class UsbDriveImage(plugin_manager.Plugin):
                 elif imager.os == "Windows":
                     image_path = "%s:\\" % self.arguments.usb[0]
                     output_path = current_path + "\\" + self.arguments.output[0]
-            imager.add_path_names(output_path,
-                                  [image_path],
-                                  True,
-                                  self.arguments.append,
-                                  self.arguments.container_password,
-                                  symlinks=self.arguments.symlinks)
+            result = imager.add_path_names(output_path,
+                                           [image_path],
+                                           True,
+                                           self.arguments.append,
+                                           self.arguments.container_password,
+                                           symlinks=self.arguments.symlinks)
             chdir(current_path)
-            return True
+            return result
         else:
             self.parser.print_help()
             return False
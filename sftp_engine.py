@@ -0,0 +1,226 @@
+# Parallel SFTP transfer engine shared by the SSH plugins.
+
+import posixpath
+import socket
+import threading
+from stat import S_ISDIR, S_ISREG, S_ISLNK, S_ISSOCK
+
+from colorama import reinit, Fore
+
+import acquisition
+import imaging
+import utilities
+
+reinit()  # Colorama
+utils = utilities.Utilities.get_instance()
+
+# Files at least this big are read with pipelined requests, smaller ones only need one or two round trips anyway.
+PREFETCH_SIZE = 1024 * 1024
+# Seconds to wait on the archive stream before giving up on it and copying the rest over SFTP.
+ARCHIVE_TIMEOUT = 60
+
+
+class SftpEngine(acquisition.PooledSource):
+    """
+        This class is used to copy a directory tree off a device over several SFTP sessions at once, or to stream it
+        off as one tar archive over an SSH shell.
+    """
+
+    protocol = "SFTP"
+
+    def close(self):
+        """
+            Close every session but the first, which belongs to the plugin.
+        """
+
+        for session in self.sessions[1:]:
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    def archive(self, directories, symlinks=False, no_image=frozenset()):
+        """
+            Stream the given remote directories off the target as one tar archive over an SSH shell and yield its
+            members for the imager, which avoids the SFTP round trips for every file. Paths tar could not read are
+            copied over SFTP afterwards, and if the archive ends early the rest of the directories are copied over SFTP.
+
+            Parameters:
+                directories: Remote directories to start from.
+                symlinks: Follow symlinks.
+                no_image: Remote paths to leave out, passed to tar as exclusions.
+        """
+
+        session = self.sessions[0]
+        targets = []
+        for directory in directories:
+            if directory.strip("/"):
+                targets.append(directory.strip("/"))
+                continue
+            # Name the top level entries so the excluded ones are never opened (tar would hang on /proc).
+            for entry in session.listdir_attr("/"):
+                if "/" + entry.filename not in no_image:
+                    targets.append(entry.filename)
+        command = f"tar -c{'h' if symlinks else ''}f - {imaging.tar_arguments(targets, no_image)}"
+        if self.verbose:
+            utils.multi_print(f"{Fore.GREEN}[*] Streaming archive: {Fore.RESET}{command}")
+
+        channel = session.sftp_client.get_channel().get_transport().open_session()
+        channel.settimeout(ARCHIVE_TIMEOUT)
+        channel.exec_command(command)
+        errors = []
+        # tar stops writing the archive if its error output isn't read.
+        reader = threading.Thread(target=self.read_errors, args=(channel, errors), daemon=True)
+        reader.start()
+
+        archived = set()
+        pathname = None
+        complete = False
+        try:
+            for pathname, fsmeta, stream in imaging.tar_streams(channel.makefile("rb")):
+                if pathname in self.skip:
+                    continue
+                archived.add(pathname)
+                yield pathname, fsmeta, stream
+            complete = True
+        except Exception as e:
+            utils.multi_print(f"{Fore.RED}[-] Archive stream failed: {Fore.RESET}{e}")
+        finally:
+            channel.close()
+            reader.join()
+
+        output = b"".join(errors).decode("utf-8", "replace")
+        if self.verbose:
+            for line in output.splitlines():
+                utils.multi_print(f"{Fore.RED}\t{line}")
+        failed = imaging.tar_error_paths(output)
+        if complete:
+            utils.multi_print(f"{Fore.GREEN}[+] Archive streamed, {Fore.RESET}{len(failed)}{Fore.GREEN} "
+                              f"paths to copy over SFTP.")
+            retry_directories = []
+            for remote_path in failed:
+                if self.container_path(remote_path) in archived:
+                    continue
+                try:
+                    attributes = session.stat(remote_path)
+                except OSError:
+                    continue
+                if S_ISDIR(attributes.st_mode):
+                    retry_directories.append(remote_path)
+                elif S_ISREG(attributes.st_mode) and self.container_path(remote_path) not in self.skip:
+                    self.files.append((remote_path, imaging.create_metadata(
+                        remote_path, attributes.st_size, attributes.st_mtime, attributes.st_atime)))
+        else:
+            # The file being read when the stream broke is incomplete, so it is copied again with the rest.
+            utils.multi_print(f"{Fore.RED}[-] Copying the remaining files over SFTP.")
+            archived.discard(pathname)
+            retry_directories = ["/" + target for target in targets]
+        if retry_directories or self.files:
+            self.skip = self.skip | archived
+            yield from self.copy(retry_directories, symlinks, no_image)
+
+    @staticmethod
+    def read_errors(channel, errors):
+        """
+            Collect a command's error output until it exits or its channel is closed. The channel's timeout is only
+            meant for the archive stream, so waiting on a command that has nothing to report doesn't stop this.
+
+            Parameters:
+                channel: Channel the command is running on.
+                errors: List the error output is added to.
+        """
+
+        while True:
+            try:
+                data = channel.recv_stderr(32768)
+            except socket.timeout:
+                if channel.exit_status_ready() or channel.closed:
+                    return
+                continue
+            if not data:
+                return
+            errors.append(data)
+
+    def list(self, session, remote_dir, folders, symlinks, no_image, recursive, directories, files):
+        """
+            List a remote directory, collecting its folders for the imager, the directories to walk next and the files
+            to copy.
+        """
+
+        try:
+            if symlinks:
+                # Following symlinks can lead back to a directory that was already walked.
+                real_path = session.normalize(remote_dir)
+                with self.lock:
+                    if real_path in self.visited:
+                        return
+                    self.visited.add(real_path)
+            for entry in session.listdir_attr(remote_dir):
+                remote_path = posixpath.join(remote_dir, entry.filename)
+                mode = entry.st_mode
+                # Directory
+                if S_ISDIR(mode):
+                    if remote_path in no_image:
+                        utils.multi_print(f"{Fore.RED}\tSkipping directory: {Fore.RESET}{remote_path}")
+                        continue
+                    if self.container_path(remote_path) not in self.skip:
+                        if self.verbose:
+                            utils.multi_print(f"{Fore.GREEN}\tCreating directory: {Fore.RESET}{remote_path}")
+                        folders.append((self.container_path(remote_path),
+                                        imaging.create_metadata(remote_path, 0, entry.st_mtime, entry.st_atime), None))
+                    if recursive:
+                        directories.append(remote_path)
+                # Symlinks
+                elif S_ISLNK(mode):
+                    if symlinks and recursive:
+                        directories.append(remote_path)
+                # File
+                elif S_ISREG(mode):
+                    if remote_path in no_image:
+                        utils.multi_print(f"{Fore.RED}\tSkipping file: {Fore.RESET}{remote_path}")
+                        continue
+                    if self.container_path(remote_path) in self.skip:
+                        continue
+                    files.append((remote_path, imaging.create_metadata(remote_path, entry.st_size, entry.st_mtime,
+                                                                       entry.st_atime)))
+                elif S_ISSOCK(mode):
+                    if self.verbose:
+                        utils.multi_print(f"{Fore.RED}\t[-] Socket, skipping: {Fore.RESET}{remote_path}")
+                else:
+                    utils.multi_print(f"{Fore.RED}[-] Something went wrong: {remote_path}, {mode}")
+
+        except FileNotFoundError:
+            utils.multi_print(f"{Fore.RED}[-] Error: File not found: {remote_dir}")
+            self.result = False
+
+        except PermissionError:
+            if self.verbose:
+                utils.multi_print(f"{Fore.RED}\t[-] Permission denied: {Fore.RESET}{remote_dir}")
+
+        except OSError as e:
+            # A followed symlink that points at a file can't be listed.
+            if self.verbose:
+                utils.multi_print(f"{Fore.RED}\t[-] Could not list: {Fore.RESET}{remote_dir} ({e})")
+
+        except Exception as e:
+            if "EOF during negotiation" in str(e):
+                utils.multi_print(f"{Fore.RED}[-] Error: Could not connect. Server may not support SFTP.")
+            else:
+                utils.multi_print(f"{Fore.RED}[-] Error: {Fore.RESET}{remote_dir} ({e})")
+            self.result = False
+
+    @staticmethod
+    def read(session, remote_path, size, stream):
+        """
+            Read a remote file into `stream`. Large files are prefetched, which keeps many read requests in flight at
+            once instead of waiting on each one.
+        """
+
+        with session.open(remote_path, "rb") as remote:
+            if size >= PREFETCH_SIZE:
+                remote.prefetch(size)
+            while True:
+                data = remote.read(acquisition.READ_SIZE)
+                if not data:
+                    break
+                stream.write(data)
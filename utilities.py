@@ -29,6 +29,8 @@ class Utilities:
         Utilities.__instance = self
         self.gui = False
         self.textBrowser = None
+        # Progress bar shown on the console, output is printed above it while it is.
+        self.progress = None
         self.reaesc = compile(r'\x1b[^m]*m')
 
     def set_gui(self):
@@ -63,7 +65,10 @@ class Utilities:
                     worker.emit(new_text.strip("\t"))
                 except:
                     pass
-        print(output)
+        if self.progress is not None:
+            self.progress.write(output)
+        else:
+            print(output)
 
     def check_file_names(self, file):
         """
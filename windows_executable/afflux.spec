@@ -17,6 +17,8 @@ a = Analysis(['..\\afflux.py'],
                             'pymobiledevice3.lockdown',
                             'pymobiledevice3.services.afc',
                             'pysftp',
+                            'acquisition',
+                            'sftp_engine',
                             'smbprotocol',
                             'smbclient',
                             'bs4',
@@ -24,6 +24,8 @@ a = Analysis(['..\\afflux_gui.py'],
                             'pymobiledevice3.lockdown',
                             'pymobiledevice3.services.afc',
                             'pysftp',
+                            'acquisition',
+                            'sftp_engine',
                             'smbprotocol',
                             'smbclient',
                             'sys'],
@@ -0,0 +1,322 @@
+# Zip container writer that deflates members on a thread pool and records their hashes.
+
+import csv
+import hashlib
+import io
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import compression
+import metrics
+
+run_metrics = metrics.Metrics.get_instance()
+
+# Size of the blocks a member is split into and deflated in parallel.
+BLOCK_SIZE = 1024 * 1024
+
+# Deflate level, the same as `zipfile`.
+LEVEL = zlib.Z_DEFAULT_COMPRESSION
+
+# Each block is deflated with the end of the block before it as its dictionary, so the output is about as small as
+# one stream.
+DICTIONARY_SIZE = 32 * 1024
+
+# Member every file's size, SHA1, MD5 and whether it was read to the end are listed in.
+MANIFEST_NAME = "afflux-hashes.csv"
+
+# Record signatures, see the PKWARE APPNOTE.
+LOCAL_HEADER = 0x04034b50
+DATA_DESCRIPTOR = 0x08074b50
+CENTRAL_HEADER = 0x02014b50
+ZIP64_END = 0x06064b50
+ZIP64_LOCATOR = 0x07064b50
+END = 0x06054b50
+
+ZIP64_EXTRA = 0x0001
+ZIP64_VERSION = 45
+UNIX = 3
+STORED = 0
+DEFLATED = 8
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+DIRECTORY_ATTRIBUTE = 0x10
+MAX_32 = 0xFFFFFFFF
+MAX_16 = 0xFFFF
+
+
+def deflate_block(block, dictionary, final):
+    """
+        Deflate one block of a member as raw deflate data that can be joined to the blocks before and after it.
+
+        Parameters:
+            block: Data of the block.
+            dictionary: The data before the block, or nothing for the first block.
+            final: Finish the deflate stream, for the last block of the member.
+    """
+
+    start_time = time.perf_counter()
+    if dictionary:
+        compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary[-DICTIONARY_SIZE:])
+    else:
+        compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # A sync flush ends the block on a byte boundary without marking it as the last one.
+    data = compressor.compress(block) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    run_metrics.count("compressed", size=len(block), seconds=time.perf_counter() - start_time)
+    return data
+
+
+def dos_date_time(date_time):
+    """
+        Pack a datetime as the DOS date and time a zip stores, which can't go before 1980.
+    """
+
+    if date_time is None:
+        date_time = datetime.now()
+    if date_time.year < 1980:
+        date_time = datetime(1980, 1, 1)
+    if date_time.year > 2107:
+        date_time = datetime(2107, 12, 31, 23, 59, 58)
+    return ((date_time.year - 1980) << 9 | date_time.month << 5 | date_time.day,
+            date_time.hour << 11 | date_time.minute << 5 | date_time.second // 2)
+
+
+class ZipWriter:
+    """
+        This class is used to write a Zip container one member at a time without seeking, so it streams to the
+        output. Members are split into blocks that are deflated on a thread pool and joined in order, while the reading
+        thread computes their CRC32, SHA1 and MD5. Every member is written as ZIP64 with a data descriptor, so there is
+        no limit on the size of the container or of a file, and the central directory is kept in a temporary file next
+        to the output instead of in memory until it is copied to the end. The hashes are written to a CSV manifest
+        member when the container is closed. Files the compression policy picks "store" for, like photos and archives,
+        are stored as they are instead of deflated.
+    """
+
+    def __init__(self, path, workers=1, compression="auto"):
+        """
+            Constructor for ZipWriter class.
+
+            Parameters:
+                path: Path of the zip file.
+                workers: Number of threads to deflate with.
+                compression: Policy for picking which files are stored instead of deflated, see
+                             `compression.POLICIES`.
+        """
+
+        self.path = path
+        self.file = open(path, "wb")
+        self.offset = 0
+        self.entries = 0
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.window = max(1, workers) * 2
+        self.compression = compression
+        folder = os.path.dirname(os.path.abspath(path))
+        self.central_directory = tempfile.TemporaryFile(dir=folder)
+        self.manifest = io.TextIOWrapper(tempfile.TemporaryFile(dir=folder), encoding="utf-8", newline="")
+        self.manifest_writer = csv.writer(self.manifest)
+        self.manifest_writer.writerow(("path", "size", "sha1", "md5", "status"))
+
+    def write(self, data):
+        self.file.write(data)
+        self.offset += len(data)
+        return len(data)
+
+    @staticmethod
+    def member_name(pathname):
+        """
+            Get the name of a member for a path, the same way as `zipfile`: without a drive or leading separators, and
+            with forward slashes.
+        """
+
+        pathname = os.path.normpath(os.path.splitdrive(pathname)[1])
+        while pathname[0:1] in (os.sep, "/"):
+            pathname = pathname[1:]
+        if os.sep != "/":
+            pathname = pathname.replace(os.sep, "/")
+        return pathname
+
+    def add_folder(self, pathname, fsmeta=None, mode=None):
+        """
+            Add a folder.
+
+            Parameters:
+                pathname: Path of the folder.
+                fsmeta: FSMetadata of the folder, for its modified time.
+                mode: POSIX mode bits.
+        """
+
+        name = self.member_name(pathname).rstrip("/") + "/"
+        self.add_member(name, fsmeta, mode, None)
+
+    def add_file(self, pathname, fsmeta, src, mode=None):
+        """
+            Add a file, reading it to the end. Returns its size, SHA1 and MD5. If reading fails the member is closed
+            with what was read, listed in the manifest as incomplete with the size and hashes of that, and the error is
+            raised.
+
+            Parameters:
+                pathname: Path of the file.
+                fsmeta: FSMetadata of the file, for its modified time.
+                src: Readable file like object.
+                mode: POSIX mode bits.
+        """
+
+        name = self.member_name(pathname)
+        size, sha1, md5, error = self.add_member(name, fsmeta, mode, src)
+        self.manifest_writer.writerow((name, size, sha1, md5, "complete" if error is None else "incomplete"))
+        if error is not None:
+            raise error
+        return size, sha1, md5
+
+    def add_member(self, name, fsmeta, mode, src):
+        """
+            Write a member. Returns the size, SHA1 and MD5 of what was read of a file and the error that stopped the
+            read, if any, or None for a folder.
+
+            Parameters:
+                name: Name of the member.
+                fsmeta: FSMetadata of the file or folder, for its modified time.
+                mode: POSIX mode bits.
+                src: Readable file like object, None for a folder.
+        """
+
+        encoded_name = name.encode("utf-8")
+        flags = 0 if name.isascii() else FLAG_UTF8
+        date, dos_time = dos_date_time(getattr(fsmeta, "lastWritten", None))
+        if mode is None:
+            mode = getattr(fsmeta, "mode", None)
+        if mode and not stat.S_IFMT(mode):
+            mode |= stat.S_IFREG if src is not None else stat.S_IFDIR
+        attributes = (mode or 0) << 16
+        offset = self.offset
+
+        if src is None:
+            # Folders have nothing to stream, so their sizes go in the header.
+            attributes |= DIRECTORY_ATTRIBUTE
+            self.write(struct.pack("<IHHHHHIIIHH", LOCAL_HEADER, ZIP64_VERSION, flags, STORED, dos_time, date, 0, 0, 0,
+                                   len(encoded_name), 0) + encoded_name)
+            self.add_central_record(encoded_name, flags, STORED, dos_time, date, 0, 0, 0, attributes, offset)
+            return None
+
+        error = None
+        try:
+            block = self.read_block(src)
+        except Exception as e:
+            error = e
+            block = b""
+        # Every codec but "store" is deflate in a zip.
+        method = STORED if compression.choose_codec(self.compression, name, block) == "store" else DEFLATED
+
+        flags |= FLAG_DATA_DESCRIPTOR
+        extra = struct.pack("<HHQQ", ZIP64_EXTRA, 16, 0, 0)
+        self.write(struct.pack("<IHHHHHIIIHH", LOCAL_HEADER, ZIP64_VERSION, flags, method, dos_time, date, 0, MAX_32,
+                               MAX_32, len(encoded_name), len(extra)) + encoded_name + extra)
+
+        hashes = (hashlib.sha1(), hashlib.md5())
+        crc = size = compressed_size = 0
+        pending = deque()
+        previous = b""
+        final = False
+
+        def add_block(data, last):
+            nonlocal crc, size, compressed_size, previous
+            if method == STORED:
+                # Queued like deflated blocks so they are written in the same order.
+                pending.append(self.pool.submit(bytes, data))
+            else:
+                pending.append(self.pool.submit(deflate_block, data, previous, last))
+            start_time = time.perf_counter()
+            crc = zlib.crc32(data, crc)
+            for h in hashes:
+                h.update(data)
+            run_metrics.count("hashed", size=len(data), seconds=time.perf_counter() - start_time)
+            size += len(data)
+            previous = data
+            while len(pending) >= self.window:
+                compressed_size += self.write(pending.popleft().result())
+
+        try:
+            while not final:
+                # Read ahead one block to know if this one is the last.
+                next_block = self.read_block(src) if block else b""
+                final = not next_block
+                add_block(block, final)
+                block = next_block
+        except Exception as e:
+            error = e
+            if not final:
+                # End the member with what was read so the rest of the container can still be read.
+                final = True
+                add_block(block, final)
+        while pending:
+            compressed_size += self.write(pending.popleft().result())
+
+        self.write(struct.pack("<IIQQ", DATA_DESCRIPTOR, crc, compressed_size, size))
+        self.add_central_record(encoded_name, flags, method, dos_time, date, crc, compressed_size, size, attributes,
+                                offset)
+        return (size,) + tuple(h.hexdigest() for h in hashes) + (error,)
+
+    @staticmethod
+    def read_block(src):
+        start_time = time.perf_counter()
+        block = src.read(BLOCK_SIZE)
+        run_metrics.count("transferred", size=len(block), seconds=time.perf_counter() - start_time)
+        return block
+
+    def add_central_record(self, encoded_name, flags, method, dos_time, date, crc, compressed_size, size, attributes,
+                           offset):
+        """
+            Add a member's record to the central directory, with its sizes and offset in a ZIP64 extra field.
+        """
+
+        extra = struct.pack("<HHQQQ", ZIP64_EXTRA, 24, size, compressed_size, offset)
+        self.central_directory.write(struct.pack("<IHHHHHHIIIHHHHHII", CENTRAL_HEADER, UNIX << 8 | ZIP64_VERSION,
+                                                 ZIP64_VERSION, flags, method, dos_time, date, crc, MAX_32, MAX_32,
+                                                 len(encoded_name), len(extra), 0, 0, 0, attributes & MAX_32, MAX_32)
+                                     + encoded_name + extra)
+        self.entries += 1
+
+    def close(self):
+        """
+            Add the hash manifest, then write the central directory and the end records.
+        """
+
+        if self.file is None:
+            return
+        try:
+            self.manifest.flush()
+            manifest = self.manifest.detach()
+            manifest.seek(0)
+            error = self.add_member(MANIFEST_NAME, None, 0o100644, manifest)[3]
+            manifest.close()
+            if error is not None:
+                raise error
+
+            central_offset = self.offset
+            self.central_directory.seek(0)
+            shutil.copyfileobj(self.central_directory, self.file, 16 * 1024 * 1024)
+            central_size = self.central_directory.tell()
+            self.central_directory.close()
+            end_offset = central_offset + central_size
+            self.file.write(struct.pack("<IQHHIIQQQQ", ZIP64_END, 44, UNIX << 8 | ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                                        self.entries, self.entries, central_size, central_offset))
+            self.file.write(struct.pack("<IIQI", ZIP64_LOCATOR, 0, end_offset, 1))
+            self.file.write(struct.pack("<IHHHHIIH", END, 0, 0, min(self.entries, MAX_16), min(self.entries, MAX_16),
+                                        min(central_size, MAX_32), min(central_offset, MAX_32), 0))
+        finally:
+            self.pool.shutdown()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()